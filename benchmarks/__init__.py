@@ -0,0 +1,3 @@
+from benchmarks.runner import BACKENDS, OPERATIONS, run, compare
+from benchmarks.scaling import run_scaling
+from benchmarks.shapes import SHAPES
@@ -0,0 +1,68 @@
+"""
+Command line interface for the benchmarks.
+
+    python -m benchmarks run --sizes 1000 10000 --output results.json
+    python -m benchmarks compare baseline.json results.json
+    python -m benchmarks scaling --size 1000000 --workers 1 2 4 8
+"""
+
+import argparse
+import sys
+
+from benchmarks.runner import BACKENDS, run, compare, save, load
+from benchmarks.scaling import run_scaling
+from benchmarks.shapes import SHAPES
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description='Benchmarks for the tree implementations.'
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--backends', nargs='+', choices=sorted(BACKENDS), default=sorted(BACKENDS))
+    run_parser.add_argument('--shapes', nargs='+', choices=sorted(SHAPES), default=sorted(SHAPES))
+    run_parser.add_argument('--sizes', nargs='+', type=int, default=[1000, 10000])
+    run_parser.add_argument('--ops', type=int, default=100, help='measured calls for each operation')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help='JSON file for the results')
+
+    compare_parser = commands.add_parser('compare', help='compare two runs and list the regressions')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=1.2, help='slowdown ratio reported as regression')
+    compare_parser.add_argument('--statistic', default='p50_ms', choices=['p50_ms', 'p90_ms', 'p99_ms', 'max_ms'])
+
+    scaling_parser = commands.add_parser('scaling', help='measure the parallel bulk build with more and more workers')
+    scaling_parser.add_argument('--shape', choices=sorted(SHAPES), default='balanced')
+    scaling_parser.add_argument('--size', type=int, default=100000)
+    scaling_parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    scaling_parser.add_argument('--url', default='sqlite:///:memory:', help='database of the built trees')
+    scaling_parser.add_argument('--seed', type=int, default=0)
+    scaling_parser.add_argument('--output', help='JSON file for the results')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run(args.backends, args.shapes, args.sizes, args.ops, args.seed)
+        if args.output:
+            save(results, args.output)
+        return 0
+
+    if args.command == 'scaling':
+        results = run_scaling(args.shape, args.size, args.workers, args.seed, args.url)
+        if args.output:
+            save(results, args.output)
+        return 0
+
+    regressions = compare(load(args.baseline), load(args.current), args.threshold, args.statistic)
+    for key, old, new, ratio in regressions:
+        print('{:<12} {:<9} {:>8} {:<16} {:.3f}ms -> {:.3f}ms ({:.2f}x)'.format(*(key + (old, new, ratio))))
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
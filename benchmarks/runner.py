@@ -0,0 +1,264 @@
+"""
+Runs the same workload against every tree implementation and collects latency statistics.
+"""
+
+import json
+import platform
+import time
+from random import Random
+
+import sqlalchemy
+
+from benchmarks.shapes import SHAPES
+from sql_tree_implementations.adjacency_list import AdjacencyTree
+from sql_tree_implementations.closure_table import ClosureTree
+from sql_tree_implementations.hybrid_tree import HybridTree
+from sql_tree_implementations.nested_sets import NestedSetsTree
+
+BACKENDS = {
+    'closure': ClosureTree,
+    'nested_sets': NestedSetsTree,
+    'adjacency': AdjacencyTree,
+    'hybrid': HybridTree
+}
+
+OPERATIONS = ['insert', 'get_path', 'get_descendants', 'get_roots', 'move', 'delete']
+
+
+def percentile(sorted_values, fraction):
+    """
+    Returns a percentile of a sorted list, using the nearest rank.
+    :param sorted_values: the sorted values
+    :param fraction: the percentile as a number between 0 and 1
+    :return: the value
+    """
+
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(timings):
+    """
+    Computes the statistics of an operation.
+    :param timings: the duration of every call, in seconds
+    :return: a dict with the statistics, latencies are in milliseconds
+    """
+
+    values = sorted(timings)
+    total = sum(values)
+
+    return {
+        'count': len(values),
+        'total_s': total,
+        'ops_per_s': len(values) / total if total else None,
+        'p50_ms': percentile(values, 0.5) * 1000,
+        'p90_ms': percentile(values, 0.9) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': values[-1] * 1000
+    }
+
+
+def load_tree(tree, parents):
+    """
+    Stores a tree shape, with the bulk import when the tree has one.
+    :param tree: an empty tree
+    :param parents: the parent index of every node
+    :return: the id of every node
+    """
+
+    if hasattr(tree, 'add_edges'):
+        ids = tree.add_edges((index, parent, 'n{}'.format(index)) for index, parent in enumerate(parents))
+        return [ids[index] for index in range(len(parents))]
+
+    ids = []
+    with tree.session():
+        for index, parent in enumerate(parents):
+            ids.append(tree.add_node('n{}'.format(index), None if parent is None else ids[parent]))
+
+    return ids
+
+
+class Workload:
+    """
+    Keeps a copy of the structure in memory, so that valid random operations can be picked without querying the
+    tree that is being measured. Every operation method makes one call to the tree and returns its duration.
+    """
+
+    def __init__(self, tree, parents, rng):
+        self.tree = tree
+        self.parents = list(parents)
+        self.rng = rng
+        self.ids = load_tree(tree, parents)
+        self.deleted = set()
+        self.leaves = None
+
+    def _random_node(self):
+        while True:
+            index = self.rng.randrange(len(self.parents))
+            if index not in self.deleted:
+                return index
+
+    def _is_under(self, index, ancestor):
+        while index is not None:
+            if index == ancestor:
+                return True
+            index = self.parents[index]
+
+        return False
+
+    def _timed(self, function, *args):
+        start = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - start
+
+    def insert(self):
+        parent = self._random_node()
+
+        start = time.perf_counter()
+        new_id = self.tree.add_node('new', self.ids[parent])
+        duration = time.perf_counter() - start
+
+        self.parents.append(parent)
+        self.ids.append(new_id)
+
+        return duration
+
+    def get_path(self):
+        return self._timed(self.tree.get_path, self.ids[self._random_node()])
+
+    def get_descendants(self):
+        return self._timed(self.tree.get_descendants, self.ids[self._random_node()])
+
+    def get_roots(self):
+        return self._timed(self.tree.get_roots)
+
+    def move(self):
+        while True:
+            node, parent = self._random_node(), self._random_node()
+            if not self._is_under(parent, node):
+                break
+
+        duration = self._timed(self.tree.move_node, self.ids[node], self.ids[parent])
+        self.parents[node] = parent
+
+        return duration
+
+    def delete(self):
+        # only delete leaves, so that the size of the tree does not collapse
+        if self.leaves is None:
+            has_children = set(self.parents)
+            self.leaves = [x for x in range(len(self.parents)) if x not in has_children]
+            self.rng.shuffle(self.leaves)
+
+        node = self.leaves.pop()
+
+        duration = self._timed(self.tree.delete_node, self.ids[node])
+        self.deleted.add(node)
+
+        return duration
+
+
+def run_case(backend, shape, size, ops, seed):
+    """
+    Builds one tree and measures all the operations on it.
+    :param backend: the name of the tree implementation
+    :param shape: the name of the tree shape
+    :param size: the number of nodes
+    :param ops: the number of calls measured for each operation
+    :param seed: the seed of the random generator
+    :return: a list of result dicts
+    """
+
+    rng = Random(seed)
+    parents = SHAPES[shape](size, rng)
+
+    start = time.perf_counter()
+    workload = Workload(BACKENDS[backend](), parents, rng)
+    load_time = time.perf_counter() - start
+
+    case = {'backend': backend, 'shape': shape, 'size': size}
+    results = [dict(case, operation='load', **summarize([load_time]))]
+
+    for operation in OPERATIONS:
+        timings = [getattr(workload, operation)() for _ in range(ops)]
+        results.append(dict(case, operation=operation, **summarize(timings)))
+
+    workload.tree.engine.dispose()
+
+    return results
+
+
+def run(backends, shapes, sizes, ops=100, seed=0, report=print):
+    """
+    Runs the benchmark for every combination of backend, shape and size.
+    :param backends: the names of the tree implementations
+    :param shapes: the names of the tree shapes
+    :param sizes: the numbers of nodes
+    :param ops: the number of calls measured for each operation
+    :param seed: the seed of the random generator
+    :param report: a function called with a progress message after each case (None for no progress)
+    :return: a dict that can be saved as JSON
+    """
+
+    results = []
+    for size in sizes:
+        for shape in shapes:
+            for backend in backends:
+                case_results = run_case(backend, shape, size, ops, seed)
+                results.extend(case_results)
+
+                if report:
+                    report('{:<12} {:<9} {:>8}  {}'.format(backend, shape, size, '  '.join(
+                        '{}={:.3f}ms'.format(x['operation'], x['p50_ms']) for x in case_results)))
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'ops': ops,
+            'seed': seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'results': results
+    }
+
+
+def compare(baseline, current, threshold=1.2, statistic='p50_ms'):
+    """
+    Compares two benchmark runs.
+    :param baseline: the result dict of the reference run
+    :param current: the result dict of the new run
+    :param threshold: the ratio above which a slowdown is reported as a regression
+    :param statistic: the latency statistic that is compared
+    :return: a list of (key, baseline value, current value, ratio) tuples for the regressions
+    """
+
+    def keyed(run_results):
+        return {(x['backend'], x['shape'], x['size'], x['operation']): x[statistic] for x in run_results['results']}
+
+    old, new = keyed(baseline), keyed(current)
+    regressions = []
+
+    for key in sorted(set(old) & set(new)):
+        if old[key] and new[key] / old[key] > threshold:
+            regressions.append((key, old[key], new[key], new[key] / old[key]))
+
+    return regressions
+
+
+def save(results, file_name):
+    """
+    Saves the results of a run as JSON.
+    """
+
+    with open(file_name, 'w') as handle:
+        json.dump(results, handle, indent=2)
+
+
+def load(file_name):
+    """
+    Loads the results of a run from a JSON file.
+    """
+
+    with open(file_name) as handle:
+        return json.load(handle)
@@ -0,0 +1,80 @@
+"""
+Measures how the parallel bulk build of a closure tree scales with the number of worker processes.
+"""
+
+import os
+import platform
+import tempfile
+import time
+from random import Random
+
+import sqlalchemy
+
+from benchmarks.shapes import SHAPES
+from sql_tree_implementations.closure_table import ClosureTree
+from sql_tree_implementations.snapshot import write_snapshot
+
+
+def write_shape(file_name, parents):
+    """
+    Writes a tree shape to a snapshot file, where the node ids are the indexes plus one.
+    :param file_name: the path of the snapshot
+    :param parents: the parent index of every node
+    """
+
+    write_snapshot(file_name, (
+        (index + 1, None if parent is None else parent + 1, 'n{}'.format(index)) for index, parent in enumerate(parents)
+    ))
+
+
+def run_scaling(shape, size, workers, seed=0, url='sqlite:///:memory:', report=print):
+    """
+    Loads the same snapshot without worker processes, then with each number of workers.
+    :param shape: the name of the tree shape
+    :param size: the number of nodes
+    :param workers: the numbers of worker processes
+    :param seed: the seed of the random generator
+    :param url: the database URL, the tables are dropped after each load
+    :param report: a function called with a progress message after each load (None for no progress)
+    :return: a dict that can be saved as JSON, the results have the build time and the speedup over the serial build
+    """
+
+    handle, file_name = tempfile.mkstemp(suffix='.snap')
+    os.close(handle)
+
+    try:
+        write_shape(file_name, SHAPES[shape](size, Random(seed)))
+
+        results = []
+        for count in [None] + list(workers):
+            start = time.perf_counter()
+            tree = ClosureTree.load(file_name, url, workers=count)
+            duration = time.perf_counter() - start
+
+            tree.metadata.drop_all(tree.engine)
+            tree.engine.dispose()
+
+            results.append({
+                'shape': shape,
+                'size': size,
+                'workers': count or 0,
+                'seconds': duration,
+                'speedup': results[0]['seconds'] / duration if results else 1.0
+            })
+
+            if report:
+                report('{:<9} {:>9} workers={:<3} {:.3f}s ({:.2f}x)'.format(
+                    shape, size, count or 0, duration, results[-1]['speedup']))
+    finally:
+        os.remove(file_name)
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'sqlalchemy': sqlalchemy.__version__,
+            'cpus': os.cpu_count(),
+            'seed': seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+        },
+        'results': results
+    }
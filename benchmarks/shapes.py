@@ -0,0 +1,54 @@
+"""
+Synthetic tree shapes.
+Every shape is a function that takes the number of nodes and a random generator, and returns the parent of every
+node as a list of indexes (None for roots). A parent always comes before its children.
+"""
+
+
+def balanced(size, rng, fanout=10):
+    """
+    A complete tree where every node has the same number of children.
+    """
+
+    return [None] + [(index - 1) // fanout for index in range(1, size)]
+
+
+def wide(size, rng, fanout=1000):
+    """
+    A shallow tree with a very large number of children for every node.
+    """
+
+    return balanced(size, rng, fanout)
+
+
+def deep(size, rng, chain_length=100):
+    """
+    Long chains of nodes hanging from a single root.
+    """
+
+    return [None] + [0 if index % chain_length == 1 else index - 1 for index in range(1, size)]
+
+
+def skewed(size, rng):
+    """
+    A random tree where nodes with many children are more likely to get new ones (preferential attachment), which
+    gives a few very large nodes and many small ones.
+    """
+
+    parents = [None]
+    tickets = [0]
+
+    for index in range(1, size):
+        parent = rng.choice(tickets)
+        parents.append(parent)
+        tickets.extend((parent, index))
+
+    return parents
+
+
+SHAPES = {
+    'balanced': balanced,
+    'wide': wide,
+    'deep': deep,
+    'skewed': skewed
+}
@@ -1 +1,8 @@
 from sql_tree_implementations.closure_table import ClosureTree
+from sql_tree_implementations.tree_index import TreeIndex
+
+try:
+    from sql_tree_implementations.async_closure_table import AsyncClosureTree
+except ImportError:
+    # the async API needs the asyncio extension of SQLAlchemy (greenlet)
+    pass
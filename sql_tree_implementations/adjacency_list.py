@@ -1,24 +1,251 @@
+from sqlalchemy import Table, Column, Integer, Text, ForeignKey, Index, select, literal, desc
+
 from sql_tree_implementations.generic_tree import GenericTree
 
 
 class AdjacencyTree(GenericTree):
+    """
+    Class to create a structure that can store trees using adjacency lists.
+    Every node only stores its parent, so moving a subtree is a single update. Reads that span several levels use
+    recursive common table expressions.
+    """
+
+    def __init__(self, url='sqlite:///:memory:', title_index=False, **engine_options):
+        """
+        Instance initialization.
+        :param url: the database URL (e.g. 'sqlite:///tree.db')
+        :param title_index: if True, the node titles are indexed, which speeds up the lookups by title
+        :param engine_options: the engine and pragmas arguments of GenericTree, or extra arguments for create_engine
+        (e.g. poolclass=QueuePool, pool_size=10)
+        """
+
+        super(AdjacencyTree, self).__init__(url, title_index, **engine_options)
+
+        # the instances with the same options share the table definitions
+        self._share_tables((AdjacencyTree, title_index), self._define_tables)
+
+    def _define_tables(self):
+        """
+        Adds the Nodes table, with the parent of every node, to the metadata.
+        """
+
+        self.nodes = Table(
+            'nodes', self.metadata,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('title', Text, nullable=True),
+            Column('parent_id', Integer, ForeignKey('nodes.id'), nullable=True),
+            Index('nodes_parent_idx', 'parent_id')
+        )
+
+        self._add_title_index()
+
+    def _ancestors(self, node_id):
+        """
+        Builds a recursive CTE with the node and all its ancestors.
+        :param node_id: the id of the node
+        :return: a CTE with the id, parent_id, title and depth (distance from the node) columns
+        """
+
+        cte = select(
+            [self.nodes.c.id, self.nodes.c.parent_id, self.nodes.c.title, literal(0, Integer).label('depth')]
+        ).where(
+            self.nodes.c.id == node_id
+        ).cte('ancestors', recursive=True)
+
+        parent = self.nodes.alias()
+
+        return cte.union_all(
+            select(
+                [parent.c.id, parent.c.parent_id, parent.c.title, cte.c.depth + 1]
+            ).where(
+                parent.c.id == cte.c.parent_id
+            )
+        )
+
+    def _descendants(self, node_id=None, max_depth=None):
+        """
+        Builds a recursive CTE with the node and all its descendants.
+        :param node_id: the id of the top node (None to start from the roots)
+        :param max_depth: the maximum depth relative to the top node (None for no limit)
+        :return: a CTE with the id, parent_id, title and depth (relative to the top node) columns
+        """
+
+        cte = select(
+            [self.nodes.c.id, self.nodes.c.parent_id, self.nodes.c.title, literal(0, Integer).label('depth')]
+        ).where(
+            self.nodes.c.parent_id.is_(None) if node_id is None else self.nodes.c.id == node_id
+        ).cte('descendants', recursive=True)
+
+        child = self.nodes.alias()
+
+        recursive_part = select(
+            [child.c.id, child.c.parent_id, child.c.title, cte.c.depth + 1]
+        ).where(
+            child.c.parent_id == cte.c.id
+        )
+
+        if max_depth is not None:
+            recursive_part = recursive_part.where(cte.c.depth < max_depth)
+
+        return cte.union_all(recursive_part)
+
+    def add_node(self, title='', parent=None, by_title=False):
+        """
+        Add a new child element to a parent.
+        :param title: the title of the child element.
+        :param parent: the parent of the child element.
+        :param by_title: if True, it will use the first id found for the parent title
+        :return: the id of the new node
+        """
+
+        with self._connect() as conn:
+            parent_id = self._resolve_parent(parent, by_title, conn)
+
+            return conn.execute(
+                self.nodes.insert(), {'title': title, 'parent_id': parent_id}
+            ).inserted_primary_key[0]
+
+    def is_root(self, node_id, connnection=None):
+        """
+        Checks if the node with the given id is root or not.
+        :param node_id: the id of the node to be checked
+        :param connnection: a database connection
+        :return: True if the node is root, False otherwise.
+        """
+
+        with self._connect(connnection) as connnection:
+            return connnection.execute(
+                select(
+                    [self.nodes.c.id]
+                ).where(
+                    self.nodes.c.id == node_id
+                ).where(
+                    self.nodes.c.parent_id.isnot(None)
+                )
+            ).fetchone() is None
+
     def delete_node(self, node_id, connection=None):
-        pass
+        """
+        Delete the node with the specified id and all it's descendants.
+        :param node_id: the id of the node to be removed
+        :param connection: a database connection
+        """
+
+        descendants = self._descendants(node_id)
+
+        with self._connect(connection) as connection:
+            connection.execute(
+                self.nodes.delete().where(
+                    self.nodes.c.id.in_(select([descendants.c.id]))
+                )
+            )
 
     def move_node(self, node_id, new_parent_id, connection=None):
-        pass
+        """
+        Moves a node under a different parent node, by updating only the node itself.
+        :param node_id: the id of the node to be moved
+        :param new_parent_id: the id of the new parent node (None to make the node a root)
+        :param connection: a database connection
+        """
 
-    def is_root(self, node_id, connnection=None):
-        pass
+        with self._connect(connection) as connection:
+            if not self.node_exists(node_id, connection):
+                raise Exception('Node does not exist.')
 
-    def get_path(self, node_id, connection=None):
-        pass
+            if new_parent_id is not None:
+                # the ancestors of the new parent also tell if it exists
+                ancestors = self._ancestors(new_parent_id)
+                ancestor_ids = [x.id for x in connection.execute(select([ancestors.c.id]))]
 
-    def get_descendants(self, node_id, connection=None):
-        pass
+                if not ancestor_ids:
+                    raise Exception('Parent node does not exist.')
 
-    def add_node(self, title='', parent=None, by_title=False):
-        pass
+                if node_id in ancestor_ids:
+                    raise Exception('A node cannot be moved under its own subtree.')
+
+            connection.execute(
+                self.nodes.update().where(
+                    self.nodes.c.id == node_id
+                ).values(
+                    parent_id=new_parent_id
+                )
+            )
 
     def get_roots(self, connection=None):
-        pass
+        """
+        Get the root nodes.
+        :param connection: a database connection
+        :return: a list of rows with the root nodes
+        """
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select(
+                    [self.nodes.c.title, self.nodes.c.id.label('descendant')]
+                ).where(
+                    self.nodes.c.parent_id.is_(None)
+                )
+            ).fetchall()
+
+    def get_descendants(self, node_id, connection=None):
+        """
+        Get the direct descendants of the given node.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a list of rows with the descendants of the node with id = node_id
+        """
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select([
+                    self.nodes.c.parent_id.label('ancestor'),
+                    self.nodes.c.id.label('descendant'),
+                    literal(1, Integer).label('depth'),
+                    self.nodes.c.title
+                ]).where(
+                    self.nodes.c.parent_id == node_id
+                )
+            ).fetchall()
+
+    def get_path(self, node_id, connection=None):
+        """
+        Retrieves the ancestors in descending order of depth (useful for building node location (path from root).
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a list of rows containing the ancestors of the given node
+        """
+
+        ancestors = self._ancestors(node_id)
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select([
+                    ancestors.c.id.label('ancestor'),
+                    literal(node_id, Integer).label('descendant'),
+                    ancestors.c.depth,
+                    ancestors.c.title
+                ]).order_by(
+                    desc(ancestors.c.depth)
+                )
+            ).fetchall()
+
+    def get_subtree(self, node_id=None, max_depth=None, connection=None):
+        """
+        Loads a subtree in memory with a single recursive query.
+        :param node_id: the id of the top node (None to load all the trees)
+        :param max_depth: the maximum depth relative to the top node (None for no limit)
+        :param connection: a database connection
+        :return: a SubtreeNode (None if the node does not exist) or a list of SubtreeNode roots if node_id is None
+        """
+
+        descendants = self._descendants(node_id, max_depth)
+
+        with self._connect(connection) as connection:
+            top_nodes = self._build_subtree(
+                connection.execute(select([descendants]).order_by(descendants.c.id)).fetchall()
+            )
+
+        if node_id is None:
+            return top_nodes
+
+        return top_nodes[0] if top_nodes else None
@@ -0,0 +1,435 @@
+from sql_tree_implementations.async_generic_tree import AsyncGenericTree
+from sql_tree_implementations.closure_table import ClosureQueries, Change, closure_rows
+from sql_tree_implementations.utils import chunked
+
+
+class AsyncClosureTree(ClosureQueries, AsyncGenericTree):
+    """
+    Class to create a structure that can store trees using closure tables, with awaitable operations on an asyncio
+    engine. The statements are the same as the ones of ClosureTree.
+    """
+
+    def __init__(self, url='sqlite+aiosqlite:///:memory:', title_index=False, log_changes=False, **engine_options):
+        """
+        Instance initialization.
+        :param url: the database URL with an async driver (e.g. 'sqlite+aiosqlite:///tree.db')
+        :param title_index: if True, the node titles are indexed, which speeds up the lookups by title
+        :param log_changes: if True, every structural change is appended to the change log, as with ClosureTree
+        :param engine_options: the engine and pragmas arguments of AsyncGenericTree, or extra arguments for
+        create_async_engine (e.g. pool_size=10)
+        """
+
+        super(AsyncClosureTree, self).__init__(url, title_index, **engine_options)
+
+        self.log_changes = log_changes
+
+        # add table objects
+        self._use_tables()
+
+    async def _record(self, changes, connection):
+        """
+        Appends structural changes to the change log, when it is enabled.
+        :param changes: an iterable of (operation, node_id, parent_id) tuples
+        :param connection: a database connection
+        """
+
+        rows = self._change_rows(changes)
+        if rows:
+            await connection.execute(self.changes.insert(), rows)
+
+    async def add_node(self, title='', parent=None, by_title=False):
+        """
+        Add a new child element to a parent.
+        :param title: the title of the child element.
+        :param parent: the parent of the child element.
+        :param by_title: if True, it will use the first id found for the parent title
+        :return: the id of the new node
+        """
+
+        async with self._connect() as conn:
+            parent_id = await self._resolve_parent(parent, by_title, conn)
+
+            # store new node and its paths
+            new_node_pk = (await conn.execute(self.nodes.insert(), {'title': title})).inserted_primary_key[0]
+            await conn.execute(self._add_paths_stmt(new_node_pk, parent_id))
+            await self._record([('add', new_node_pk, parent_id)], conn)
+
+            return new_node_pk
+
+    async def add_edges(self, edges, parent=None, by_title=False, chunk_size=10000):
+        """
+        Add many nodes at once, inside a single transaction.
+        :param edges: an iterable of (key, parent_key, title) tuples. The keys only link the edges together, a
+        parent_key of None places the node directly under the parent.
+        :param parent: the parent of the top level nodes (None to add them as roots)
+        :param by_title: if True, it will use the first id found for the parent title
+        :param chunk_size: the maximum number of rows written by a single statement
+        :return: a dict mapping each key to the id of its new node
+        """
+
+        parents, titles, order = self._parse_edges(edges)
+
+        async with self._connect() as conn:
+            parent_id = await self._resolve_parent(parent, by_title, conn)
+
+            base_paths = []
+            if parent_id is not None:
+                base_paths = [(row.ancestor, row.depth) for row in await self.get_path(parent_id, conn)]
+
+            if not order:
+                return {}
+
+            # the first node gets its id from the database, and its insert holds the write lock until the commit, so
+            # no other writer can take the next ids, which are allocated upfront to write the nodes with executemany
+            first_id = (await conn.execute(
+                self.nodes.insert(), {'title': titles[order[0]]}
+            )).inserted_primary_key[0]
+            ids = {key: first_id + index for index, key in enumerate(order)}
+
+            for chunk in chunked(({'id': ids[key], 'title': titles[key]} for key in order[1:]), chunk_size):
+                await conn.execute(self.nodes.insert(), chunk)
+
+            for chunk in chunked(closure_rows(order, parents, ids, base_paths), chunk_size):
+                await conn.execute(self.paths.insert(), chunk)
+
+            await self._record((
+                ('add', ids[key], parent_id if parents[key] is None else ids[parents[key]]) for key in order
+            ), conn)
+
+        return ids
+
+    async def add_subtree(self, structure, parent=None, by_title=False, chunk_size=10000):
+        """
+        Add a nested structure of nodes at once, inside a single transaction.
+        :param structure: a list of nodes, where each node is either a title or a (title, children) tuple
+        :param parent: the parent of the top level nodes (None to add them as roots)
+        :param by_title: if True, it will use the first id found for the parent title
+        :param chunk_size: the maximum number of rows written by a single statement
+        :return: the ids of the new nodes in depth-first order
+        """
+
+        edges = self._structure_edges(structure)
+        ids = await self.add_edges(edges, parent, by_title, chunk_size)
+
+        return [ids[key] for key in range(len(edges))]
+
+    async def detach_node(self, node_id, connection=None):
+        """
+        Deletes all paths leading to or begin with a node, creating a new tree formed by its subtree.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        """
+
+        async with self._connect(connection) as connection:
+            await connection.execute(self._detach_stmt(node_id))
+            await self._record([('detach', node_id, None)], connection)
+
+    async def attach_node(self, node_id, new_parent_id, connection=None):
+        """
+        Attach a root node under a new parent node.
+        :param node_id: the id of the root node
+        :param new_parent_id: the id of the new parent
+        :param connection: a database connection
+        """
+
+        async with self._connect(connection) as connection:
+            await self._check_move(node_id, new_parent_id, connection)
+
+            if not await self.is_root(node_id, connection):
+                raise Exception('Only root nodes can be attached.')
+
+            await connection.execute(self._attach_stmt(node_id, new_parent_id))
+            await self._record([('attach', node_id, new_parent_id)], connection)
+
+    async def _check_move(self, node_id, new_parent_id, connection):
+        """
+        Checks that a node can be moved under a new parent: both nodes exist and the parent is not in the subtree of
+        the node.
+        :param node_id: the id of the node
+        :param new_parent_id: the id of the new parent (None if the node becomes a root)
+        :param connection: a database connection
+        """
+
+        if not await self.node_exists(node_id, connection):
+            raise Exception('Node does not exist.')
+
+        if new_parent_id is None:
+            return
+
+        if not await self.node_exists(new_parent_id, connection):
+            raise Exception('Parent node does not exist.')
+
+        if (await connection.execute(self._cycle_stmt(node_id, new_parent_id))).fetchone() is not None:
+            raise Exception('A node cannot be moved under its own subtree.')
+
+    async def is_root(self, node_id, connnection=None):
+        """
+        Checks if the node with the given id is root or not.
+        :param node_id: the id of the node to be checked
+        :param connnection: a database connection
+        :return: True if the node is root, False otherwise.
+        """
+
+        async with self._connect(connnection) as connnection:
+            return (await connnection.execute(self._not_root_stmt(node_id))).fetchone() is None
+
+    async def delete_node(self, node_id, connection=None):
+        """
+        Delete the node with the specified id and all it's descendants.
+        :param node_id: the id of the node to be removed
+        :param connection: a database connection
+        """
+
+        async with self._connect(connection) as connection:
+            subtree_ids = [x.descendant for x in await connection.execute(self._subtree_ids_stmt(node_id))]
+            for stmt in self._delete_stmts(node_id, subtree_ids):
+                await connection.execute(stmt)
+
+            if subtree_ids:
+                await self._record([('delete', node_id, None)], connection)
+
+    async def move_node(self, node_id, new_parent_id, connection=None):
+        """
+        Moves a node under a different parent node, in a single transaction.
+        :param node_id: the id of the node to be moved
+        :param new_parent_id: the id of the new parent node (None to make the node a root)
+        :param connection: a database connection
+        """
+
+        async with self._connect(connection) as connection:
+            await self._check_move(node_id, new_parent_id, connection)
+            await connection.execute(self._detach_stmt(node_id))
+            await connection.execute(self._attach_stmt(node_id, new_parent_id))
+            await self._record([('move', node_id, new_parent_id)], connection)
+
+    async def changes_since(self, version=0, limit=None, connection=None):
+        """
+        Reads the change log, which holds the structural changes made by every process in the order they were
+        committed.
+        :param version: the version of the last change already seen (0 to read the whole log)
+        :param limit: the maximum number of changes returned (None for no limit)
+        :param connection: a database connection
+        :return: a list of Change rows, in version order
+        """
+
+        async with self._connect(connection) as connection:
+            return [Change(x.version, x.operation, x.node_id, x.parent_id)
+                    for x in await connection.execute(self._changes_stmt(version, limit))]
+
+    async def change_version(self, connection=None):
+        """
+        Returns the version of the last change, to start following the log from the current state.
+        :param connection: a database connection
+        :return: the version, 0 if the log is empty
+        """
+
+        async with self._connect(connection) as connection:
+            return (await connection.execute(self._change_version_stmt())).scalar()
+
+    async def get_roots(self, connection=None):
+        """
+        Get the root nodes.
+        :param connection: a database connection
+        :return: a list of rows with the root nodes
+        """
+
+        async with self._connect(connection) as connection:
+            return (await connection.execute(self._roots_stmt())).fetchall()
+
+    async def get_descendants(self, node_id, connection=None):
+        """
+        Get the descendants of the given node.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a list of rows with the descendants of the node with id = node_id
+        """
+
+        async with self._connect(connection) as connection:
+            return (await connection.execute(self._descendants_stmt(node_id))).fetchall()
+
+    async def iter_descendants(self, node_id, min_depth=1, max_depth=None, batch_size=1000, cursor=None,
+                               connection=None):
+        """
+        Streams all the descendants of a node ordered by depth and id, fetching them in batches with keyset
+        pagination so that the memory usage does not depend on the size of the subtree.
+        :param node_id: the id of the node
+        :param min_depth: the minimum depth relative to the node
+        :param max_depth: the maximum depth relative to the node (None for no limit)
+        :param batch_size: the number of rows fetched by a query
+        :param cursor: a (depth, descendant) pair taken from the last row processed; the iteration resumes after it
+        :param connection: a database connection
+        :return: an async generator of rows with the paths and the titles of the descendants
+        """
+
+        while True:
+            batch_stmt = self._descendants_batch_stmt(node_id, min_depth, max_depth, batch_size, cursor)
+
+            # only hold the connection while fetching a batch
+            async with self._connect(connection) as batch_connection:
+                rows = (await batch_connection.execute(batch_stmt)).fetchall()
+
+            for row in rows:
+                yield row
+
+            if len(rows) < batch_size:
+                return
+
+            cursor = rows[-1].depth, rows[-1].descendant
+
+    async def get_path(self, node_id, connection=None):
+        """
+        Retrieves the ancestors in descending order of depth (useful for building node location (path from root).
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a list of rows containing the ancestors of the given node
+        """
+
+        async with self._connect(connection) as connection:
+            return (await connection.execute(self._path_stmt(node_id))).fetchall()
+
+    async def get_paths(self, node_ids, chunk_size=500, connection=None):
+        """
+        Retrieves the ancestors of many nodes, with one query for each chunk of ids, issued concurrently when
+        possible.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to the list of rows returned by get_path for it
+        """
+
+        paths = {x: [] for x in node_ids}
+
+        statements = [self._paths_stmt(chunk) for chunk in chunked(list(paths), chunk_size)]
+        for rows in await self._fetch_all(statements, connection):
+            for row in rows:
+                paths[row.descendant].append(row)
+
+        return paths
+
+    async def are_roots(self, node_ids, chunk_size=500, connection=None):
+        """
+        Checks if many nodes are roots, with one query for each chunk of ids, issued concurrently when possible.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to True if the node is root, False otherwise
+        """
+
+        roots = dict.fromkeys(node_ids, True)
+
+        statements = [self._not_roots_stmt(chunk) for chunk in chunked(list(roots), chunk_size)]
+        for rows in await self._fetch_all(statements, connection):
+            for row in rows:
+                roots[row.descendant] = False
+
+        return roots
+
+    async def is_ancestor(self, ancestor_id, descendant_id, include_self=False, connection=None):
+        """
+        Checks if a node is an ancestor of another one, with a single lookup on the primary key of the paths.
+        :param ancestor_id: the id of the ancestor
+        :param descendant_id: the id of the descendant
+        :param include_self: if True, a node is considered an ancestor of itself
+        :param connection: a database connection
+        :return: True or False, also False if one of the nodes does not exist
+        """
+
+        async with self._connect(connection) as connection:
+            stmt = self._is_ancestor_stmt(ancestor_id, descendant_id, include_self)
+
+            return (await connection.execute(stmt)).fetchone() is not None
+
+    async def is_ancestor_many(self, pairs, include_self=False, chunk_size=250, connection=None):
+        """
+        Checks many (ancestor, descendant) pairs, with one query for each chunk of pairs, issued concurrently when
+        possible.
+        :param pairs: a list of (ancestor_id, descendant_id) pairs
+        :param include_self: if True, a node is considered an ancestor of itself
+        :param chunk_size: the maximum number of pairs sent in a query
+        :param connection: a database connection
+        :return: a list of booleans, in the order of the pairs
+        """
+
+        pairs = [tuple(x) for x in pairs]
+
+        statements = [
+            self._ancestor_pairs_stmt(chunk, include_self) for chunk in chunked(list(dict.fromkeys(pairs)), chunk_size)
+        ]
+        found = set()
+        for rows in await self._fetch_all(statements, connection):
+            found.update((row.ancestor, row.descendant) for row in rows)
+
+        return [x in found for x in pairs]
+
+    async def lca(self, node_ids, connection=None):
+        """
+        Finds the lowest common ancestor of some nodes with a single query, which intersects their ancestors and
+        keeps the nearest one. A node counts as its own ancestor, so the result can be one of the nodes.
+        :param node_ids: the ids of the nodes
+        :param connection: a database connection
+        :return: the id of the ancestor, or None if the nodes are not in the same tree
+        """
+
+        node_ids = list(dict.fromkeys(node_ids))
+        if not node_ids:
+            return None
+
+        async with self._connect(connection) as connection:
+            return (await connection.execute(self._lca_stmt(node_ids))).scalar()
+
+    async def resolve_path(self, path, sep='/', connection=None):
+        """
+        Finds a node by the titles of its ancestors, with a single query.
+        :param path: a string with the titles from the root to the node joined by sep (e.g. 'A/B/D'), or a sequence
+        of titles
+        :param sep: the separator of the titles
+        :param connection: a database connection
+        :return: the id of the node, or None if no node matches. If several nodes match, the smallest id is returned
+        """
+
+        ids = await self.resolve_paths([path], sep, connection=connection)
+
+        return ids[0]
+
+    async def resolve_paths(self, paths, sep='/', chunk_size=100, connection=None):
+        """
+        Finds many nodes by the titles of their ancestors, with one query for each chunk of paths, issued
+        concurrently when possible.
+        :param paths: the paths, as accepted by resolve_path
+        :param sep: the separator of the titles
+        :param chunk_size: the maximum number of paths resolved by a query
+        :param connection: a database connection
+        :return: a list with the id of the node of each path, or None if no node matches
+        """
+
+        split_paths = [self._split_path(x, sep) for x in paths]
+        ids = [None] * len(split_paths)
+
+        statements = [
+            self._resolve_paths_stmt(chunk)
+            for chunk in chunked([(index, x) for index, x in enumerate(split_paths) if x], chunk_size)
+        ]
+        for rows in await self._fetch_all(statements, connection):
+            for row in rows:
+                ids[row.position] = row.descendant
+
+        return ids
+
+    async def get_subtree(self, node_id=None, max_depth=None, connection=None):
+        """
+        Loads a subtree in memory with a single query.
+        :param node_id: the id of the top node (None to load all the trees)
+        :param max_depth: the maximum depth relative to the top node (None for no limit)
+        :param connection: a database connection
+        :return: a SubtreeNode (None if the node does not exist) or a list of SubtreeNode roots if node_id is None
+        """
+
+        async with self._connect(connection) as connection:
+            rows = (await connection.execute(self._subtree_stmt(node_id, max_depth))).fetchall()
+
+        top_nodes = self._build_subtree(rows)
+
+        if node_id is None:
+            return top_nodes
+
+        return top_nodes[0] if top_nodes else None
@@ -0,0 +1,295 @@
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from types import MappingProxyType
+
+from sqlalchemy import MetaData
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool, SingletonThreadPool
+
+from sql_tree_implementations.generic_tree import NodeQueries, SQLITE_PRAGMAS, set_pragmas
+from sql_tree_implementations.utils import chunked
+
+# the connections of the active sessions of the current task, as a read-only mapping from each tree to its connection.
+# A session sets a new mapping and resets the previous one when it ends, so the tasks started inside a session still
+# see the mapping they were started with
+_sessions = ContextVar('tree_sessions', default=MappingProxyType({}))
+
+
+class AsyncGenericTree(NodeQueries):
+
+    def __init__(self, url='sqlite+aiosqlite:///:memory:', title_index=False, engine=None, pragmas=SQLITE_PRAGMAS,
+                 **engine_options):
+        """
+        Class instance initializer.
+        Must define a "nodes" table. The tables are created by the first operation, if they do not exist yet.
+        :param url: the database URL with an async driver (e.g. 'sqlite+aiosqlite:///tree.db')
+        :param title_index: if True, the node titles are indexed, which speeds up the lookups by title
+        :param engine: an existing async engine to use instead of creating one from the URL
+        :param pragmas: the pragmas set on the connections when the tree creates a SQLite engine (None for none)
+        :param engine_options: extra arguments for create_async_engine (e.g. pool_size=10)
+        """
+
+        if engine is None:
+            engine = create_async_engine(url, **engine_options)
+            set_pragmas(engine.sync_engine, pragmas)
+
+        self.engine = engine
+        self.metadata = MetaData()
+        self.title_index = title_index
+
+        self.nodes = None
+
+        self._schema_ready = False
+        self._schema_lock = None
+
+    async def create_schema(self, connection=None):
+        """
+        Creates the tables and indexes that do not exist yet. It is called by the first operation, so it only needs
+        to be called to create the schema ahead of time.
+        :param connection: a database connection
+        """
+
+        if self._schema_ready:
+            return
+
+        if self._schema_lock is None:
+            self._schema_lock = asyncio.Lock()
+
+        async with self._schema_lock:
+            if not self._schema_ready:
+                if connection is not None:
+                    await connection.run_sync(self._create_tables)
+                else:
+                    async with self.engine.begin() as connection:
+                        await connection.run_sync(self._create_tables)
+
+                self._schema_ready = True
+
+    @asynccontextmanager
+    async def session(self):
+        """
+        Runs all the operations inside the block on a single pooled connection and in a single transaction.
+        The transaction is committed when the block ends and rolled back if it raises. A session opened inside
+        another session of the same task joins the outer one.
+        :return: an async context manager yielding the database connection
+        """
+
+        connection = _sessions.get().get(self)
+        if connection is not None:
+            yield connection
+            return
+
+        await self.create_schema()
+
+        async with self.engine.connect() as connection:
+            token = _sessions.set(MappingProxyType({**_sessions.get(), self: connection}))
+
+            try:
+                async with connection.begin():
+                    yield connection
+            finally:
+                _sessions.reset(token)
+
+    @asynccontextmanager
+    async def _connect(self, connection=None):
+        """
+        Provides the connection used by an operation: the given connection, the one of the active session or a
+        new one with its own transaction, which is committed and released when the operation ends.
+        :param connection: a database connection
+        :return: an async context manager yielding the database connection
+        """
+
+        if connection is not None:
+            await self.create_schema(connection)
+            yield connection
+            return
+
+        async with self.session() as connection:
+            yield connection
+
+    def _concurrent(self, connection=None):
+        """
+        Tells if independent reads can be issued concurrently, each on its own pooled connection. This is not the
+        case inside a session, or when the pool holds a single connection (e.g. an in-memory SQLite database).
+        :param connection: a database connection
+        :return: True if the reads can be concurrent
+        """
+
+        if connection is not None or self in _sessions.get():
+            return False
+
+        return not isinstance(self.engine.sync_engine.pool, (StaticPool, SingletonThreadPool))
+
+    async def _fetch_all(self, statements, connection=None):
+        """
+        Runs independent select statements, concurrently when the driver and the pool allow it.
+        :param statements: a list of select statements
+        :param connection: a database connection
+        :return: a list with the rows of each statement, in the same order
+        """
+
+        async def fetch(stmt, fetch_connection=None):
+            async with self._connect(fetch_connection) as fetch_connection:
+                return (await fetch_connection.execute(stmt)).fetchall()
+
+        if len(statements) > 1 and self._concurrent(connection):
+            await self.create_schema()
+            return list(await asyncio.gather(*(fetch(x) for x in statements)))
+
+        async with self._connect(connection) as connection:
+            return [await fetch(x, connection) for x in statements]
+
+    async def dispose(self):
+        """
+        Closes all the pooled connections.
+        """
+
+        await self.engine.dispose()
+
+    async def node_count(self, connection=None):
+        """
+        Returns the number of nodes.
+        :param connection: a database connection
+        :return: the number of stored nodes.
+        """
+
+        async with self._connect(connection) as connection:
+            return (await connection.execute(self._node_count_stmt())).fetchone()[0]
+
+    async def get_node(self, node_id, connection=None):
+        """
+        Retrieves the node from the Nodes table.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a row object or None of the node does not exist
+        """
+
+        async with self._connect(connection) as connection:
+            return (await connection.execute(self._node_stmt(node_id))).fetchone()
+
+    async def node_exists(self, node_id, connection=None):
+        """
+        Checks if a node exists in the Nodes table.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: True if the node exists, False otherwise
+        """
+
+        return await self.get_node(node_id, connection) is not None
+
+    async def get_nodes(self, node_ids, chunk_size=500, connection=None):
+        """
+        Retrieves many nodes from the Nodes table, with one query for each chunk of ids, issued concurrently when
+        possible.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to a row object, or to None if the node does not exist
+        """
+
+        nodes = dict.fromkeys(node_ids)
+
+        statements = [self._nodes_stmt(chunk) for chunk in chunked(list(nodes), chunk_size)]
+        for rows in await self._fetch_all(statements, connection):
+            for row in rows:
+                nodes[row.id] = row
+
+        return nodes
+
+    async def nodes_exist(self, node_ids, chunk_size=500, connection=None):
+        """
+        Checks if many nodes exist in the Nodes table.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to True if the node exists, False otherwise
+        """
+
+        nodes = await self.get_nodes(node_ids, chunk_size, connection)
+
+        return {x: row is not None for x, row in nodes.items()}
+
+    async def get_first_id(self, node_title, connection=None):
+        """
+        Retrieves the id of the first node found with the given title.
+        :param node_title: the title of the node to be searched.
+        :param connection: a database connection
+        :return: the id of the node if found, or None otherwise
+        """
+
+        async with self._connect(connection) as connection:
+            node = (await connection.execute(self._first_id_stmt(node_title))).fetchone()
+
+            return node and node.id
+
+    async def _resolve_parent(self, parent, by_title=False, connection=None):
+        """
+        Finds the id of a parent node and checks that it exists.
+        :param parent: the parent given as an id, a row object or a title
+        :param by_title: if True, it will use the first id found for the parent title
+        :param connection: a database connection
+        :return: the id of the parent or None if no parent was given
+        """
+
+        async with self._connect(connection) as connection:
+            parent_id = self._parent_id(parent)
+
+            if by_title:
+                parent_id = await self.get_first_id(parent, connection)
+                if not parent_id:
+                    raise Exception('Parent node does not exist.')
+
+            # check parent exists
+            if parent_id is not None and not await self.node_exists(parent_id, connection):
+                raise Exception('Parent node does not exist.')
+
+            return parent_id
+
+    async def view_tree(self, node=None, prefix=' ', connection=None):
+        """
+        Print a tree in a more visual style.
+        :param node: the starting node of the tree, as an id or a row object (None to print all the trees)
+        :param prefix: string that will be appeneded to the node and all its children
+        :param connection: a database connection
+        """
+
+        if not node:
+            self._print_subtrees(await self.get_subtree(connection=connection), prefix, all_trees=True)
+            return
+
+        # cover cases where the node is sent as id or row object
+        node = await self.get_subtree(getattr(node, 'descendant', node), connection=connection)
+        self._print_subtrees([node] if node else [], prefix)
+
+    async def add_node(self, title='', parent=None, by_title=False):
+        """ Add a node. """
+        raise NotImplementedError
+
+    async def is_root(self, node_id, connnection=None):
+        """ Check if a node is root. """
+        raise NotImplementedError
+
+    async def delete_node(self, node_id, connection=None):
+        """ Delete a node. """
+        raise NotImplementedError
+
+    async def move_node(self, node_id, new_parent_id, connection=None):
+        """ Move a node and its subtree. """
+        raise NotImplementedError
+
+    async def get_roots(self, connection=None):
+        """ Get all nodes that are roots. """
+        raise NotImplementedError
+
+    async def get_descendants(self, node_id, connection=None):
+        """ Get the descendants of a node. """
+        raise NotImplementedError
+
+    async def get_path(self, node_id, connection=None):
+        """ Get a list of ancestors in order for a given node (the path of the node) """
+        raise NotImplementedError
+
+    async def get_subtree(self, node_id=None, max_depth=None, connection=None):
+        """ Load the subtree of a node (or all the trees) in memory. """
+        raise NotImplementedError
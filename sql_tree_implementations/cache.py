@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict
+
+# returned by LRUCache.get for missing keys, since None can be a cached value
+MISSING = object()
+
+
+class LRUCache:
+    """
+    A thread safe mapping of bounded size that evicts the least recently used entries.
+    """
+
+    def __init__(self, max_size):
+        """
+        Instance initialization.
+        :param max_size: the maximum number of entries
+        """
+
+        if max_size < 1:
+            raise Exception('The cache size must be a positive number.')
+
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """
+        Retrieves an entry and marks it as the most recently used.
+        :param key: the key of the entry
+        :return: the cached value or MISSING
+        """
+
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+
+            self._data.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value):
+        """
+        Stores an entry, evicting the least recently used one if the cache is full.
+        :param key: the key of the entry
+        :param value: the value to be cached
+        """
+
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        """
+        Removes entries from the cache.
+        :param keys: the keys of the entries, missing keys are ignored
+        """
+
+        with self._lock:
+            for key in keys:
+                if self._data.pop(key, MISSING) is not MISSING:
+                    self.invalidations += 1
+
+    def clear(self):
+        """
+        Removes all the entries.
+        """
+
+        with self._lock:
+            self.invalidations += len(self._data)
+            self._data.clear()
+
+    def info(self):
+        """
+        Returns the usage counters.
+        :return: a dict with the hits, misses, evictions, invalidations, size and max_size
+        """
+
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._data),
+                'max_size': self.max_size
+            }
@@ -1,352 +1,2582 @@
-from sqlalchemy import (Table, Column, Integer, Text, PrimaryKeyConstraint, ForeignKey,
-                        select, union_all, bindparam, desc, func)
+import copy
+import threading
+from collections import namedtuple
 
+from sqlalchemy import (Table, Column, Integer, Text, PrimaryKeyConstraint, ForeignKey, Index,
+                        select, union_all, bindparam, literal, true, exists, desc, func, case, and_, or_)
+from sqlalchemy.pool import SingletonThreadPool
+
+from sql_tree_implementations.cache import LRUCache, MISSING
+from sql_tree_implementations.fractional_index import key_between
 from sql_tree_implementations.generic_tree import GenericTree
+from sql_tree_implementations.parallel import parallel_closure_rows
+from sql_tree_implementations.snapshot import read_snapshot, write_snapshot
+from sql_tree_implementations.utils import chunked, topological_order
+
+# the aggregates of a subtree, relative to its top node
+SubtreeStats = namedtuple('SubtreeStats', ['descendants', 'height', 'leaves'])
+
+# an entry of the change log. The operation is 'add', 'move', 'attach' or 'detach' with the node and its new parent,
+# 'delete' with the top node of the deleted subtree, or 'reset' when the whole tree was rewritten
+Change = namedtuple('Change', ['version', 'operation', 'node_id', 'parent_id'])
+
+
+def closure_rows(order, parents, ids=None, base_paths=()):
+    """
+    Generates the closure table rows for a batch of new nodes.
+    :param order: the keys of the new nodes, parents before children
+    :param parents: a dict mapping each key to the key of its parent (None for top level keys)
+    :param ids: a dict mapping each key to its node id (None if the keys are the node ids)
+    :param base_paths: (ancestor, depth) pairs of the existing node under which the batch is added
+    :return: a generator of path rows
+    """
+
+    for key in order:
+        node_id = key if ids is None else ids[key]
+        depth = 0
+        current = key
+
+        # walk up to the top of the batch
+        while current is not None:
+            yield {'ancestor': current if ids is None else ids[current], 'descendant': node_id, 'depth': depth}
+            current = parents[current]
+            depth += 1
+
+        # continue with the ancestors outside of the batch
+        for ancestor, ancestor_depth in base_paths:
+            yield {'ancestor': ancestor, 'descendant': node_id, 'depth': ancestor_depth + depth}
+
+
+def positioned_rows(rows, positions):
+    """
+    Adds the position keys to closure table rows, the position of a node is stored on the path from its parent.
+    :param rows: an iterable of path rows
+    :param positions: a dict mapping each node id to its position key
+    :return: a generator of path rows
+    """
+
+    for row in rows:
+        row['position'] = positions.get(row['descendant']) if row['depth'] == 1 else None
+        yield row
+
+
+class ClosureQueries:
+    """
+    Defines the tables of a closure tree and builds its statements, shared by the synchronous and the asynchronous
+    trees.
+    """
+
+    metadata = None
+    nodes = None
+    paths = None
+    changes = None
+    track_counts = False
+    ordered = False
+    log_changes = False
+
+    # the tree of a forest the statements are restricted to
+    tree_id = None
+
+    def _define_tables(self):
+        """
+        Adds the Nodes and Paths tables to the metadata. In forest mode, the tree id leads the keys and the indexes
+        of the paths, so the rows of a tree are stored together.
+        """
+
+        # the node ids stay unique across the trees, so they can keep being allocated by the database
+        columns = [
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('title', Text, nullable=True)
+        ]
+
+        if self.track_counts:
+            columns.append(Column('descendant_count', Integer, nullable=False, default=0, server_default='0'))
+
+        prefix, suffix = [], []
+        if self.forest:
+            # the parent joins read the ancestor from this index, otherwise sqlite prefers a tree_id-only seek
+            prefix, suffix = ['tree_id'], ['ancestor']
+            columns.append(Column('tree_id', Integer, nullable=False))
+            columns.append(Index('nodes_tree_idx', 'tree_id', 'id'))
+
+        self.nodes = Table('nodes', self.metadata, *columns)
+
+        paths_items = [
+            Column('ancestor', Integer, ForeignKey('nodes.id'), nullable=False),
+            Column('descendant', Integer, ForeignKey('nodes.id'), nullable=False),
+            Column('depth', Integer, nullable=False),
+            PrimaryKeyConstraint(*prefix + ['ancestor', 'descendant'], name='ad_pk'),
+            Index('paths_add_idx', *prefix + ['ancestor', 'depth', 'descendant']),
+            Index('paths_dd_idx', *prefix + ['descendant', 'depth'] + suffix)
+        ]
+
+        if self.forest:
+            paths_items.insert(0, Column('tree_id', Integer, nullable=False))
+
+        if self.ordered:
+            # the position of a node among its siblings, set on the path from its parent (depth 1)
+            paths_items.append(Column('position', Text, nullable=True))
+            paths_items.append(
+                Index('paths_position_idx', *prefix + ['ancestor', 'depth', 'position', 'descendant'])
+            )
+
+        self.paths = Table('paths', self.metadata, *paths_items)
+
+        if self.log_changes:
+            changes_items = [
+                Column('version', Integer, primary_key=True, autoincrement=True),
+                Column('operation', Text, nullable=False),
+                Column('node_id', Integer, nullable=True),
+                Column('parent_id', Integer, nullable=True)
+            ]
+
+            if self.forest:
+                changes_items.append(Column('tree_id', Integer, nullable=False))
+                changes_items.append(Index('changes_tree_idx', 'tree_id', 'version'))
+
+            # the versions are never reused, even once the log is pruned
+            self.changes = Table('changes', self.metadata, *changes_items, sqlite_autoincrement=True)
+
+        self._add_title_index()
+
+    def _use_tables(self):
+        """
+        Defines the tables, or reuses the ones of another closure tree with the same schema options.
+        """
+
+        key = (ClosureQueries, self.title_index, self.track_counts, self.ordered, self.forest, self.log_changes)
+        self._share_tables(key, self._define_tables)
+
+    def _scope(self, stmt, *tables):
+        """
+        Restricts a statement to the current tree of a forest, a no-op for the other trees.
+        :param stmt: a statement
+        :param tables: the tables or aliases to restrict
+        :return: the statement
+        """
+
+        if not self.forest:
+            return stmt
+
+        if self.tree_id is None:
+            raise Exception('The operations on a forest need a tree, use scoped(tree_id).')
+
+        for table in tables:
+            stmt = stmt.where(table.c.tree_id == self.tree_id)
+
+        return stmt
+
+    def _same_tree(self, table, other_table):
+        """
+        Builds the join condition keeping the rows of two tables in the same tree of a forest.
+        :param table: a table or alias
+        :param other_table: another table or alias
+        :return: a list with the condition in forest mode, empty otherwise
+        """
+
+        return [table.c.tree_id == other_table.c.tree_id] if self.forest else []
+
+    def _tree_values(self):
+        """
+        Returns the values identifying the current tree, added to the inserted rows.
+        :return: a dict with the tree_id in forest mode, empty otherwise
+        """
+
+        if not self.forest:
+            return {}
+
+        if self.tree_id is None:
+            raise Exception('The operations on a forest need a tree, use scoped(tree_id).')
+
+        return {'tree_id': self.tree_id}
+
+    def _tree_rows(self, rows):
+        """
+        Adds the values identifying the current tree to rows written in bulk.
+        :param rows: an iterable of row dicts
+        :return: an iterable of row dicts
+        """
+
+        values = self._tree_values()
+        if not values:
+            return rows
+
+        return (dict(row, **values) for row in rows)
+
+    @staticmethod
+    def _parse_edges(edges):
+        """
+        Checks the edges of a batch of new nodes and sorts them.
+        :param edges: an iterable of (key, parent_key, title) tuples
+        :return: the parents dict, the titles dict and the keys with the parents before the children
+        """
+
+        parents = {}
+        titles = {}
+        for key, parent_key, title in edges:
+            if key in parents:
+                raise Exception('Duplicate node key: {}.'.format(key))
+
+            parents[key] = parent_key
+            titles[key] = title
+
+        return parents, titles, topological_order(parents)
+
+    @staticmethod
+    def _descendant_counts(order, parents):
+        """
+        Counts the descendants of every node of a batch.
+        :param order: the keys of the nodes, parents before children
+        :param parents: a dict mapping each key to the key of its parent (None for top level keys)
+        :return: a dict mapping each key to the number of its descendants
+        """
+
+        counts = dict.fromkeys(order, 0)
+
+        for key in reversed(order):
+            parent_key = parents[key]
+            if parent_key is not None:
+                counts[parent_key] += counts[key] + 1
+
+        return counts
+
+    @staticmethod
+    def _batch_positions(order, parents, last_position=None):
+        """
+        Generates the position keys of a batch of new nodes, where siblings keep the order of the batch.
+        :param order: the keys of the nodes, parents before children
+        :param parents: a dict mapping each key to the key of its parent (None for top level keys)
+        :param last_position: the position of the last existing sibling of the top level nodes
+        :return: a dict mapping each key to its position key
+        """
+
+        last_positions = {None: last_position}
+        positions = {}
+
+        for key in order:
+            parent_key = parents[key]
+            positions[key] = last_positions[parent_key] = key_between(last_positions.get(parent_key), None)
+
+        return positions
+
+    @staticmethod
+    def _structure_edges(structure):
+        """
+        Flattens a nested structure of nodes into edges.
+        :param structure: a list of nodes, where each node is either a title or a (title, children) tuple
+        :return: a list of (key, parent_key, title) tuples in depth-first order, where the keys are the positions
+        """
+
+        edges = []
+        stack = [(None, item) for item in reversed(structure)]
+
+        while stack:
+            parent_key, item = stack.pop()
+            title, children = item if isinstance(item, tuple) else (item, ())
+
+            key = len(edges)
+            edges.append((key, parent_key, title))
+            stack.extend((key, child) for child in reversed(children))
+
+        return edges
+
+    def _change_rows(self, changes):
+        """
+        Builds the rows of the change log.
+        :param changes: an iterable of (operation, node_id, parent_id) tuples
+        :return: a list of row dicts, empty if the changes are not logged
+        """
+
+        if not self.log_changes:
+            return []
+
+        values = self._tree_values()
+        return [dict(values, operation=x, node_id=node_id, parent_id=parent_id) for x, node_id, parent_id in changes]
+
+    def _check_changes(self):
+        """
+        Checks that the change log exists.
+        """
+
+        if not self.log_changes:
+            raise Exception('The changes are not logged, use log_changes=True.')
+
+    def _changes_stmt(self, version, limit=None):
+        """ Select the changes after a version, in order. """
+        self._check_changes()
+
+        stmt = select([self.changes]).where(self.changes.c.version > version).order_by(self.changes.c.version)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+
+        return self._scope(stmt, self.changes)
+
+    def _change_version_stmt(self):
+        """ Select the version of the last change. """
+        self._check_changes()
+        return self._scope(select([func.coalesce(func.max(self.changes.c.version), 0)]), self.changes)
+
+    def _prune_changes_stmt(self, version):
+        """ Delete the changes up to a version. """
+        self._check_changes()
+        return self._scope(self.changes.delete().where(self.changes.c.version <= version), self.changes)
+
+    def _edges_stmt(self):
+        """ Select the id, parent_id and title of every node. """
+        parent_paths = self.paths.alias()
+
+        stmt = select(
+            [self.nodes.c.id, parent_paths.c.ancestor.label('parent_id'), self.nodes.c.title]
+        ).select_from(
+            self.nodes.outerjoin(
+                parent_paths, and_(
+                    parent_paths.c.descendant == self.nodes.c.id, parent_paths.c.depth == 1,
+                    *self._same_tree(parent_paths, self.nodes)
+                )
+            )
+        ).order_by(
+            *self._sibling_order(parent_paths, self.nodes.c.id)
+        )
+
+        return self._scope(stmt, self.nodes)
+
+    def _sibling_order(self, parent_paths, id_column):
+        """
+        Builds the ORDER BY clauses listing siblings in their order: by position when the siblings are ordered,
+        then by id.
+        :param parent_paths: the paths alias joined on the path from the parent of each node (depth 1)
+        :param id_column: the column with the node ids
+        :return: a list of clauses
+        """
+
+        if self.ordered:
+            return [parent_paths.c.position, id_column]
+
+        return [id_column]
+
+    def _path_count_stmt(self):
+        """ Select the number of paths. """
+        return self._scope(select([func.count()]).select_from(self.paths), self.paths)
+
+    def _add_paths_stmt(self, node_id, parent_id, position=None):
+        """
+        Builds the statement adding the paths of a new node.
+        :param node_id: the id of the new node
+        :param parent_id: the id of its parent (None for a root)
+        :param position: the position key of the node among its siblings, when the siblings are ordered
+        :return: an insert statement
+        """
+
+        names = ['ancestor', 'descendant', 'depth']
+        parent_columns = [self.paths.c.ancestor, bindparam('d1', node_id), self.paths.c.depth + 1]
+        self_columns = [bindparam('a2', node_id), bindparam('d2', node_id), bindparam('l2', 0)]
+
+        if self.ordered:
+            # only the path from the parent holds the position
+            names.append('position')
+            parent_columns.append(case([(self.paths.c.depth == 0, bindparam('p1', position, Text))]))
+            self_columns.append(bindparam('p2', None, Text))
+
+        if self.forest:
+            names.append('tree_id')
+            parent_columns.append(self.paths.c.tree_id)
+            self_columns.append(bindparam('t2', self._tree_values()['tree_id']))
+
+        sel_stmt = []
+
+        if parent_id is not None:
+            # add new paths for all the ancestors of the parent node
+            sel_stmt.append(
+                self._scope(select(parent_columns).where(
+                    self.paths.c.descendant == parent_id
+                ), self.paths)
+            )
+
+        # add path to self
+        sel_stmt.append(select(self_columns))
+
+        return self.paths.insert().from_select(names, union_all(*sel_stmt))
+
+    def _detach_stmt(self, node_id):
+        """
+        Builds the statement deleting the paths between a subtree and the ancestors of its top node.
+        :param node_id: the id of the top node of the subtree
+        :return: a delete statement
+        """
+
+        stmt = self.paths.delete().where(
+            self.paths.c.descendant.in_(
+                self._scope(select([self.paths.c.descendant]).where(
+                    self.paths.c.ancestor == node_id
+                ), self.paths))
+        ).where(
+            self.paths.c.ancestor.in_(
+                self._scope(select([self.paths.c.ancestor]).where(
+                    self.paths.c.descendant == node_id
+                ).where(
+                    self.paths.c.ancestor != self.paths.c.descendant
+                ), self.paths))
+        )
+
+        return self._scope(stmt, self.paths)
+
+    def _attach_stmt(self, node_id, new_parent_id, position=None):
+        """
+        Builds the statement adding the paths between a tree and the ancestors of a new parent.
+        :param node_id: the id of the root node
+        :param new_parent_id: the id of the new parent
+        :param position: the position key of the node among its new siblings, when the siblings are ordered
+        :return: an insert statement
+        """
+
+        paths_super_tree = self.paths.alias()
+        paths_sub_tree = self.paths.alias()
+
+        names = ['ancestor', 'descendant', 'depth']
+        columns = [
+            paths_super_tree.c.ancestor,
+            paths_sub_tree.c.descendant,
+            (paths_super_tree.c.depth + paths_sub_tree.c.depth + 1)
+        ]
+
+        if self.ordered:
+            # only the path from the new parent to the node holds the position
+            names.append('position')
+            columns.append(case([
+                (and_(paths_super_tree.c.depth == 0, paths_sub_tree.c.depth == 0), bindparam('p1', position, Text))
+            ]))
+
+        if self.forest:
+            names.append('tree_id')
+            columns.append(paths_super_tree.c.tree_id)
+
+        return self.paths.insert().from_select(
+            names=names,
+            select=self._scope(select(columns).select_from(
+                paths_super_tree.join(paths_sub_tree, true())
+            ).where(
+                paths_super_tree.c.descendant == new_parent_id
+            ).where(
+                paths_sub_tree.c.ancestor == node_id
+            ), paths_super_tree, paths_sub_tree)
+        )
+
+    def _position_stmt(self, node_id):
+        """ Select the parent and the position of a node, which only exist if the node is not a root. """
+        return self._scope(select(
+            [self.paths.c.ancestor, self.paths.c.position]
+        ).where(
+            self.paths.c.descendant == node_id
+        ).where(
+            self.paths.c.depth == 1
+        ), self.paths)
+
+    def _sibling_position_stmt(self, parent_id, position=None, before=False):
+        """
+        Builds the statement finding the position of a neighbour among the children of a node, with a single seek on
+        the position index.
+        :param parent_id: the id of the parent
+        :param position: the position next to which the neighbour is searched (None for the last child)
+        :param before: True to find the neighbour before the position, False for the one after it
+        :return: a select statement with the position of the neighbour, NULL if there is none
+        """
+
+        column = self.paths.c.position
+
+        stmt = select(
+            [func.max(column) if position is None or before else func.min(column)]
+        ).where(
+            self.paths.c.ancestor == parent_id
+        ).where(
+            self.paths.c.depth == 1
+        )
+
+        if position is not None:
+            stmt = stmt.where(column < position if before else column > position)
+
+        return self._scope(stmt, self.paths)
+
+    def _reposition_stmt(self):
+        """ Update the position of a node, given by the parent_id, node_id and new_position parameters. """
+        return self._scope(self.paths.update().where(
+            self.paths.c.ancestor == bindparam('parent_id')
+        ).where(
+            self.paths.c.descendant == bindparam('node_id')
+        ).values(
+            position=bindparam('new_position')
+        ), self.paths)
+
+    def _cycle_stmt(self, node_id, new_parent_id):
+        """ Select the path from a node to a new parent, which exists if the parent is in the subtree of the node. """
+        return self._scope(select(
+            [self.paths.c.depth]
+        ).where(
+            self.paths.c.ancestor == node_id
+        ).where(
+            self.paths.c.descendant == new_parent_id
+        ), self.paths)
+
+    def _not_root_stmt(self, node_id):
+        """ Select the paths from the ancestors of a node, which only exist if the node is not a root. """
+        return self._scope(select(
+            [self.paths]
+        ).where(
+            self.paths.c.depth > 0
+        ).where(
+            self.paths.c.descendant == node_id
+        ), self.paths)
+
+    def _not_roots_stmt(self, node_ids):
+        """ Select the ids of the nodes that have a parent, among the given ones. """
+        return self._scope(select(
+            [self.paths.c.descendant]
+        ).where(
+            self.paths.c.descendant.in_(node_ids)
+        ).where(
+            self.paths.c.depth == 1
+        ), self.paths)
+
+    def _ancestors_stmt(self, node_ids):
+        """ Select the distinct ancestors of many nodes, without the nodes themselves. """
+        return self._scope(select(
+            [self.paths.c.ancestor]
+        ).where(
+            self.paths.c.descendant.in_(node_ids)
+        ).where(
+            self.paths.c.depth > 0
+        ).distinct(), self.paths)
+
+    def _is_ancestor_stmt(self, ancestor_id, descendant_id, include_self=False):
+        """ Select the path between two nodes, a single lookup on the primary key. """
+        stmt = select(
+            [self.paths.c.depth]
+        ).where(
+            self.paths.c.ancestor == ancestor_id
+        ).where(
+            self.paths.c.descendant == descendant_id
+        )
+
+        if not include_self:
+            stmt = stmt.where(self.paths.c.depth > 0)
+
+        return self._scope(stmt, self.paths)
+
+    def _ancestor_pairs_stmt(self, pairs, include_self=False):
+        """
+        Builds the statement finding which (ancestor, descendant) pairs have a path, with a primary key lookup for
+        each pair.
+        :param pairs: a non empty list of (ancestor_id, descendant_id) pairs
+        :param include_self: if True, the path of a node to itself is included
+        :return: a select statement with the ancestor and descendant columns of the pairs that have a path
+        """
+
+        stmt = select(
+            [self.paths.c.ancestor, self.paths.c.descendant]
+        ).where(
+            or_(*[and_(self.paths.c.ancestor == a, self.paths.c.descendant == d) for a, d in pairs])
+        )
+
+        if not include_self:
+            stmt = stmt.where(self.paths.c.depth > 0)
+
+        return self._scope(stmt, self.paths)
+
+    def _lca_stmt(self, node_ids):
+        """
+        Builds the statement finding the lowest common ancestor of some nodes: the ancestors shared by all of them
+        (a node counts as its own ancestor), the nearest one first.
+        :param node_ids: a non empty list of distinct node ids
+        :return: a select statement with the ancestor column, returning at most one row
+        """
+
+        return self._scope(select(
+            [self.paths.c.ancestor]
+        ).where(
+            self.paths.c.descendant.in_(node_ids)
+        ), self.paths).group_by(
+            self.paths.c.ancestor
+        ).having(
+            func.count() == len(node_ids)
+        ).order_by(
+            func.min(self.paths.c.depth)
+        ).limit(1)
+
+    def _shift_counts_stmt(self, node_id, sign):
+        """
+        Builds the statement adding the size of a subtree to the descendant counts of the ancestors of its top node.
+        :param node_id: the id of the top node of the subtree
+        :param sign: 1 to add the size, -1 to subtract it
+        :return: an update statement
+        """
+
+        size = self._scope(select([func.count()]).where(self.paths.c.ancestor == node_id), self.paths)
+
+        return self._scope(self.nodes.update().where(
+            self.nodes.c.id.in_(self._ancestors_stmt([node_id]))
+        ).values(
+            descendant_count=self.nodes.c.descendant_count + sign * size.scalar_subquery()
+        ), self.nodes)
+
+    def _recount_stmt(self, node_ids=None):
+        """
+        Builds the statement computing the descendant counts of some nodes again from the paths.
+        :param node_ids: the ids of the nodes (None for all the nodes)
+        :return: an update statement
+        """
+
+        stmt = self.nodes.update().values(
+            descendant_count=self._scope(select(
+                [func.count() - 1]
+            ).where(
+                self.paths.c.ancestor == self.nodes.c.id
+            ), self.paths).scalar_subquery()
+        )
+
+        if node_ids is not None:
+            stmt = stmt.where(self.nodes.c.id.in_(node_ids))
+
+        return self._scope(stmt, self.nodes)
+
+    def _uncount_stmt(self, node_ids):
+        """
+        Builds the statement removing some nodes from the descendant counts of their ancestors.
+        :param node_ids: the ids of the nodes, whose own descendants are among them or already deleted
+        :return: an update statement
+        """
+
+        removed = self._scope(select([func.count()]).where(
+            self.paths.c.ancestor == self.nodes.c.id
+        ).where(
+            self.paths.c.descendant.in_(node_ids)
+        ).where(
+            self.paths.c.depth > 0
+        ), self.paths)
+
+        return self._scope(self.nodes.update().where(
+            self.nodes.c.id.in_(self._ancestors_stmt(node_ids))
+        ).values(
+            descendant_count=self.nodes.c.descendant_count - removed.scalar_subquery()
+        ), self.nodes)
+
+    def _subtree_stats_stmt(self, node_ids):
+        """
+        Builds the statement computing the aggregates of many subtrees with a single GROUP BY.
+        :param node_ids: the ids of the top nodes
+        :return: a select statement with the ancestor, descendants, height and leaves columns
+        """
+
+        child_paths = self.paths.alias()
+        is_leaf = ~exists(
+            self._scope(select([child_paths.c.descendant]).where(
+                child_paths.c.ancestor == self.paths.c.descendant
+            ).where(
+                child_paths.c.depth == 1
+            ), child_paths)
+        )
+
+        return self._scope(select([
+            self.paths.c.ancestor,
+            (func.count() - 1).label('descendants'),
+            func.max(self.paths.c.depth).label('height'),
+            func.sum(case([(is_leaf, 1)], else_=0)).label('leaves')
+        ]).where(
+            self.paths.c.ancestor.in_(node_ids)
+        ), self.paths).group_by(
+            self.paths.c.ancestor
+        )
+
+    def _subtree_ids_stmt(self, node_id):
+        """ Select the ids of the nodes of a subtree, including its top node. """
+        return self._scope(select([self.paths.c.descendant]).where(self.paths.c.ancestor == node_id), self.paths)
+
+    def _delete_stmts(self, node_id, subtree_ids, chunk_size=500):
+        """
+        Builds the statements deleting a subtree: first the paths of all its nodes, then the nodes themselves.
+        :param node_id: the id of the top node
+        :param subtree_ids: the ids of the nodes of the subtree, read before the paths are deleted
+        :param chunk_size: the maximum number of nodes deleted by a statement
+        :return: a list of delete statements
+        """
+
+        stmts = [
+            # delete the paths associated with this node
+            self._scope(self.paths.delete().where(
+                self.paths.c.descendant.in_(self._subtree_ids_stmt(node_id))
+            ), self.paths)
+        ]
+
+        # delete the nodes, the top node is included even if it has no paths
+        for chunk in chunked(list(dict.fromkeys([node_id] + list(subtree_ids))), chunk_size):
+            stmts.append(self._scope(self.nodes.delete().where(self.nodes.c.id.in_(chunk)), self.nodes))
+
+        return stmts
+
+    def _subtree_depths_stmt(self, node_id):
+        """ Select the ids of the nodes of a subtree, with their depth below its top node. """
+        return self._scope(
+            select([self.paths.c.descendant, self.paths.c.depth]).where(self.paths.c.ancestor == node_id), self.paths
+        )
+
+    def _delete_batch_stmts(self, node_ids):
+        """ Builds the statements deleting nodes whose descendants are already deleted, with the paths to them. """
+        return ([self._uncount_stmt(node_ids)] if self.track_counts else []) + [
+            self._scope(self.paths.delete().where(self.paths.c.descendant.in_(node_ids)), self.paths),
+            self._scope(self.nodes.delete().where(self.nodes.c.id.in_(node_ids)), self.nodes)
+        ]
+
+    def _verify_stmts(self):
+        """
+        Builds the statements counting each kind of inconsistency of the tables, each one a single set-based query.
+        :return: a dict mapping each kind to a select statement returning a count
+        """
+
+        paths = self.paths
+        other_paths = self.paths.alias()
+        edges = self.paths.alias()
+
+        def count_nodes(condition):
+            return self._scope(select([func.count()]).select_from(self.nodes).where(condition), self.nodes)
+
+        def count_paths(condition):
+            return self._scope(select([func.count()]).select_from(paths).where(condition), paths)
+
+        def node_missing(column):
+            return ~exists(self._scope(select([self.nodes.c.id]).where(self.nodes.c.id == column), self.nodes))
+
+        multiple_parents = self._scope(select(
+            [paths.c.descendant]
+        ).where(
+            paths.c.depth == 1
+        ), paths).group_by(
+            paths.c.descendant
+        ).having(
+            func.count() > 1
+        ).alias('multiple_parents')
+
+        return {
+            # nodes without any path, such as the descendants left by an interrupted delete
+            'orphans': count_nodes(~exists(
+                self._scope(select([paths.c.ancestor]).where(paths.c.descendant == self.nodes.c.id), paths)
+            )),
+            'missing_self_paths': count_nodes(~exists(
+                self._scope(select([paths.c.ancestor]).where(
+                    paths.c.ancestor == self.nodes.c.id
+                ).where(
+                    paths.c.descendant == self.nodes.c.id
+                ).where(
+                    paths.c.depth == 0
+                ), paths)
+            )),
+            'dangling_paths': count_paths(or_(node_missing(paths.c.ancestor), node_missing(paths.c.descendant))),
+            'bad_depths': count_paths(or_(
+                and_(paths.c.ancestor == paths.c.descendant, paths.c.depth != 0),
+                and_(paths.c.ancestor != paths.c.descendant, paths.c.depth <= 0)
+            )),
+            'multiple_parents': select([func.count()]).select_from(multiple_parents),
+            # the ancestors of the parent of a node, one level further, must be ancestors of the node
+            'missing_paths': self._scope(select([func.count()]).select_from(
+                edges.join(other_paths, other_paths.c.descendant == edges.c.ancestor)
+            ).where(
+                edges.c.depth == 1
+            ).where(
+                ~exists(
+                    self._scope(select([paths.c.depth]).where(
+                        paths.c.ancestor == other_paths.c.ancestor
+                    ).where(
+                        paths.c.descendant == edges.c.descendant
+                    ).where(
+                        paths.c.depth == other_paths.c.depth + 1
+                    ), paths)
+                )
+            ), edges, other_paths),
+            # and every longer path must come from a path of the parent, which is looked up first so the check is
+            # a primary key seek instead of a scan of the descendants of the ancestor
+            'extra_paths': count_paths(and_(
+                paths.c.depth > 1,
+                ~exists(
+                    self._scope(select([other_paths.c.depth]).where(
+                        other_paths.c.ancestor == paths.c.ancestor
+                    ).where(
+                        other_paths.c.depth == paths.c.depth - 1
+                    ).where(
+                        other_paths.c.descendant.in_(
+                            self._scope(select([edges.c.ancestor]).where(
+                                edges.c.descendant == paths.c.descendant
+                            ).where(
+                                edges.c.depth == 1
+                            ).correlate(paths), edges)
+                        )
+                    ), other_paths)
+                )
+            )),
+            'cycles': count_paths(and_(
+                paths.c.depth > 0,
+                exists(
+                    self._scope(select([other_paths.c.depth]).where(
+                        other_paths.c.ancestor == paths.c.descendant
+                    ).where(
+                        other_paths.c.descendant == paths.c.ancestor
+                    ).where(
+                        other_paths.c.depth > 0
+                    ), other_paths)
+                )
+            ))
+        }
+
+    def _parent_edges_stmt(self):
+        """ Select the paths from the parents (depth 1), with the position when the siblings are ordered. """
+        columns = [self.paths.c.ancestor, self.paths.c.descendant]
+        if self.ordered:
+            columns.append(self.paths.c.position)
+
+        return self._scope(select(columns).where(self.paths.c.depth == 1), self.paths)
+
+    def _roots_stmt(self):
+        """ Select the root nodes. """
+        return self._scope(select(
+            [self.nodes.c.title, self.nodes.c.id.label('descendant')]
+        ).where(
+            self.nodes.c.id.notin_(
+                self._scope(select([self.paths.c.descendant]).where(self.paths.c.depth > 0), self.paths)
+            )
+        ), self.nodes)
+
+    def _descendants_stmt(self, node_id):
+        """ Select the children of a node, in their order when the siblings are ordered. """
+        stmt = select(
+            [self.paths, self.nodes.c.title]
+        ).select_from(
+            self.paths.join(self.nodes, self.nodes.c.id == self.paths.c.descendant)
+        ).where(
+            self.paths.c.ancestor == node_id
+        ).where(
+            self.paths.c.depth == '1'
+        )
+
+        if self.ordered:
+            stmt = stmt.order_by(self.paths.c.position, self.paths.c.descendant)
+
+        return self._scope(stmt, self.paths)
+
+    def _descendants_batch_stmt(self, node_id, min_depth, max_depth, batch_size, cursor):
+        """
+        Builds the statement fetching a batch of descendants ordered by depth and id.
+        :param node_id: the id of the node
+        :param min_depth: the minimum depth relative to the node
+        :param max_depth: the maximum depth relative to the node (None for no limit)
+        :param batch_size: the number of rows fetched
+        :param cursor: the (depth, descendant) pair of the last row already fetched (None for the first batch)
+        :return: a select statement
+        """
+
+        stmt = select(
+            [self.paths, self.nodes.c.title]
+        ).select_from(
+            self.paths.join(self.nodes, self.nodes.c.id == self.paths.c.descendant)
+        ).where(
+            self.paths.c.ancestor == node_id
+        ).where(
+            self.paths.c.depth >= min_depth
+        ).order_by(
+            self.paths.c.depth, self.paths.c.descendant
+        ).limit(
+            batch_size
+        )
+
+        if max_depth is not None:
+            stmt = stmt.where(self.paths.c.depth <= max_depth)
+
+        if cursor is not None:
+            last_depth, last_descendant = cursor
+            stmt = stmt.where(
+                or_(
+                    self.paths.c.depth > last_depth,
+                    and_(self.paths.c.depth == last_depth, self.paths.c.descendant > last_descendant)
+                )
+            )
+
+        return self._scope(stmt, self.paths)
+
+    def _path_stmt(self, node_id):
+        """ Select the ancestors of a node in descending order of depth. """
+        return self._scope(select(
+            [self.paths, self.nodes.c.title]
+        ).select_from(
+            self.paths.join(self.nodes, self.nodes.c.id == self.paths.c.ancestor)
+        ).where(
+            self.paths.c.descendant == node_id
+        ).order_by(
+            desc(self.paths.c.depth)
+        ), self.paths)
+
+    def _paths_stmt(self, node_ids):
+        """ Select the ancestors of many nodes, grouped by node in descending order of depth. """
+        return self._scope(select(
+            [self.paths, self.nodes.c.title]
+        ).select_from(
+            self.paths.join(self.nodes, self.nodes.c.id == self.paths.c.ancestor)
+        ).where(
+            self.paths.c.descendant.in_(node_ids)
+        ).order_by(
+            self.paths.c.descendant, desc(self.paths.c.depth)
+        ), self.paths)
+
+    @staticmethod
+    def _split_path(path, sep):
+        """
+        Splits a title path.
+        :param path: a string with the titles from the root to the node joined by sep, or a sequence of titles
+        :param sep: the separator of the titles
+        :return: a list of titles
+        """
+
+        if isinstance(path, str):
+            return path.strip(sep).split(sep) if path.strip(sep) else []
+
+        return list(path)
+
+    def _resolve_path_stmt(self, titles):
+        """
+        Builds the statement finding the nodes reached by a path of titles that starts from a root.
+        The ancestors of each candidate (a node with the last title) are matched against the titles by depth, so the
+        query does not depend on the length of the path.
+        :param titles: a non empty list of titles, from the root to the node
+        :return: a select statement with the descendant column, the id of every matching node
+        """
+
+        depth = len(titles) - 1
+        target = self.nodes.alias()
+        ancestor = self.nodes.alias()
+        parent_paths = self.paths.alias()
+
+        return self._scope(select(
+            [self.paths.c.descendant]
+        ).select_from(
+            self.paths.join(
+                target, target.c.id == self.paths.c.descendant
+            ).join(
+                ancestor, ancestor.c.id == self.paths.c.ancestor
+            )
+        ).where(
+            target.c.title == titles[-1]
+        ).where(
+            or_(*[
+                and_(self.paths.c.depth == depth - index, ancestor.c.title == title)
+                for index, title in enumerate(titles)
+            ])
+        ).where(
+            # the first title must be a root
+            ~exists(
+                self._scope(select([parent_paths.c.ancestor]).where(
+                    parent_paths.c.descendant == self.paths.c.descendant
+                ).where(
+                    parent_paths.c.depth == depth + 1
+                ), parent_paths)
+            )
+        ), self.paths, target).group_by(
+            self.paths.c.descendant
+        ).having(
+            func.count() == len(titles)
+        )
+
+    def _resolve_paths_stmt(self, paths):
+        """
+        Builds the statement resolving many paths of titles at once.
+        :param paths: a list of (index, titles) pairs, where titles is a non empty list
+        :return: a select statement with the position and the smallest matching node id of every resolved path
+        """
+
+        rows = [
+            select([literal(index).label('position'), stmt.c.descendant]).select_from(stmt)
+            for index, stmt in ((index, self._resolve_path_stmt(titles).alias()) for index, titles in paths)
+        ]
+        matches = (union_all(*rows) if len(rows) > 1 else rows[0]).alias('matches')
+
+        return select(
+            [matches.c.position, func.min(matches.c.descendant).label('descendant')]
+        ).group_by(
+            matches.c.position
+        )
+
+    def _subtree_stmt(self, node_id=None, max_depth=None):
+        """
+        Builds the statement loading a subtree.
+        :param node_id: the id of the top node (None to load all the trees)
+        :param max_depth: the maximum depth relative to the top node (None for no limit)
+        :return: a select statement with the id, title, depth and parent_id of every node
+        """
+
+        parent_paths = self.paths.alias()
+
+        stmt = select(
+            [self.nodes.c.id, self.nodes.c.title, self.paths.c.depth, parent_paths.c.ancestor.label('parent_id')]
+        ).select_from(
+            self.paths.join(
+                self.nodes, self.nodes.c.id == self.paths.c.descendant
+            ).outerjoin(
+                parent_paths, and_(
+                    parent_paths.c.descendant == self.paths.c.descendant, parent_paths.c.depth == 1,
+                    *self._same_tree(parent_paths, self.paths)
+                )
+            )
+        ).order_by(
+            *self._sibling_order(parent_paths, self.paths.c.descendant)
+        )
+
+        if node_id is None:
+            # start from the roots
+            stmt = stmt.where(
+                self.paths.c.ancestor.notin_(
+                    self._scope(select([self.paths.c.descendant]).where(self.paths.c.depth > 0), self.paths)
+                )
+            )
+        else:
+            stmt = stmt.where(self.paths.c.ancestor == node_id)
+
+        if max_depth is not None:
+            stmt = stmt.where(self.paths.c.depth <= max_depth)
+
+        return self._scope(stmt, self.paths)
+
+
+class BackgroundDelete(threading.Thread):
+    """
+    The thread deleting a detached subtree in batches. The exception that stopped it, if any, is kept in exception
+    and raised again by join.
+    """
+
+    def __init__(self, target, args, name):
+        super().__init__(target=target, args=args, name=name)
+        self.exception = None
+
+    def run(self):
+        try:
+            super().run()
+        except Exception as e:
+            self.exception = e
+
+    def join(self, timeout=None):
+        super().join(timeout)
+
+        if self.exception is not None:
+            raise self.exception
+
+
+class ClosureTree(ClosureQueries, GenericTree):
+    """
+    Class to create a structure that can store trees using closure tables.
+    """
+
+    def __init__(self, url='sqlite:///:memory:', cache_size=None, title_index=False, track_counts=False,
+                 ordered=False, forest=False, log_changes=False, **engine_options):
+        """
+        Instance initialization.
+        :param url: the database URL (e.g. 'sqlite:///tree.db')
+        :param cache_size: the maximum number of cached get_path, is_root and get_node results (None for no cache)
+        :param title_index: if True, the node titles are indexed, which speeds up the lookups by title
+        :param track_counts: if True, every node stores the number of its descendants in a descendant_count column,
+        which is kept up to date by the operations that change the trees. It must be set when the tables are created.
+        :param ordered: if True, the children of every node are kept in an explicit order, stored as fractional
+        position keys, so placing a node between two siblings only writes its own row. It must be set when the tables
+        are created.
+        :param forest: if True, the tables hold many independent trees (e.g. one for each tenant): every row carries
+        a tree_id that leads the keys and the indexes, and the operations run on the tree selected with scoped. It
+        must be set when the tables are created.
+        :param log_changes: if True, every structural change is appended to a change log table in the transaction
+        that makes it, so that other processes can follow the changes with changes_since and sync_changes. It must be
+        set when the tables are created.
+        :param engine_options: the engine and pragmas arguments of GenericTree, or extra arguments for create_engine
+        (e.g. poolclass=QueuePool, pool_size=10)
+        """
+
+        super(ClosureTree, self).__init__(url, title_index, **engine_options)
+
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.track_counts = track_counts
+        self.ordered = ordered
+        self.forest = forest
+        self.log_changes = log_changes
+
+        # add table objects
+        self._use_tables()
+
+    def _cache_key(self, key):
+        """
+        Adds the tree of a scoped forest to a cache key, since the scoped views share the cache.
+        :param key: a (kind, node_id) tuple
+        :return: the key of the cache entry
+        """
+
+        return key if self.tree_id is None else key + (self.tree_id,)
+
+    def _cached(self, key, load):
+        """
+        Reads a value through the cache.
+        :param key: the cache key
+        :param load: a function without arguments that loads the value from the database
+        :return: the value
+        """
+
+        if self.cache is None:
+            return load()
+
+        key = self._cache_key(key)
+        value = self.cache.get(key)
+        if value is MISSING:
+            value = load()
+            self.cache.put(key, value)
+
+        return value
+
+    def _cached_many(self, kind, node_ids, load):
+        """
+        Reads the values of many nodes through the cache, loading all the missing ones at once.
+        :param kind: the kind of value ('path', 'root' or 'node')
+        :param node_ids: the ids of the nodes
+        :param load: a function that takes a list of ids and returns a dict mapping each of them to its value
+        :return: a dict mapping each id to its value
+        """
+
+        node_ids = list(dict.fromkeys(node_ids))
+
+        if self.cache is None:
+            return load(node_ids)
+
+        values = {}
+        missing = []
+        for node_id in node_ids:
+            value = self.cache.get(self._cache_key((kind, node_id)))
+            if value is MISSING:
+                missing.append(node_id)
+            else:
+                values[node_id] = value
+
+        if missing:
+            for node_id, value in load(missing).items():
+                self.cache.put(self._cache_key((kind, node_id)), value)
+                values[node_id] = value
+
+        return values
+
+    def _invalidate(self, keys):
+        """
+        Removes entries from the cache, both now and after the active transaction ends, so that values read by
+        other connections before the commit (or by this one before a rollback) do not stay in the cache.
+        :param keys: the cache keys
+        """
+
+        if self.cache is None:
+            return
+
+        keys = [self._cache_key(x) for x in keys]
+        self.cache.invalidate(keys)
+        self._after_transaction(lambda: self.cache.invalidate(keys))
+
+    def _invalidate_subtrees(self, node_ids, connection, deleted=False):
+        """
+        Removes the cache entries affected by a change of the position of some nodes.
+        :param node_ids: the ids of the nodes
+        :param connection: a database connection
+        :param deleted: True if the subtrees are being deleted
+        """
+
+        if self.cache is None:
+            return
+
+        subtree_ids = set()
+        for chunk in chunked(node_ids, 500):
+            subtree_ids.update(x.descendant for x in connection.execute(
+                self._scope(select([self.paths.c.descendant]).where(self.paths.c.ancestor.in_(chunk)), self.paths)
+            ))
+
+        # only the paths of the subtrees change, the descendants of the nodes keep their parents
+        keys = [('path', x) for x in subtree_ids] + [('root', x) for x in node_ids]
+        if deleted:
+            keys += [('root', x) for x in subtree_ids] + [('node', x) for x in subtree_ids]
+
+        self._invalidate(keys)
+
+    def _invalidate_new(self, node_ids):
+        """
+        Removes the cache entries of new nodes, since ids of deleted nodes can be reused.
+        :param node_ids: the ids of the new nodes
+        """
+
+        self._invalidate([(kind, x) for x in node_ids for kind in ('path', 'root', 'node')])
+
+    def _record(self, changes, connection):
+        """
+        Appends structural changes to the change log, when it is enabled.
+        :param changes: an iterable of (operation, node_id, parent_id) tuples
+        :param connection: a database connection
+        """
+
+        rows = self._change_rows(changes)
+        if rows:
+            self._insert_many(connection, self.changes, rows)
+
+    def _shift_counts(self, node_id, sign, connection):
+        """
+        Adds the size of a subtree to the descendant counts of the ancestors of its top node, or subtracts it.
+        :param node_id: the id of the top node of the subtree
+        :param sign: 1 to add the size, -1 to subtract it
+        :param connection: a database connection
+        """
+
+        if not self.track_counts:
+            return
+
+        if self.cache is not None:
+            self._invalidate([('node', x.ancestor) for x in connection.execute(self._ancestors_stmt([node_id]))])
+
+        connection.execute(self._shift_counts_stmt(node_id, sign))
+
+    def _ancestor_ids(self, node_ids, connection, chunk_size=500):
+        """
+        Finds the ancestors of many nodes.
+        :param node_ids: the ids of the nodes
+        :param connection: a database connection
+        :param chunk_size: the maximum number of ids sent in a query
+        :return: a set of ids, without the nodes themselves unless they are ancestors of other nodes
+        """
+
+        ancestor_ids = set()
+        for chunk in chunked(node_ids, chunk_size):
+            ancestor_ids.update(x.ancestor for x in connection.execute(self._ancestors_stmt(chunk)))
+
+        return ancestor_ids
+
+    def _recount(self, node_ids, connection, chunk_size=500):
+        """
+        Computes the descendant counts of some nodes again from the paths.
+        :param node_ids: the ids of the nodes
+        :param connection: a database connection
+        :param chunk_size: the maximum number of ids sent in a query
+        """
+
+        self._invalidate([('node', x) for x in node_ids])
+
+        for chunk in chunked(list(node_ids), chunk_size):
+            connection.execute(self._recount_stmt(chunk))
+
+    def recount(self, connection=None):
+        """
+        Computes the descendant counts of all the nodes again from the paths, with a single statement.
+        :param connection: a database connection
+        """
+
+        if not self.track_counts:
+            raise Exception('The descendant counts are not tracked.')
+
+        with self._connect(connection) as connection:
+            connection.execute(self._recount_stmt())
+
+            if self.cache is not None:
+                self.cache.clear()
+                self._after_transaction(self.cache.clear)
+
+    def cache_info(self):
+        """
+        Returns the cache counters.
+        :return: a dict with the hits, misses, evictions, invalidations and size, or None if there is no cache
+        """
+
+        return self.cache and self.cache.info()
+
+    def scoped(self, tree_id):
+        """
+        Selects a tree of a forest. The returned object shares the engine, the sessions and the cache of this one,
+        and all its operations only read and write the rows of the tree.
+        :param tree_id: the id of the tree
+        :return: a ClosureTree restricted to the tree
+        """
+
+        if not self.forest:
+            raise Exception('The tree is not a forest.')
+
+        scoped_tree = copy.copy(self)
+        scoped_tree.tree_id = tree_id
+
+        # the methods wrapped on this object (e.g. by instrument) are bound to it and would ignore the scope
+        for name in list(vars(scoped_tree)):
+            if callable(getattr(type(self), name, None)):
+                delattr(scoped_tree, name)
+
+        return scoped_tree
+
+    def drop_tree(self, tree_id, connection=None):
+        """
+        Deletes a whole tree of a forest, with one statement for the paths and one for the nodes.
+        :param tree_id: the id of the tree
+        :param connection: a database connection
+        :return: the number of deleted nodes
+        """
+
+        if not self.forest:
+            raise Exception('The tree is not a forest.')
+
+        with self._connect(connection) as connection:
+            connection.execute(self.paths.delete().where(self.paths.c.tree_id == tree_id))
+            deleted = connection.execute(self.nodes.delete().where(self.nodes.c.tree_id == tree_id)).rowcount
+            self.scoped(tree_id)._record([('reset', None, None)], connection)
+
+        if self.cache is not None:
+            self.cache.clear()
+            self._after_transaction(self.cache.clear)
+
+        return deleted
+
+    def copy_tree(self, source_tree_id, target_tree_id, connection=None):
+        """
+        Copies a whole tree of a forest to a new tree, with one statement for the nodes and one for the paths. The
+        copied nodes get the ids of the source nodes shifted by an offset, above all the existing ids.
+        :param source_tree_id: the id of the copied tree
+        :param target_tree_id: the id of the new tree, which must not hold any node
+        :param connection: a database connection
+        :return: the offset added to the ids of the source nodes, None if the source tree is empty
+        """
+
+        if not self.forest:
+            raise Exception('The tree is not a forest.')
+
+        with self._connect(connection) as connection:
+            if connection.execute(self.scoped(target_tree_id)._node_count_stmt()).scalar():
+                raise Exception('The target tree is not empty.')
+
+            first_id = connection.execute(
+                select([func.min(self.nodes.c.id)]).where(self.nodes.c.tree_id == source_tree_id)
+            ).scalar()
+            if first_id is None:
+                return None
+
+            # the copy of the first node gets its id from the database, and its insert holds the write lock until the
+            # commit, so no other writer can take the ids of the other copies, which follow it
+            values = dict(connection.execute(select([self.nodes]).where(self.nodes.c.id == first_id)).fetchone(),
+                          tree_id=target_tree_id)
+            del values['id']
+            offset = connection.execute(self.nodes.insert(), values).inserted_primary_key[0] - first_id
+
+            for table, id_columns in ((self.nodes, ['id']), (self.paths, ['ancestor', 'descendant'])):
+                names = [x.name for x in table.columns if x.name != 'tree_id']
+                columns = [table.c[x] + offset if x in id_columns else table.c[x] for x in names]
+
+                stmt = select(columns + [literal(target_tree_id)]).where(table.c.tree_id == source_tree_id)
+                if table is self.nodes:
+                    stmt = stmt.where(table.c.id != first_id)
+
+                connection.execute(table.insert().from_select(names + ['tree_id'], stmt))
+
+            self.scoped(target_tree_id)._record([('reset', None, None)], connection)
+
+        return offset
+
+    def _place(self, parent_id, before, after, connection):
+        """
+        Finds where a node goes among the children of a parent. Without an anchor, the node goes after the last
+        child. An anchor also gives the parent when none is given.
+        :param parent_id: the id of the parent (None if the node becomes a root, or to use the parent of the anchor)
+        :param before: the id of the sibling placed right after the node
+        :param after: the id of the sibling placed right before the node
+        :param connection: a database connection
+        :return: the id of the parent and the position key of the node (None for a root or unordered siblings)
+        """
+
+        if not self.ordered:
+            if before is not None or after is not None:
+                raise Exception('The siblings are not ordered.')
+
+            return parent_id, None
+
+        if before is not None and after is not None:
+            raise Exception('Only one of before and after can be given.')
+
+        anchor_id = after if before is None else before
+        if anchor_id is None:
+            if parent_id is None:
+                return None, None
+
+            last_position = connection.execute(self._sibling_position_stmt(parent_id)).scalar()
+            return parent_id, key_between(last_position, None)
+
+        anchor = connection.execute(self._position_stmt(anchor_id)).fetchone()
+        if anchor is None:
+            raise Exception('The anchor node does not exist or is a root.')
+
+        if parent_id is not None and parent_id != anchor.ancestor:
+            raise Exception('The anchor node is not a child of the parent.')
+
+        neighbour = connection.execute(
+            self._sibling_position_stmt(anchor.ancestor, anchor.position, before is not None)
+        ).scalar()
+
+        if before is not None:
+            return anchor.ancestor, key_between(neighbour, anchor.position)
+
+        return anchor.ancestor, key_between(anchor.position, neighbour)
+
+    def add_node(self, title='', parent=None, by_title=False, before=None, after=None):
+        """
+        Add a new child element to a parent.
+        :param title: the title of the child element.
+        :param parent: the parent of the child element.
+        :param by_title: if True, it will use the first id found for the parent title
+        :param before: with ordered siblings, the id of the sibling placed right after the new node (the parent can
+        then be omitted)
+        :param after: with ordered siblings, the id of the sibling placed right before the new node (the parent can
+        then be omitted)
+        """
+
+        with self._connect() as conn:
+            parent_id = self._resolve_parent(parent, by_title, conn)
+            parent_id, position = self._place(parent_id, before, after, conn)
+
+            # store new node and its paths
+            new_node = conn.execute(self.nodes.insert(), dict(self._tree_values(), title=title))
+            new_node_pk = new_node.inserted_primary_key[0]
+            conn.execute(self._add_paths_stmt(new_node_pk, parent_id, position))
+
+            self._invalidate_new([new_node_pk])
+            self._shift_counts(new_node_pk, 1, conn)
+            self._record([('add', new_node_pk, parent_id)], conn)
+
+            return new_node_pk
+
+    def add_edges(self, edges, parent=None, by_title=False, chunk_size=10000):
+        """
+        Add many nodes at once, inside a single transaction.
+        :param edges: an iterable of (key, parent_key, title) tuples. The keys only link the edges together, a
+        parent_key of None places the node directly under the parent.
+        :param parent: the parent of the top level nodes (None to add them as roots)
+        :param by_title: if True, it will use the first id found for the parent title
+        :param chunk_size: the maximum number of rows written by a single statement
+        :return: a dict mapping each key to the id of its new node
+        """
+
+        parents, titles, order = self._parse_edges(edges)
+
+        with self._connect() as conn:
+            parent_id = self._resolve_parent(parent, by_title, conn)
+
+            base_paths = []
+            if parent_id is not None:
+                base_paths = [(row.ancestor, row.depth) for row in self.get_path(parent_id, conn)]
+
+            nodes = ({'title': titles[key]} for key in order)
+            if self.track_counts:
+                counts = self._descendant_counts(order, parents)
+                nodes = (dict(row, descendant_count=counts[key]) for key, row in zip(order, nodes))
+
+            nodes = iter(self._tree_rows(nodes))
+            first_node = next(nodes, None)
+            if first_node is None:
+                return {}
+
+            # the first node gets its id from the database, and its insert holds the write lock until the commit, so
+            # no other writer can take the next ids, which are allocated upfront to write the nodes with executemany
+            first_id = conn.execute(self.nodes.insert(), first_node).inserted_primary_key[0]
+            ids = {key: first_id + index for index, key in enumerate(order)}
+            nodes = (dict(row, id=ids[key]) for key, row in zip(order[1:], nodes))
+
+            paths = closure_rows(order, parents, ids, base_paths)
+            if self.ordered:
+                last_position = None
+                if parent_id is not None:
+                    last_position = conn.execute(self._sibling_position_stmt(parent_id)).scalar()
+
+                positions = self._batch_positions(order, parents, last_position)
+                paths = positioned_rows(paths, {ids[key]: x for key, x in positions.items()})
+
+            self._insert_many(conn, self.nodes, nodes, chunk_size)
+            self._insert_many(conn, self.paths, self._tree_rows(paths), chunk_size)
+            self._record((
+                ('add', ids[key], parent_id if parents[key] is None else ids[parents[key]]) for key in order
+            ), conn)
+
+            self._invalidate_new(ids.values())
+
+            if self.track_counts and base_paths:
+                self._invalidate([('node', x) for x, _ in base_paths])
+                conn.execute(
+                    self._scope(self.nodes.update().where(
+                        self.nodes.c.id.in_([x for x, _ in base_paths])
+                    ).values(
+                        descendant_count=self.nodes.c.descendant_count + len(order)
+                    ), self.nodes)
+                )
+
+        return ids
+
+    def add_subtree(self, structure, parent=None, by_title=False, chunk_size=10000):
+        """
+        Add a nested structure of nodes at once, inside a single transaction.
+        :param structure: a list of nodes, where each node is either a title or a (title, children) tuple
+        :param parent: the parent of the top level nodes (None to add them as roots)
+        :param by_title: if True, it will use the first id found for the parent title
+        :param chunk_size: the maximum number of rows written by a single statement
+        :return: the ids of the new nodes in depth-first order
+        """
+
+        edges = self._structure_edges(structure)
+        ids = self.add_edges(edges, parent, by_title, chunk_size)
+
+        return [ids[key] for key in range(len(edges))]
+
+    def dump(self, path, connection=None):
+        """
+        Writes all the trees to a compact binary snapshot (the node ids, the parent ids and the titles), which can be
+        loaded with ClosureTree.load. The paths are not stored, they are derived again when loading. Siblings are
+        written in their order, which is kept by a load into an ordered tree.
+        :param path: the path of the file
+        :param connection: a database connection
+        :return: the number of nodes written
+        """
+
+        with self._connect(connection) as connection:
+            rows = connection.execute(self._edges_stmt()).fetchall()
+
+        parents = {row.id: row.parent_id for row in rows}
+        titles = {row.id: row.title for row in rows}
+
+        write_snapshot(path, ((x, parents[x], titles[x]) for x in topological_order(parents)))
+
+        return len(rows)
+
+    @classmethod
+    def load(cls, path, url='sqlite:///:memory:', mmap=False, chunk_size=10000, workers=None, **options):
+        """
+        Creates a tree from a snapshot written by dump.
+        :param path: the path of the snapshot
+        :param url: the database URL, the database must not hold any node
+        :param mmap: if True, the snapshot is memory mapped instead of being read in memory
+        :param chunk_size: the maximum number of rows written by a single statement
+        :param workers: the number of processes computing the paths (None to compute them in this process)
+        :param options: extra arguments for the constructor (e.g. cache_size)
+        :return: the new tree
+        """
+
+        tree = cls(url, **options)
+
+        with read_snapshot(path, mmap) as snapshot:
+            tree.add_snapshot(snapshot, chunk_size, workers)
+
+        return tree
+
+    def add_snapshot(self, snapshot, chunk_size=10000, workers=None):
+        """
+        Adds the nodes of a snapshot to an empty tree, keeping their ids, inside a single transaction. The paths are
+        derived from the parent ids in a single pass, or by a pool of processes for very large trees, in which case
+        this process only writes the paths while the next ones are computed.
+        :param snapshot: a Snapshot
+        :param chunk_size: the maximum number of rows written by a single statement
+        :param workers: the number of processes computing the paths (None to compute them in this process)
+        """
+
+        parents = {}
+        for node_id, parent_id in zip(snapshot.ids, snapshot.parents):
+            if parent_id >= 0 and parent_id not in parents:
+                raise Exception('The snapshot is not valid: node {} comes before its parent.'.format(node_id))
+
+            parents[node_id] = None if parent_id < 0 else parent_id
+
+        with self._connect() as conn:
+            if conn.execute(self._node_count_stmt()).scalar():
+                raise Exception('The tree is not empty.')
+
+            nodes = ({'id': x, 'title': title} for x, title in zip(snapshot.ids, snapshot.titles()))
+            if self.track_counts:
+                counts = self._descendant_counts(list(parents), parents)
+                nodes = (dict(row, descendant_count=counts[row['id']]) for row in nodes)
+
+            self._insert_many(conn, self.nodes, self._tree_rows(nodes), chunk_size)
+
+            if workers:
+                # the rows stay tuples, which are much cheaper than dicts at this scale
+                columns = ['ancestor', 'descendant', 'depth']
+                paths = parallel_closure_rows(snapshot.ids, snapshot.parents, workers)
+
+                if self.ordered:
+                    positions = self._batch_positions(list(parents), parents)
+                    paths = (row + (positions[row[1]] if row[2] == 1 else None,) for row in paths)
+                    columns.append('position')
+
+                if self.forest:
+                    tree_id = self._tree_values()['tree_id']
+                    paths = (row + (tree_id,) for row in paths)
+                    columns.append('tree_id')
+
+                self._insert_many(conn, self.paths, paths, chunk_size, columns)
+            else:
+                paths = closure_rows(parents, parents)
+                if self.ordered:
+                    paths = positioned_rows(paths, self._batch_positions(list(parents), parents))
+
+                self._insert_many(conn, self.paths, self._tree_rows(paths), chunk_size)
+
+            self._record([('reset', None, None)], conn)
+            self._invalidate_new(list(parents))
+
+    def detach_node(self, node_id, connection=None):
+        """
+        Deletes all paths leading to or begin with a node, creating a new tree formed by its subtree.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        """
+
+        with self._connect(connection) as connection:
+            self._invalidate_subtrees([node_id], connection)
+            self._detach(node_id, connection)
+            self._record([('detach', node_id, None)], connection)
+
+    def _detach(self, node_id, connection):
+        """
+        Deletes the paths between a subtree and the ancestors of its top node.
+        :param node_id: the id of the top node of the subtree
+        :param connection: a database connection
+        """
+
+        self._shift_counts(node_id, -1, connection)
+        connection.execute(self._detach_stmt(node_id))
+
+    def attach_node(self, node_id, new_parent_id, connection=None):
+        """
+        Attach a root node under a new parent node, after its last child when the siblings are ordered.
+        :param node_id: the id of the root node
+        :param new_parent_id: the id of the new parent
+        :param connection: a database connection
+        """
+
+        with self._connect(connection) as connection:
+            self._check_move(node_id, new_parent_id, connection)
+
+            if not self.is_root(node_id, connection):
+                raise Exception('Only root nodes can be attached.')
+
+            _, position = self._place(new_parent_id, None, None, connection)
+
+            self._invalidate_subtrees([node_id], connection)
+            self._attach(node_id, new_parent_id, connection, position)
+            self._record([('attach', node_id, new_parent_id)], connection)
+
+    def _attach(self, node_id, new_parent_id, connection, position=None):
+        """
+        Adds the paths between a tree and the ancestors of a new parent.
+        :param node_id: the id of the root node
+        :param new_parent_id: the id of the new parent
+        :param connection: a database connection
+        :param position: the position key of the node among its new siblings, when the siblings are ordered
+        """
+
+        connection.execute(self._attach_stmt(node_id, new_parent_id, position))
+        self._shift_counts(node_id, 1, connection)
+
+    def _check_move(self, node_id, new_parent_id, connection):
+        """
+        Checks that a node can be moved under a new parent: both nodes exist and the parent is not in the subtree of
+        the node.
+        :param node_id: the id of the node
+        :param new_parent_id: the id of the new parent (None if the node becomes a root)
+        :param connection: a database connection
+        """
+
+        if not self.node_exists(node_id, connection):
+            raise Exception('Node does not exist.')
+
+        if new_parent_id is None:
+            return
+
+        if not self.node_exists(new_parent_id, connection):
+            raise Exception('Parent node does not exist.')
+
+        # a single lookup on the primary key, it also covers moving a node under itself
+        if connection.execute(self._cycle_stmt(node_id, new_parent_id)).fetchone() is not None:
+            raise Exception('A node cannot be moved under its own subtree.')
+
+    def is_root(self, node_id, connnection=None):
+        """
+        Checks if the node with the given id is root or not.
+        :param node_id: the id of the node to be checked
+        :param connnection: a database connection
+        :return: True if the node is root, False otherwise.
+        """
+
+        def load():
+            with self._connect(connnection) as connection:
+                return connection.execute(self._not_root_stmt(node_id)).fetchone() is None
+
+        return self._cached(('root', node_id), load)
+
+    def delete_node(self, node_id, connection=None, batch_size=None, progress=None, background=False):
+        """
+        Delete the node with the specified id and all it's descendants.
+        With a batch size, a large subtree is deleted without holding the write lock for long: a first short
+        transaction detaches it from its tree, then its nodes and their paths are deleted from the leaves up, one
+        batch in each transaction unless a connection is given. Until the last batch, what is left of the subtree is
+        a separate tree, which is consistent at every step, and deleting its top node again resumes an interrupted
+        delete.
+        :param node_id: the id of the node to be removed
+        :param connection: a database connection
+        :param batch_size: the maximum number of nodes deleted by a transaction (None to delete the subtree at once)
+        :param progress: a function called after every batch with the number of deleted nodes and the number of
+        nodes to delete
+        :param background: if True, the batches are deleted by a thread, which is started once the subtree is
+        detached (the database must not be in memory, since the thread uses its own connections). Its join raises
+        the exception that stopped it, if any.
+        :return: the BackgroundDelete thread deleting the batches if background is True, None otherwise
+        """
+
+        if batch_size is not None:
+            return self._delete_subtree(node_id, batch_size, progress, background, connection)
+
+        if background:
+            raise Exception('A background delete needs a batch size.')
+
+        with self._connect(connection) as connection:
+            self._invalidate_subtrees([node_id], connection, deleted=True)
+            self._shift_counts(node_id, -1, connection)
+
+            subtree_ids = [x.descendant for x in connection.execute(self._subtree_ids_stmt(node_id))]
+            for stmt in self._delete_stmts(node_id, subtree_ids):
+                connection.execute(stmt)
+
+            if subtree_ids:
+                self._record([('delete', node_id, None)], connection)
+
+    def _delete_subtree(self, node_id, batch_size, progress, background, connection):
+        """
+        Detaches a subtree and deletes it in batches, see delete_node.
+        :return: the thread deleting the batches if background is True, None otherwise
+        """
+
+        if batch_size < 1:
+            raise Exception('The batch size must be a positive number.')
+
+        if background:
+            if connection is not None:
+                raise Exception('A background delete uses its own connections.')
+
+            # the connections of another thread would open another (empty) in-memory database
+            if self.engine.url.database in (None, '', ':memory:') or isinstance(self.engine.pool, SingletonThreadPool):
+                raise Exception('A background delete needs a database shared between threads.')
+
+        with self._connect(connection) as detach_connection:
+            self._invalidate_subtrees([node_id], detach_connection, deleted=True)
+            self._detach(node_id, detach_connection)
+
+            subtree = list(detach_connection.execute(self._subtree_depths_stmt(node_id)))
+            if subtree:
+                self._record([('delete', node_id, None)], detach_connection)
+            else:
+                # a node without paths has no subtree to delete
+                detach_connection.execute(
+                    self._scope(self.nodes.delete().where(self.nodes.c.id == node_id), self.nodes)
+                )
+
+        if not background:
+            self._delete_batches(node_id, subtree, batch_size, progress, connection)
+            return None
+
+        thread = BackgroundDelete(
+            target=self._delete_batches, args=(node_id, subtree, batch_size, progress, None),
+            name='delete_node-{}'.format(node_id)
+        )
+        thread.start()
 
+        return thread
 
-class ClosureTree(GenericTree):
-    """
-    Class to create a structure that can store trees using closure tables.
-    """
+    def _delete_batches(self, node_id, subtree, batch_size, progress, connection):
+        """
+        Deletes a detached subtree from the leaves up, so that the nodes left always form a valid tree.
+        :param node_id: the id of the top node of the subtree
+        :param subtree: the (descendant, depth) rows of the nodes of the subtree
+        :param batch_size: the maximum number of nodes deleted by a transaction
+        :param progress: a function called after every batch with the number of deleted nodes and the number of
+        nodes to delete (None for no progress)
+        :param connection: a database connection (None for a transaction for every batch)
+        """
+
+        deleted, total = 0, len(subtree)
+
+        while subtree:
+            order = [x.descendant for x in sorted(subtree, key=lambda x: x.depth, reverse=True)]
 
-    def __init__(self):
+            for batch in chunked(order, batch_size):
+                with self._connect(connection) as batch_connection:
+                    for chunk in chunked(batch, 500):
+                        if self.track_counts and self.cache is not None:
+                            self._invalidate([
+                                ('node', x.ancestor) for x in batch_connection.execute(self._ancestors_stmt(chunk))
+                            ])
+
+                        for stmt in self._delete_batch_stmts(chunk):
+                            batch_connection.execute(stmt)
+
+                self._invalidate([(kind, x) for x in batch for kind in ('path', 'root', 'node')])
+                deleted += len(batch)
+
+                if progress is not None:
+                    progress(deleted, total)
+
+            # the nodes added under the subtree while it was deleted
+            with self._connect(connection) as check_connection:
+                subtree = list(check_connection.execute(self._subtree_depths_stmt(node_id)))
+            total += len(subtree)
+
+    def move_node(self, node_id, new_parent_id, connection=None, before=None, after=None):
         """
-        Instance initialization.
+        Moves a node under a different parent node, in a single transaction. With ordered siblings, the node goes
+        after the last child of the new parent unless an anchor is given, and a move among the same siblings only
+        updates the position of the node.
+        :param node_id: the id of the node to be moved
+        :param new_parent_id: the id of the new parent node (None to make the node a root, or to use the parent of
+        the anchor)
+        :param connection: a database connection
+        :param before: with ordered siblings, the id of the sibling placed right after the node
+        :param after: with ordered siblings, the id of the sibling placed right before the node
         """
 
-        super(ClosureTree, self).__init__()
+        if node_id in (before, after):
+            raise Exception('A node cannot be placed next to itself.')
 
-        # add table objects
-        self.nodes = Table(
-            'nodes', self.metadata,
-            Column('id', Integer, primary_key=True, autoincrement=True),
-            Column('title', Text, nullable=True)
-        )
+        with self._connect(connection) as connection:
+            new_parent_id, position = self._place(new_parent_id, before, after, connection)
+            self._check_move(node_id, new_parent_id, connection)
+            self._invalidate_subtrees([node_id], connection)
 
-        self.paths = Table(
-            'paths', self.metadata,
-            Column('ancestor', Integer, ForeignKey('nodes.id'), nullable=False),
-            Column('descendant', Integer, ForeignKey('nodes.id'), nullable=False),
-            Column('depth', Integer, nullable=False),
-            PrimaryKeyConstraint('ancestor', 'descendant', name='ad_pk')
-        )
+            if position is not None:
+                current = connection.execute(self._position_stmt(node_id)).fetchone()
 
-        # create tables
-        self.metadata.create_all(self.engine)
+                # a reorder among the same siblings writes a single row
+                if current is not None and current.ancestor == new_parent_id:
+                    connection.execute(
+                        self._reposition_stmt(), {'parent_id': new_parent_id, 'node_id': node_id,
+                                                  'new_position': position}
+                    )
+                    self._record([('move', node_id, new_parent_id)], connection)
+                    return
 
-    def add_node(self, title='', parent=None, by_title=False):
+            self._detach(node_id, connection)
+            self._attach(node_id, new_parent_id, connection, position)
+            self._record([('move', node_id, new_parent_id)], connection)
+
+    def move_nodes(self, moves, chunk_size=500, connection=None):
         """
-        Add a new child element to a parent.
-        :param title: the title of the child element.
-        :param parent: the parent of the child element.
-        :param by_title: if True, it will use the first id found for the parent title
+        Moves many nodes at once, in a single transaction. The moves are applied together: every moved node ends up
+        under its new parent and all the other nodes keep their parents.
+        The subtrees are detached with one statement for each chunk of nodes, then attached in as few waves as
+        possible, where a wave holds the moves whose new parent is not in a subtree that still has to be attached.
+        :param moves: a list of (node_id, new_parent_id) pairs, new_parent_id can be None to make the node a root
+        :param chunk_size: the maximum number of moves handled by a statement
+        :param connection: a database connection
         """
 
-        sel_stmt = []
-        conn = self.engine.connect()
+        new_parents = {}
+        for node_id, new_parent_id in moves:
+            if node_id in new_parents:
+                raise Exception('Node {} is moved more than once.'.format(node_id))
 
-        # cover cases where id is sent as int, str or row object
-        parent_id = parent
-        try:
-            parent_id = parent_id.id
-        except AttributeError:
-            pass
+            new_parents[node_id] = new_parent_id
 
-        if by_title:
-            parent_id = self.get_first_id(parent)
-            if not parent_id:
-                raise Exception('Parent node does not exist.')
+        if not new_parents:
+            return
 
-        if parent_id is not None:
-            # check parent exists
-            if not self.node_exists(parent_id):
+        with self._connect(connection) as connection:
+            parent_ids = {x for x in new_parents.values() if x is not None}
+            existing = self.nodes_exist(set(new_parents) | parent_ids, chunk_size, connection)
+
+            if not all(existing[x] for x in new_parents):
+                raise Exception('Node does not exist.')
+
+            if not all(existing[x] for x in parent_ids):
                 raise Exception('Parent node does not exist.')
 
-            # store new node
-            new_node_pk = conn.execute(self.nodes.insert(), {'title': title}).inserted_primary_key[0]
+            self._invalidate_subtrees(list(new_parents), connection)
 
-            # add new paths for all the ancestors of the parent node
-            sel_stmt.append(
-                select(
-                    [self.paths.c.ancestor, bindparam('d1', new_node_pk), self.paths.c.depth + 1]
-                ).where(
-                    self.paths.c.descendant == parent_id
+            # the counts of the old and new ancestors are computed again once the moves are done
+            count_ids = set()
+            if self.track_counts:
+                count_ids = self._ancestor_ids(list(new_parents), connection, chunk_size)
+
+            # remove the paths between every moved subtree and the ancestors of its top node
+            moved_paths = self.paths.alias()
+            ancestor_paths = self.paths.alias()
+
+            for chunk in chunked(list(new_parents), chunk_size):
+                connection.execute(
+                    self._scope(self.paths.delete().where(
+                        exists(
+                            self._scope(select(
+                                [moved_paths.c.descendant]
+                            ).select_from(
+                                moved_paths.join(
+                                    ancestor_paths, ancestor_paths.c.descendant == moved_paths.c.ancestor
+                                )
+                            ).where(
+                                moved_paths.c.ancestor.in_(chunk)
+                            ).where(
+                                moved_paths.c.descendant == self.paths.c.descendant
+                            ).where(
+                                ancestor_paths.c.ancestor == self.paths.c.ancestor
+                            ).where(
+                                ancestor_paths.c.depth > 0
+                            ), moved_paths, ancestor_paths)
+                        )
+                    ), self.paths)
                 )
-            )
-        else:
-            # add new node
-            new_node_pk = conn.execute(self.nodes.insert(), {'title': title}).inserted_primary_key[0]
 
-        # add path to self
-        sel_stmt.append(
-            select(
-                [bindparam('a2', new_node_pk), bindparam('d2', new_node_pk), bindparam('l2', 0)]
-            )
-        )
+            # the log replays the moves in the order they are applied, so that every step is a valid move
+            self._record((('detach', x, None) for x in new_parents), connection)
 
-        # add paths
-        conn.execute(self.paths.insert().from_select(['ancestor', 'descendant', 'depth'], union_all(*sel_stmt)))
+            # find the top node of the tree that holds each new parent now that all the subtrees are detached
+            tops = {}
+            for chunk in chunked(list(parent_ids), chunk_size):
+                top_depths = {}
+                for row in connection.execute(
+                    self._scope(select([self.paths]).where(self.paths.c.descendant.in_(chunk)), self.paths)
+                ):
+                    if row.depth >= top_depths.get(row.descendant, -1):
+                        top_depths[row.descendant] = row.depth
+                        tops[row.descendant] = row.ancestor
 
-        return new_node_pk
+            # a move has to wait for the move of the subtree that holds its new parent
+            waiting = {}
+            ready = []
+            for node_id, new_parent_id in new_parents.items():
+                if new_parent_id is None:
+                    continue
 
-    def detach_node(self, node_id, connection=None):
+                top_id = tops[new_parent_id]
+                if top_id in new_parents:
+                    waiting.setdefault(top_id, []).append(node_id)
+                else:
+                    ready.append(node_id)
+
+            # the subtrees that become trees are already in place
+            ready.extend(x for node_id, new_parent_id in new_parents.items() if new_parent_id is None
+                         for x in waiting.pop(node_id, ()))
+
+            while ready:
+                for chunk in chunked(ready, chunk_size):
+                    self._attach_many([(x, new_parents[x]) for x in chunk], connection)
+
+                self._record((('attach', x, new_parents[x]) for x in ready), connection)
+
+                ready = [x for node_id in ready for x in waiting.pop(node_id, ())]
+
+            # the moves left waiting form a cycle
+            if waiting:
+                raise Exception('The moves would create a cycle.')
+
+            if self.ordered:
+                self._append_positions(new_parents, connection)
+
+            if self.track_counts:
+                count_ids.update(self._ancestor_ids(list(new_parents), connection, chunk_size))
+                self._recount(count_ids, connection, chunk_size)
+
+    def _append_positions(self, new_parents, connection):
         """
-        Deletes all paths leading to or begin with a node, creating a new tree formed by its subtree.
-        :param node_id: the id of the node
+        Places moved nodes after the last children of their new parents, in the order of the moves.
+        :param new_parents: a dict mapping each moved node to its new parent (None for a root)
         :param connection: a database connection
         """
 
-        connection = connection or self.engine.connect()
+        last_positions = {}
+        rows = []
 
-        connection.execute(
-            self.paths.delete().where(
-                self.paths.c.descendant.in_(
-                    select([self.paths.c.descendant]).where(
-                        self.paths.c.ancestor == node_id
-                    ))
-            ).where(
-                self.paths.c.ancestor.in_(
-                    select([self.paths.c.ancestor]).where(
-                        self.paths.c.descendant == node_id
-                    ).where(
-                        self.paths.c.ancestor != self.paths.c.descendant
-                    ))
-            )
-        )
+        for node_id, new_parent_id in new_parents.items():
+            if new_parent_id is None:
+                continue
 
-    def attach_node(self, node_id, new_parent_id, connection=None):
+            if new_parent_id not in last_positions:
+                last_positions[new_parent_id] = connection.execute(
+                    self._sibling_position_stmt(new_parent_id)
+                ).scalar()
+
+            position = last_positions[new_parent_id] = key_between(last_positions[new_parent_id], None)
+            rows.append({'parent_id': new_parent_id, 'node_id': node_id, 'new_position': position})
+
+        if rows:
+            connection.execute(self._reposition_stmt(), rows)
+
+    def _attach_many(self, moves, connection):
         """
-        Attach a root node under a new parent node.
-        :param node_id: the id of the root node
-        :param new_parent_id: the id of the new parent
+        Adds the paths between many trees and the ancestors of their new parents, with a single statement.
+        :param moves: a list of (node_id, new_parent_id) pairs where every node is a root
         :param connection: a database connection
         """
 
-        connection = connection or self.engine.connect()
-
-        # todo: add check parent/node exist
-        # todo: add check node is root of a tree
-
+        rows = [
+            select([literal(node_id).label('node_id'), literal(new_parent_id).label('parent_id')])
+            for node_id, new_parent_id in moves
+        ]
+        moves_table = (union_all(*rows) if len(rows) > 1 else rows[0]).alias('moves')
         paths_super_tree = self.paths.alias()
         paths_sub_tree = self.paths.alias()
 
+        names = ['ancestor', 'descendant', 'depth']
+        columns = [
+            paths_super_tree.c.ancestor,
+            paths_sub_tree.c.descendant,
+            (paths_super_tree.c.depth + paths_sub_tree.c.depth + 1)
+        ]
+
+        if self.forest:
+            names.append('tree_id')
+            columns.append(paths_super_tree.c.tree_id)
+
         connection.execute(
-            self.paths.insert().from_select(names=[
-                'ancestor', 'descendant', 'depth'
-            ],
-                select=select([
-                    paths_super_tree.c.ancestor,
-                    paths_sub_tree.c.descendant,
-                    (paths_super_tree.c.depth + paths_sub_tree.c.depth + 1)
-                ]).where(
-                    paths_super_tree.c.descendant == new_parent_id
-                ).where(
-                    paths_sub_tree.c.ancestor == node_id
-                )
+            self.paths.insert().from_select(
+                names=names,
+                select=self._scope(select(columns).select_from(
+                    moves_table.join(
+                        paths_super_tree, paths_super_tree.c.descendant == moves_table.c.parent_id
+                    ).join(
+                        paths_sub_tree, paths_sub_tree.c.ancestor == moves_table.c.node_id
+                    )
+                ), paths_super_tree, paths_sub_tree)
             )
         )
 
-    def is_root(self, node_id, connnection=None):
+    def verify(self, connection=None):
         """
-        Checks if the node with the given id is root or not.
-        :param node_id: the id of the node to be checked
-        :param connnection: a database connection
-        :return: True if the node is root, False otherwise.
+        Checks the consistency of the tables with a few set-based queries, without loading the trees.
+        :param connection: a database connection
+        :return: a dict with the number of nodes and paths, the count of each kind of problem (orphans,
+        missing_self_paths, dangling_paths, bad_depths, multiple_parents, missing_paths, extra_paths and cycles) and
+        valid, True if no problem was found
         """
 
-        connnection = connnection or self.engine.connect()
+        with self._connect(connection) as connection:
+            report = {
+                'nodes': connection.execute(self._node_count_stmt()).scalar(),
+                'paths': connection.execute(self._path_count_stmt()).scalar()
+            }
 
-        return connnection.execute(
-            select(
-                [self.paths]
-            ).where(
-                self.paths.c.depth > 0
-            ).where(
-                self.paths.c.descendant == node_id
-            )
-        ).fetchone() is None
+            for kind, stmt in self._verify_stmts().items():
+                report[kind] = connection.execute(stmt).scalar()
+
+        report['valid'] = not any(count for kind, count in report.items() if kind not in ('nodes', 'paths'))
 
-    def delete_node(self, node_id, connection=None):
+        return report
+
+    @staticmethod
+    def _repair_parents(node_ids, edges):
         """
-        Delete the node with the specified id and all it's descendants.
-        :param node_id: the id of the node to be removed
+        Derives a valid forest from parent edges: a node with several parents keeps the first one, a parent that
+        does not exist makes the node a root and every cycle is broken by making one of its nodes a root.
+        :param node_ids: the ids of all the nodes
+        :param edges: a list of (parent_id, node_id, sort_key) tuples, where sort_key orders the siblings
+        :return: a dict mapping each node id to its parent id (None for roots), with the parents before the children
+        """
+
+        parents = dict.fromkeys(node_ids)
+        sort_keys = {}
+        for parent_id, node_id, sort_key in edges:
+            if node_id in parents and node_id not in sort_keys and parent_id in parents and parent_id != node_id:
+                parents[node_id] = parent_id
+                sort_keys[node_id] = sort_key
+
+        children = {}
+        for node_id in sorted(parents, key=lambda x: (sort_keys.get(x, ()), x)):
+            children.setdefault(parents[node_id], []).append(node_id)
+
+        order = {}
+
+        def add_tree(top_id):
+            stack = [top_id]
+            while stack:
+                current = stack.pop()
+                order[current] = parents[current]
+                stack.extend(reversed(children.get(current, ())))
+
+        for node_id in children.get(None, ()):
+            add_tree(node_id)
+
+        # the nodes left are in a cycle or under one, walk up to the cycle and break it there
+        for node_id in parents:
+            if node_id in order:
+                continue
+
+            seen = set()
+            while node_id not in seen:
+                seen.add(node_id)
+                node_id = parents[node_id]
+
+            children[parents[node_id]].remove(node_id)
+            parents[node_id] = None
+            add_tree(node_id)
+
+        return order
+
+    def rebuild_paths(self, chunk_size=10000, connection=None):
+        """
+        Regenerates the whole Paths table from the parents of the nodes (the paths of depth 1), in a single
+        transaction: the parents are read with one query, the closure is derived in memory and written with bulk
+        inserts. Nodes with several parents keep one of them, nodes under a missing parent become roots and cycles
+        are broken. Ordered siblings keep their order and get new position keys.
+        :param chunk_size: the maximum number of rows written by a single statement
         :param connection: a database connection
+        :return: the number of paths written
         """
 
-        connection = connection or self.engine.connect()
+        with self._connect(connection) as connection:
+            node_ids = [x.id for x in connection.execute(self._scope(select([self.nodes.c.id]), self.nodes))]
+            edges = [
+                (row.ancestor, row.descendant, (row.position is None, row.position or '') if self.ordered else ())
+                for row in connection.execute(self._parent_edges_stmt())
+            ]
+            parents = self._repair_parents(node_ids, edges)
 
-        # delete the paths associated with this node
-        connection.execute(
-            self.paths.delete().where(
-                self.paths.c.descendant.in_(
-                    select(
-                        [self.paths.c.descendant]
-                    ).where(
-                        self.paths.c.ancestor == node_id
-                    ))
-            )
-        )
+            paths = closure_rows(parents, parents)
+            if self.ordered:
+                paths = positioned_rows(paths, self._batch_positions(list(parents), parents))
 
-        # delete the node
-        connection.execute(
-            self.nodes.delete().where(
-                self.nodes.c.id == node_id
+            connection.execute(self._scope(self.paths.delete(), self.paths))
+            self._insert_many(connection, self.paths, self._tree_rows(paths), chunk_size)
+
+            if self.track_counts:
+                connection.execute(self._recount_stmt())
+
+            self._record([('reset', None, None)], connection)
+
+            if self.cache is not None:
+                self.cache.clear()
+                self._after_transaction(self.cache.clear)
+
+            return connection.execute(self._path_count_stmt()).scalar()
+
+    def collect_orphans(self, chunk_size=500, connection=None):
+        """
+        Deletes the nodes that have no path, such as the descendants left by delete_node before it removed them.
+        Every chunk is deleted in its own transaction unless a connection is given, so that the locks are only held
+        briefly.
+        :param chunk_size: the maximum number of nodes deleted by a statement
+        :param connection: a database connection
+        :return: the number of deleted nodes
+        """
+
+        orphans_stmt = self._scope(select([self.nodes.c.id]).where(
+            ~exists(
+                self._scope(
+                    select([self.paths.c.ancestor]).where(self.paths.c.descendant == self.nodes.c.id), self.paths
+                )
             )
-        )
+        ), self.nodes).limit(chunk_size)
+
+        deleted = 0
+        while True:
+            with self._connect(connection) as chunk_connection:
+                chunk = [x.id for x in chunk_connection.execute(orphans_stmt)]
+                if not chunk:
+                    return deleted
+
+                # the paths starting from an orphan can only be left over from an inconsistent state
+                chunk_connection.execute(
+                    self._scope(self.paths.delete().where(self.paths.c.ancestor.in_(chunk)), self.paths)
+                )
+                chunk_connection.execute(self._scope(self.nodes.delete().where(self.nodes.c.id.in_(chunk)), self.nodes))
 
-    def move_node(self, node_id, new_parent_id, connection=None):
+            self._invalidate([(kind, x) for x in chunk for kind in ('path', 'root', 'node')])
+            deleted += len(chunk)
+
+    def changes_since(self, version=0, limit=None, connection=None):
         """
-        Moves a node under a different parent node.
-        :param node_id: the id of the node to be moved
-        :param new_parent_id: the id of the new parent node
+        Reads the change log, which holds the structural changes made by every process in the order they were
+        committed.
+        :param version: the version of the last change already seen (0 to read the whole log)
+        :param limit: the maximum number of changes returned (None for no limit)
+        :param connection: a database connection
+        :return: a list of Change rows, in version order
+        """
+
+        with self._connect(connection) as connection:
+            return [Change(x.version, x.operation, x.node_id, x.parent_id)
+                    for x in connection.execute(self._changes_stmt(version, limit))]
+
+    def change_version(self, connection=None):
+        """
+        Returns the version of the last change, to start following the log from the current state.
+        :param connection: a database connection
+        :return: the version, 0 if the log is empty
+        """
+
+        with self._connect(connection) as connection:
+            return connection.execute(self._change_version_stmt()).scalar()
+
+    def prune_changes(self, version, connection=None):
+        """
+        Deletes the oldest entries of the change log, once every process has seen them.
+        :param version: the version of the last deleted change
+        :param connection: a database connection
+        :return: the number of deleted changes
+        """
+
+        with self._connect(connection) as connection:
+            return connection.execute(self._prune_changes_stmt(version)).rowcount
+
+    def sync_changes(self, version, index=None, connection=None):
+        """
+        Brings the cache and a TreeIndex mirror up to date with the changes made since a version, including the ones
+        of other processes. The index replays the log, or is reloaded if the tree was rewritten.
+        :param version: the version returned by the previous call (or by change_version before the index was built)
+        :param index: a TreeIndex of this tree
         :param connection: a database connection
+        :return: the version to pass to the next call
         """
 
-        connection = connection or self.engine.connect()
+        with self._connect(connection) as connection:
+            changes = self.changes_since(version, connection=connection)
+            if not changes:
+                return version
+
+            version = changes[-1].version
+
+            if self.cache is not None:
+                if self.track_counts or any(x.operation in ('delete', 'reset') for x in changes):
+                    # the deleted nodes and the former ancestors are not known anymore
+                    self.cache.clear()
+                else:
+                    self._invalidate_new([x.node_id for x in changes if x.operation == 'add'])
+                    self._invalidate_subtrees(list({x.node_id for x in changes}), connection)
+
+            if index is not None:
+                if any(x.operation == 'reset' for x in changes):
+                    # the reads may not share a snapshot, so the index is loaded again until no change was made
+                    # meanwhile
+                    while True:
+                        index.reload(self, connection)
+                        latest = self.change_version(connection)
+                        if latest == version:
+                            break
 
-        self.detach_node(node_id=node_id, connection=connection)
-        self.attach_node(node_id=node_id, new_parent_id=new_parent_id, connection=connection)
+                        version = latest
+                else:
+                    index.apply_changes(changes)
+
+        return version
 
     def get_roots(self, connection=None):
         """
         Get the root nodes.
         :param connection: a database connection
-        :return: a ResultProxy instance with the root nodes
+        :return: a list of rows with the root nodes
         """
 
-        connection = connection or self.engine.connect()
-
-        return connection.execute(
-            select(
-                [self.nodes.c.title, self.nodes.c.id.label('descendant')]
-            ).where(
-                self.nodes.c.id.notin_(
-                    select([self.paths.c.descendant]).where(self.paths.c.depth > 0)
-                )
-            )
-        )
+        with self._connect(connection) as connection:
+            return connection.execute(self._roots_stmt()).fetchall()
 
     def get_descendants(self, node_id, connection=None):
         """
-        Get the descendants of the given node.
+        Get the descendants of the given node, in their order when the siblings are ordered.
         :param node_id: the id of the node
         :param connection: a database connection
-        :return: a ResultProxy instance with the descendants of the node with id = node_id
+        :return: a list of rows with the descendants of the node with id = node_id
         """
 
-        connection = connection or self.engine.connect()
+        with self._connect(connection) as connection:
+            return connection.execute(self._descendants_stmt(node_id)).fetchall()
 
-        return connection.execute(
-            select(
-                [self.paths, self.nodes.c.title]
-            ).select_from(
-                self.paths.join(self.nodes, self.nodes.c.id == self.paths.c.descendant)
-            ).where(
-                self.paths.c.ancestor == node_id
-            ).where(
-                self.paths.c.depth == '1'
-            )
-        )
+    def iter_descendants(self, node_id, min_depth=1, max_depth=None, batch_size=1000, cursor=None,
+                         connection=None):
+        """
+        Streams all the descendants of a node ordered by depth and id, fetching them in batches with keyset
+        pagination so that the memory usage does not depend on the size of the subtree.
+        :param node_id: the id of the node
+        :param min_depth: the minimum depth relative to the node
+        :param max_depth: the maximum depth relative to the node (None for no limit)
+        :param batch_size: the number of rows fetched by a query
+        :param cursor: a (depth, descendant) pair taken from the last row processed; the iteration resumes after it
+        :param connection: a database connection
+        :return: a generator of rows with the paths and the titles of the descendants
+        """
+
+        while True:
+            batch_stmt = self._descendants_batch_stmt(node_id, min_depth, max_depth, batch_size, cursor)
+
+            # only hold the connection while fetching a batch
+            with self._connect(connection) as batch_connection:
+                rows = batch_connection.execute(batch_stmt).fetchall()
+
+            for row in rows:
+                yield row
+
+            if len(rows) < batch_size:
+                return
+
+            cursor = rows[-1].depth, rows[-1].descendant
 
     def get_path(self, node_id, connection=None):
         """
         Retrieves the ancestors in descending order of depth (useful for building node location (path from root).
         :param node_id: the id of the node
         :param connection: a database connection
-        :return: a ResultProxy containing the ancestors of the given node
+        :return: a list of rows containing the ancestors of the given node
         """
 
-        connection = connection or self.engine.connect()
+        def load():
+            with self._connect(connection) as load_connection:
+                return tuple(load_connection.execute(self._path_stmt(node_id)))
 
-        return connection.execute(
-            select(
-                [self.paths, self.nodes.c.title]
-            ).select_from(
-                self.paths.join(self.nodes, self.nodes.c.id == self.paths.c.ancestor)
-            ).where(
-                self.paths.c.descendant == node_id
-            ).order_by(
-                desc(self.paths.c.depth)
-            )
-        )
+        return list(self._cached(('path', node_id), load))
 
-    def print_path(self, node_id, connection=None):
+    def get_node(self, node_id, connection=None):
         """
-        Prints the ancestors of the node descending depth order.
-        :param node_id: the id of the node.
+        Retrieves the node from the Nodes table.
+        :param node_id: the id of the node
         :param connection: a database connection
+        :return: a row object or None of the node does not exist
         """
 
-        connection = connection or self.engine.connect()
+        return self._cached(('node', node_id), lambda: super(ClosureTree, self).get_node(node_id, connection))
+
+    def get_nodes(self, node_ids, chunk_size=500, connection=None):
+        """
+        Retrieves many nodes from the Nodes table, with one query for each chunk of ids.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to a row object, or to None if the node does not exist
+        """
 
-        ancestors = self.get_path(node_id, connection)
+        def load(missing_ids):
+            return super(ClosureTree, self).get_nodes(missing_ids, chunk_size, connection)
 
-        print(' -> '.join(x.title for x in ancestors))
+        return self._cached_many('node', node_ids, load)
 
-    def print_table(self, table, connection=None):
+    def descendant_count(self, node_id, connection=None):
         """
-        Print a table from the database.
-        :param table: a SQLA Table
+        Counts all the descendants of a node, with a single read of the node when the counts are tracked.
+        :param node_id: the id of the node
         :param connection: a database connection
+        :return: the number of descendants
         """
 
-        connection = connection or self.engine.connect()
-        result = connection.execute(select([table]))
-        print(
-            '-----------------------------------------------------------'
-            '\nColumns:\n\t{}\nData:\n\t{}\n'
-            '-----------------------------------------------------------'.format(
-                table.columns, '\n\t'.join(str(row) for row in result)
-            )
-        )
+        if self.track_counts:
+            node = self.get_node(node_id, connection)
+            return node.descendant_count if node is not None else 0
 
-        result.close()
+        with self._connect(connection) as connection:
+            return connection.execute(
+                self._scope(
+                    select([func.count()]).where(self.paths.c.ancestor == node_id).where(self.paths.c.depth > 0),
+                    self.paths
+                )
+            ).scalar()
 
-    def view_tree(self, node=None, prefix=' ', connection=None):
+    def subtree_stats(self, node_ids, chunk_size=500, connection=None):
         """
-        Print a tree in a more visual style.
-        :param node: the starting node of the tree.
-        :param prefix: string that will be appeneded to the node and all its children
+        Computes the number of descendants, the height (the maximum depth relative to the node) and the number of
+        leaves of many subtrees, with one GROUP BY for each chunk of ids.
+        :param node_ids: the ids of the top nodes
+        :param chunk_size: the maximum number of ids sent in a query
         :param connection: a database connection
+        :return: a dict mapping each id to a SubtreeStats, or to None if the node does not exist
         """
 
-        connection = connection or self.engine.connect()
+        stats = dict.fromkeys(node_ids)
 
-        if not node:
-            # get roots
-            roots = self.get_roots(connection)
+        with self._connect(connection) as connection:
+            for chunk in chunked(list(stats), chunk_size):
+                for row in connection.execute(self._subtree_stats_stmt(chunk)):
+                    stats[row.ancestor] = SubtreeStats(row.descendants, row.height, row.leaves)
 
-            if not roots:
-                print('No root nodes found.')
-                return
+        return stats
 
-            for node in roots:
-                # print tree for each root
-                self.view_tree(node, connection=connection)
-                print()
+    def is_ancestor(self, ancestor_id, descendant_id, include_self=False, connection=None):
+        """
+        Checks if a node is an ancestor of another one, with a single lookup on the primary key of the paths.
+        :param ancestor_id: the id of the ancestor
+        :param descendant_id: the id of the descendant
+        :param include_self: if True, a node is considered an ancestor of itself
+        :param connection: a database connection
+        :return: True or False, also False if one of the nodes does not exist
+        """
 
-            return
-        else:
-            node_title = node.title
-            node_id = node.descendant
+        with self._connect(connection) as connection:
+            stmt = self._is_ancestor_stmt(ancestor_id, descendant_id, include_self)
+
+            return connection.execute(stmt).fetchone() is not None
+
+    def is_ancestor_many(self, pairs, include_self=False, chunk_size=250, connection=None):
+        """
+        Checks many (ancestor, descendant) pairs, with one query for each chunk of pairs.
+        :param pairs: a list of (ancestor_id, descendant_id) pairs
+        :param include_self: if True, a node is considered an ancestor of itself
+        :param chunk_size: the maximum number of pairs sent in a query
+        :param connection: a database connection
+        :return: a list of booleans, in the order of the pairs
+        """
+
+        pairs = [tuple(x) for x in pairs]
+        found = set()
+
+        with self._connect(connection) as connection:
+            for chunk in chunked(list(dict.fromkeys(pairs)), chunk_size):
+                found.update(
+                    (row.ancestor, row.descendant)
+                    for row in connection.execute(self._ancestor_pairs_stmt(chunk, include_self))
+                )
 
-        # print the current node
-        print('{}({}, {})'.format(prefix, node_id, node_title))
+        return [x in found for x in pairs]
 
-        # fetch the children for the current node
-        children = self.get_descendants(node_id, connection)
+    def lca(self, node_ids, connection=None):
+        """
+        Finds the lowest common ancestor of some nodes with a single query, which intersects their ancestors and
+        keeps the nearest one. A node counts as its own ancestor, so the result can be one of the nodes.
+        :param node_ids: the ids of the nodes
+        :param connection: a database connection
+        :return: the id of the ancestor, or None if the nodes are not in the same tree
+        """
+
+        node_ids = list(dict.fromkeys(node_ids))
+        if not node_ids:
+            return None
+
+        with self._connect(connection) as connection:
+            return connection.execute(self._lca_stmt(node_ids)).scalar()
+
+    def resolve_path(self, path, sep='/', connection=None):
+        """
+        Finds a node by the titles of its ancestors, with a single query.
+        :param path: a string with the titles from the root to the node joined by sep (e.g. 'A/B/D'), or a sequence
+        of titles
+        :param sep: the separator of the titles
+        :param connection: a database connection
+        :return: the id of the node, or None if no node matches. If several nodes match, the smallest id is returned
+        """
+
+        titles = self._split_path(path, sep)
+        if not titles:
+            return None
+
+        matches = self._resolve_path_stmt(titles).alias('matches')
+
+        with self._connect(connection) as connection:
+            return connection.execute(select([func.min(matches.c.descendant)])).scalar()
+
+    def resolve_paths(self, paths, sep='/', chunk_size=100, connection=None):
+        """
+        Finds many nodes by the titles of their ancestors, with one query for each chunk of paths.
+        :param paths: the paths, as accepted by resolve_path
+        :param sep: the separator of the titles
+        :param chunk_size: the maximum number of paths resolved by a query
+        :param connection: a database connection
+        :return: a list with the id of the node of each path, or None if no node matches
+        """
+
+        split_paths = [self._split_path(x, sep) for x in paths]
+        ids = [None] * len(split_paths)
+
+        with self._connect(connection) as connection:
+            for chunk in chunked([(index, x) for index, x in enumerate(split_paths) if x], chunk_size):
+                for row in connection.execute(self._resolve_paths_stmt(chunk)):
+                    ids[row.position] = row.descendant
+
+        return ids
+
+    def get_subtree(self, node_id=None, max_depth=None, connection=None):
+        """
+        Loads a subtree in memory with a single query. The children of every node are listed in their order when
+        the siblings are ordered, by id otherwise.
+        :param node_id: the id of the top node (None to load all the trees)
+        :param max_depth: the maximum depth relative to the top node (None for no limit)
+        :param connection: a database connection
+        :return: a SubtreeNode (None if the node does not exist) or a list of SubtreeNode roots if node_id is None
+        """
+
+        stmt = self._subtree_stmt(node_id, max_depth)
+
+        with self._connect(connection) as connection:
+            top_nodes = self._build_subtree(connection.execute(stmt).fetchall())
+
+        if node_id is None:
+            return top_nodes
+
+        return top_nodes[0] if top_nodes else None
+
+    def get_paths(self, node_ids, chunk_size=500, connection=None):
+        """
+        Retrieves the ancestors of many nodes, with one query for each chunk of ids.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to the list of rows returned by get_path for it
+        """
+
+        def load(missing_ids):
+            paths = {x: [] for x in missing_ids}
+
+            with self._connect(connection) as load_connection:
+                for chunk in chunked(missing_ids, chunk_size):
+                    rows = load_connection.execute(self._paths_stmt(chunk))
+
+                    for row in rows:
+                        paths[row.descendant].append(row)
+
+            return {x: tuple(rows) for x, rows in paths.items()}
+
+        return {x: list(rows) for x, rows in self._cached_many('path', node_ids, load).items()}
+
+    def are_roots(self, node_ids, chunk_size=500, connection=None):
+        """
+        Checks if many nodes are roots, with one query for each chunk of ids.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to True if the node is root, False otherwise
+        """
+
+        def load(missing_ids):
+            roots = dict.fromkeys(missing_ids, True)
+
+            with self._connect(connection) as load_connection:
+                for chunk in chunked(missing_ids, chunk_size):
+                    rows = load_connection.execute(self._not_roots_stmt(chunk))
+
+                    for row in rows:
+                        roots[row.descendant] = False
+
+            return roots
+
+        return self._cached_many('root', node_ids, load)
+
+    def print_path(self, node_id, connection=None):
+        """
+        Prints the ancestors of the node descending depth order.
+        :param node_id: the id of the node.
+        :param connection: a database connection
+        """
+
+        with self._connect(connection) as connection:
+            ancestors = self.get_path(node_id, connection)
+
+            print(' -> '.join(x.title for x in ancestors))
+
+    def print_table(self, table, connection=None):
+        """
+        Print a table from the database.
+        :param table: a SQLA Table
+        :param connection: a database connection
+        """
+
+        with self._connect(connection) as connection:
+            result = connection.execute(select([table]))
+            print(
+                '-----------------------------------------------------------'
+                '\nColumns:\n\t{}\nData:\n\t{}\n'
+                '-----------------------------------------------------------'.format(
+                    table.columns, '\n\t'.join(str(row) for row in result)
+                )
+            )
 
-        # print the tree for each node
-        prefix += '.       '
-        for child in children:
-            self.view_tree(child, prefix=prefix, connection=connection)
+            result.close()
 
     def print_tables(self):
         """
         Prints all tables and the visual tree representation.
         """
 
-        conn = self.engine.connect()
-        self.print_table(self.nodes, conn)
-        self.print_table(self.paths, conn)
-        self.view_tree(connection=conn)
+        with self.session() as conn:
+            self.print_table(self.nodes, conn)
+            self.print_table(self.paths, conn)
+            self.view_tree(connection=conn)
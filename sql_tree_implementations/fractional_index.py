@@ -0,0 +1,203 @@
+"""
+Position keys that sort as strings and can always be generated between two other keys, so that an item can be
+placed between two siblings without renumbering them (fractional indexing, as described by David Greenspan).
+
+A key is an integer part followed by a fractional part. The first character of the integer part tells its length
+('a' to 'z' for the lengths 2 to 27, 'A' to 'Z' for the negative integers), so appending after the last key only
+increments the integer part and the keys stay short. The fractional part never ends with '0'.
+"""
+
+DIGITS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+
+INTEGER_ZERO = 'a0'
+SMALLEST_INTEGER = 'A' + '0' * 26
+
+
+def _integer_length(head):
+    """
+    Returns the length of an integer part from its first character.
+    :param head: the first character of a key
+    :return: the length
+    """
+
+    if 'a' <= head <= 'z':
+        return ord(head) - ord('a') + 2
+
+    if 'A' <= head <= 'Z':
+        return ord('Z') - ord(head) + 2
+
+    raise Exception('Invalid position key head: {}.'.format(head))
+
+
+def _split(key):
+    """
+    Splits a key and checks that it is valid.
+    :param key: a position key
+    :return: the integer part and the fractional part
+    """
+
+    if not key or key == SMALLEST_INTEGER:
+        raise Exception('Invalid position key: {!r}.'.format(key))
+
+    length = _integer_length(key[0])
+    if length > len(key) or key.endswith('0') and len(key) > length:
+        raise Exception('Invalid position key: {!r}.'.format(key))
+
+    return key[:length], key[length:]
+
+
+def _midpoint(a, b):
+    """
+    Generates a fractional part between two others.
+    :param a: the lower fractional part ('' for no lower bound)
+    :param b: the upper fractional part (None for no upper bound)
+    :return: a fractional part that sorts between a and b
+    """
+
+    if b is not None:
+        # keep the common prefix
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else '0') == b[n]:
+            n += 1
+
+        if n > 0:
+            return b[:n] + _midpoint(a[n:], b[n:])
+
+    digit_a = DIGITS.index(a[0]) if a else 0
+    digit_b = DIGITS.index(b[0]) if b is not None else BASE
+
+    if digit_b - digit_a > 1:
+        return DIGITS[(digit_a + digit_b + 1) // 2]
+
+    if b is not None and len(b) > 1:
+        return b[:1]
+
+    return DIGITS[digit_a] + _midpoint(a[1:], None)
+
+
+def _increment_integer(integer):
+    """
+    Adds one to an integer part.
+    :param integer: the integer part
+    :return: the next integer part, or None if it is the largest one
+    """
+
+    head, digits = integer[0], list(integer[1:])
+
+    for index in reversed(range(len(digits))):
+        digit = DIGITS.index(digits[index]) + 1
+        if digit < BASE:
+            digits[index] = DIGITS[digit]
+            return head + ''.join(digits)
+
+        digits[index] = '0'
+
+    # the digits overflowed, the integer part gets one digit longer (or shorter for negative integers)
+    if head == 'Z':
+        return INTEGER_ZERO
+
+    if head == 'z':
+        return None
+
+    head = chr(ord(head) + 1)
+    if head > 'a':
+        digits.append('0')
+    else:
+        digits.pop()
+
+    return head + ''.join(digits)
+
+
+def _decrement_integer(integer):
+    """
+    Subtracts one from an integer part.
+    :param integer: the integer part
+    :return: the previous integer part, or None if it is the smallest one
+    """
+
+    head, digits = integer[0], list(integer[1:])
+
+    for index in reversed(range(len(digits))):
+        digit = DIGITS.index(digits[index]) - 1
+        if digit >= 0:
+            digits[index] = DIGITS[digit]
+            return head + ''.join(digits)
+
+        digits[index] = DIGITS[-1]
+
+    # the digits underflowed, the integer part gets one digit shorter (or longer for negative integers)
+    if head == 'a':
+        return 'Z' + DIGITS[-1]
+
+    if head == 'A':
+        return None
+
+    head = chr(ord(head) - 1)
+    if head < 'Z':
+        digits.append(DIGITS[-1])
+    else:
+        digits.pop()
+
+    return head + ''.join(digits)
+
+
+def key_between(a, b):
+    """
+    Generates a position key between two others.
+    :param a: the lower key (None to generate a key before b)
+    :param b: the upper key (None to generate a key after a)
+    :return: a key that sorts between a and b
+    """
+
+    if a is not None and b is not None and a >= b:
+        raise Exception('The position keys are not in order: {!r} >= {!r}.'.format(a, b))
+
+    if a is None:
+        if b is None:
+            return INTEGER_ZERO
+
+        integer_b, fraction_b = _split(b)
+        if integer_b == SMALLEST_INTEGER:
+            return integer_b + _midpoint('', fraction_b)
+
+        if fraction_b:
+            return integer_b
+
+        key = _decrement_integer(integer_b)
+        if key is None:
+            raise Exception('No position key is available before {!r}.'.format(b))
+
+        return key
+
+    integer_a, fraction_a = _split(a)
+
+    if b is None:
+        key = _increment_integer(integer_a)
+        return integer_a + _midpoint(fraction_a, None) if key is None else key
+
+    integer_b, fraction_b = _split(b)
+    if integer_a == integer_b:
+        return integer_a + _midpoint(fraction_a, fraction_b)
+
+    key = _increment_integer(integer_a)
+    if key < b:
+        return key
+
+    return integer_a + _midpoint(fraction_a, None)
+
+
+def keys_after(a, count):
+    """
+    Generates consecutive position keys.
+    :param a: the key before the first one (None to start from the beginning)
+    :param count: the number of keys
+    :return: a list of keys in ascending order
+    """
+
+    keys = []
+    for _ in range(count):
+        a = key_between(a, None)
+        keys.append(a)
+
+    return keys
@@ -1,19 +1,349 @@
-from sqlalchemy import create_engine, MetaData, select, func
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
 
+from sqlalchemy import create_engine, event, MetaData, Index, select, func
 
-class GenericTree:
+from sql_tree_implementations.instrumentation import Instrumentation, DEFAULT_BUCKETS
+from sql_tree_implementations.utils import chunked
 
-    def __init__(self):
+# a node of a tree loaded in memory, the depth is relative to the top node that was loaded
+SubtreeNode = namedtuple('SubtreeNode', ['id', 'title', 'depth', 'children'])
+
+# the pragmas set on every connection of the SQLite engines created by the trees: a write-ahead log, which lets the
+# reads run during a write, no sync on every commit (the log is still synced at checkpoints), and larger caches
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024
+}
+
+# the metadata of the trees, by schema options, shared by the instances with the same options so that their
+# statements have the same cache keys and are compiled once for each engine
+_shared_metadata = {}
+
+
+def set_pragmas(engine, pragmas):
+    """
+    Sets pragmas on every new connection of a SQLite engine, other databases are left untouched.
+    :param engine: a SQLA Engine
+    :param pragmas: a dict mapping the pragma names to their values (None or an empty dict for no pragmas)
+    """
+
+    if not pragmas or engine.dialect.name != 'sqlite':
+        return
+
+    statements = ['PRAGMA {}={}'.format(name, value) for name, value in pragmas.items()]
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+
+        cursor.close()
+
+
+class NodeQueries:
+    """
+    Builds the statements on the Nodes table, shared by the synchronous and the asynchronous trees.
+    """
+
+    nodes = None
+    title_index = False
+
+    # in forest mode, every row carries the id of its tree and the statements are restricted to one tree
+    forest = False
+
+    def _scope(self, stmt, *tables):
+        """
+        Restricts a statement to the current tree of a forest, a no-op for the other trees.
+        :param stmt: a statement
+        :param tables: the tables or aliases to restrict
+        :return: the statement
+        """
+
+        return stmt
+
+    def _share_tables(self, key, define):
+        """
+        Defines the tables, or reuses the ones that another instance defined with the same options.
+        :param key: a hashable value identifying the definitions (e.g. the class and the schema options)
+        :param define: a function without arguments that adds the tables to self.metadata
+        """
+
+        metadata = _shared_metadata.get(key)
+        if metadata is None:
+            self.metadata = MetaData()
+            define()
+            metadata = _shared_metadata.setdefault(key, self.metadata)
+
+        self.metadata = metadata
+        for table in metadata.tables.values():
+            setattr(self, table.name, table)
+
+    def _create_tables(self, connection):
+        """
+        Creates the tables and indexes that do not exist yet. The indexes are also checked one by one, because the
+        tables that already exist are skipped with all their indexes, which would leave out the indexes added to the
+        definitions since the database was created (e.g. an index requested with title_index=True).
+        :param connection: a synchronous database connection
+        """
+
+        self.metadata.create_all(connection)
+
+        for table in self.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+    def _add_title_index(self):
+        """
+        Adds the index on the node titles to the Nodes table, if it was requested.
+        """
+
+        if self.title_index:
+            columns = [self.nodes.c.title]
+            if self.forest:
+                columns.insert(0, self.nodes.c.tree_id)
+
+            Index('nodes_title_idx', *columns)
+
+    def _node_count_stmt(self):
+        """ Select the number of nodes. """
+        return self._scope(select([func.count()]).select_from(self.nodes), self.nodes)
+
+    def _node_stmt(self, node_id):
+        """ Select a node by id. """
+        return self._scope(select([self.nodes]).where(self.nodes.c.id == node_id), self.nodes)
+
+    def _nodes_stmt(self, node_ids):
+        """ Select many nodes by id. """
+        return self._scope(select([self.nodes]).where(self.nodes.c.id.in_(node_ids)), self.nodes)
+
+    def _first_id_stmt(self, node_title):
+        """ Select the ids of the nodes with a title. """
+        return self._scope(select([self.nodes.c.id]).where(self.nodes.c.title == node_title), self.nodes)
+
+    @staticmethod
+    def _parent_id(parent):
+        """
+        Extracts the id of a parent node.
+        :param parent: the parent given as an id, a row object or a title
+        :return: the id or the given value if it is not a row object
+        """
+
+        # cover cases where id is sent as int, str or row object
+        try:
+            return parent.id
+        except AttributeError:
+            return parent
+
+    @staticmethod
+    def _build_subtree(rows):
+        """
+        Assembles the nested structure of one or more subtrees.
+        :param rows: a list of rows with the id, title, depth and parent_id of every node, where the top nodes have
+        a depth of 0
+        :return: a list with the top nodes, as SubtreeNode objects
+        """
+
+        nodes = {row.id: SubtreeNode(row.id, row.title, row.depth, []) for row in rows}
+        top_nodes = []
+
+        for row in rows:
+            if row.depth == 0:
+                top_nodes.append(nodes[row.id])
+            else:
+                nodes[row.parent_id].children.append(nodes[row.id])
+
+        return top_nodes
+
+    @staticmethod
+    def _print_subtrees(top_nodes, prefix=' ', all_trees=False):
+        """
+        Prints loaded subtrees in a more visual style.
+        :param top_nodes: the top nodes, as SubtreeNode objects
+        :param prefix: string that will be appeneded to the nodes and all their children
+        :param all_trees: True if all the trees are printed, which adds a blank line after each tree
+        """
+
+        if all_trees and not top_nodes:
+            print('No root nodes found.')
+            return
+
+        for top_node in top_nodes:
+            stack = [(top_node, prefix)]
+
+            while stack:
+                current, current_prefix = stack.pop()
+
+                # print the current node
+                print('{}({}, {})'.format(current_prefix, current.id, current.title))
+
+                # print the tree for each child, in order
+                current_prefix += '.       '
+                stack.extend((child, current_prefix) for child in reversed(current.children))
+
+            if all_trees:
+                print()
+
+
+class GenericTree(NodeQueries):
+    def __init__(self, url='sqlite:///:memory:', title_index=False, engine=None, pragmas=SQLITE_PRAGMAS,
+                 **engine_options):
         """
         Class instance initializer.
-        Must define a "nodes" table.
+        Must define a "nodes" table. The tables are created by the first operation, if they do not exist yet.
+        :param url: the database URL (e.g. 'sqlite:///tree.db')
+        :param title_index: if True, the node titles are indexed, which speeds up the lookups by title
+        :param engine: an existing engine to use instead of creating one from the URL, it can be shared by many trees
+        :param pragmas: the pragmas set on the connections when the tree creates a SQLite engine (None for none)
+        :param engine_options: extra arguments for create_engine (e.g. poolclass=QueuePool, pool_size=10)
         """
 
-        self.engine = create_engine('sqlite:///:memory:')
+        if engine is None:
+            engine = create_engine(url, **engine_options)
+            set_pragmas(engine, pragmas)
+
+        self.engine = engine
         self.metadata = MetaData()
+        self.title_index = title_index
 
         self.nodes = None
 
+        # holds the connection of the active session, separately for each thread
+        self._local = threading.local()
+
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def create_schema(self, connection=None):
+        """
+        Creates the tables and indexes that do not exist yet. It is called by the first operation, so it only needs
+        to be called to create the schema ahead of time.
+        :param connection: a database connection
+        """
+
+        if self._schema_ready:
+            return
+
+        with self._schema_lock:
+            if not self._schema_ready:
+                if connection is not None:
+                    self._create_tables(connection)
+                else:
+                    with self.engine.begin() as connection:
+                        self._create_tables(connection)
+
+                self._schema_ready = True
+
+    def instrument(self, callback=None, buckets=DEFAULT_BUCKETS):
+        """
+        Starts recording the statement count, rows changed and time of every call to a public method. The statements
+        issued by a method are attributed to the outermost public method that is running (e.g. the lookups done by
+        add_node are attributed to add_node).
+        :param callback: a function called with the OperationStats of every finished operation
+        :param buckets: the upper bounds of the duration buckets of the histograms, in milliseconds
+        :return: an Instrumentation object, with a snapshot method returning the histograms and a remove method
+        """
+
+        return Instrumentation(self, callback, buckets)
+
+    @contextmanager
+    def session(self):
+        """
+        Runs all the operations inside the block on a single pooled connection and in a single transaction.
+        The transaction is committed when the block ends and rolled back if it raises. A session opened inside
+        another session joins the outer one.
+        :return: a context manager yielding the database connection
+        """
+
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            yield connection
+            return
+
+        self.create_schema()
+
+        connection = self.engine.connect()
+        self._local.connection = connection
+        self._local.callbacks = []
+
+        try:
+            with connection.begin():
+                yield connection
+        finally:
+            callbacks = self._local.callbacks
+            self._local.connection = None
+            self._local.callbacks = []
+            connection.close()
+
+            for callback in callbacks:
+                callback()
+
+    def _after_transaction(self, callback):
+        """
+        Runs a function once the transaction of the active session ends (whether it was committed or rolled back),
+        or right away when there is no active session.
+        :param callback: a function without arguments
+        """
+
+        if getattr(self._local, 'connection', None) is None:
+            callback()
+        else:
+            self._local.callbacks.append(callback)
+
+    @contextmanager
+    def _connect(self, connection=None):
+        """
+        Provides the connection used by an operation: the given connection, the one of the active session or a
+        new one with its own transaction, which is committed and released when the operation ends.
+        :param connection: a database connection
+        :return: a context manager yielding the database connection
+        """
+
+        if connection is not None:
+            self.create_schema(connection)
+            yield connection
+            return
+
+        with self.session() as connection:
+            yield connection
+
+    @staticmethod
+    def _insert_many(connection, table, rows, chunk_size=10000, columns=None):
+        """
+        Inserts many rows with the executemany of the driver, skipping the processing of each parameter set by
+        SQLAlchemy, which dominates the cost of large imports. The rows must only hold plain values.
+        :param connection: a database connection
+        :param table: a SQLA Table
+        :param rows: an iterable of dicts, all with the same keys, or of tuples if the columns are given
+        :param chunk_size: the maximum number of rows written by a single statement
+        :param columns: the column names of the values of the tuples
+        """
+
+        compiled = None
+        indexes = None
+
+        for chunk in chunked(rows, chunk_size):
+            if compiled is None:
+                keys = list(chunk[0]) if columns is None else list(columns)
+                compiled = table.insert().compile(dialect=connection.dialect, column_keys=keys)
+
+                if compiled.positional and keys != list(compiled.positiontup):
+                    indexes = [keys.index(x) for x in compiled.positiontup]
+
+            if columns is None:
+                if compiled.positional:
+                    chunk = [tuple(row[x] for x in compiled.positiontup) for row in chunk]
+            elif not compiled.positional:
+                chunk = [dict(zip(columns, row)) for row in chunk]
+            elif indexes is not None:
+                chunk = [tuple(row[x] for x in indexes) for row in chunk]
+
+            connection.exec_driver_sql(str(compiled), chunk)
+
     def node_count(self, connection=None):
         """
         Returns the number of nodes.
@@ -21,8 +351,8 @@ class GenericTree:
         :return: the number of stored nodes.
         """
 
-        connection = connection or self.engine.connect()
-        return connection.execute(select([func.count()]).select_from(self.nodes)).fetchone()[0]
+        with self._connect(connection) as connection:
+            return connection.execute(self._node_count_stmt()).fetchone()[0]
 
     def get_node(self, node_id, connection=None):
         """
@@ -32,15 +362,8 @@ class GenericTree:
         :return: a row object or None of the node does not exist
         """
 
-        connection = connection or self.engine.connect()
-
-        return connection.execute(
-            select(
-                [self.nodes]
-            ).where(
-                self.nodes.c.id == node_id
-            )
-        ).fetchone()
+        with self._connect(connection) as connection:
+            return connection.execute(self._node_stmt(node_id)).fetchone()
 
     def node_exists(self, node_id, connection=None):
         """
@@ -50,9 +373,37 @@ class GenericTree:
         :return: True if the node exists, False otherwise
         """
 
-        connection = connection or self.engine.connect()
+        with self._connect(connection) as connection:
+            return self.get_node(node_id, connection) is not None
+
+    def get_nodes(self, node_ids, chunk_size=500, connection=None):
+        """
+        Retrieves many nodes from the Nodes table, with one query for each chunk of ids.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to a row object, or to None if the node does not exist
+        """
+
+        nodes = dict.fromkeys(node_ids)
+
+        with self._connect(connection) as connection:
+            for chunk in chunked(list(nodes), chunk_size):
+                for row in connection.execute(self._nodes_stmt(chunk)):
+                    nodes[row.id] = row
+
+        return nodes
+
+    def nodes_exist(self, node_ids, chunk_size=500, connection=None):
+        """
+        Checks if many nodes exist in the Nodes table.
+        :param node_ids: the ids of the nodes
+        :param chunk_size: the maximum number of ids sent in a query
+        :param connection: a database connection
+        :return: a dict mapping each id to True if the node exists, False otherwise
+        """
 
-        return self.get_node(node_id, connection) is not None
+        return {x: row is not None for x, row in self.get_nodes(node_ids, chunk_size, connection).items()}
 
     def get_first_id(self, node_title, connection=None):
         """
@@ -62,17 +413,49 @@ class GenericTree:
         :return: the id of the node if found, or None otherwise
         """
 
-        connection = connection or self.engine.connect()
+        with self._connect(connection) as connection:
+            node = connection.execute(self._first_id_stmt(node_title)).fetchone()
 
-        node = connection.execute(
-            select(
-                [self.nodes.c.id]
-            ).where(
-                self.nodes.c.title == node_title
-            )
-        ).fetchone()
+            return node and node.id
 
-        return node and node.id
+    def _resolve_parent(self, parent, by_title=False, connection=None):
+        """
+        Finds the id of a parent node and checks that it exists.
+        :param parent: the parent given as an id, a row object or a title
+        :param by_title: if True, it will use the first id found for the parent title
+        :param connection: a database connection
+        :return: the id of the parent or None if no parent was given
+        """
+
+        with self._connect(connection) as connection:
+            parent_id = self._parent_id(parent)
+
+            if by_title:
+                parent_id = self.get_first_id(parent, connection)
+                if not parent_id:
+                    raise Exception('Parent node does not exist.')
+
+            # check parent exists
+            if parent_id is not None and not self.node_exists(parent_id, connection):
+                raise Exception('Parent node does not exist.')
+
+            return parent_id
+
+    def view_tree(self, node=None, prefix=' ', connection=None):
+        """
+        Print a tree in a more visual style.
+        :param node: the starting node of the tree, as an id or a row object (None to print all the trees)
+        :param prefix: string that will be appeneded to the node and all its children
+        :param connection: a database connection
+        """
+
+        if not node:
+            self._print_subtrees(self.get_subtree(connection=connection), prefix, all_trees=True)
+            return
+
+        # cover cases where the node is sent as id or row object
+        node = self.get_subtree(getattr(node, 'descendant', node), connection=connection)
+        self._print_subtrees([node] if node else [], prefix)
 
     def add_node(self, title='', parent=None, by_title=False):
         """ Add a node. """
@@ -101,3 +484,7 @@ class GenericTree:
     def get_path(self, node_id, connection=None):
         """ Get a list of ancestors in order for a given node (the path of the node) """
         raise NotImplementedError
+
+    def get_subtree(self, node_id=None, max_depth=None, connection=None):
+        """ Load the subtree of a node (or all the trees) in memory. """
+        raise NotImplementedError
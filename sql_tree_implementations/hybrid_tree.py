@@ -1,24 +1,281 @@
+from collections import namedtuple
+
+from sqlalchemy import Table, Column, Integer, Text, ForeignKey, Index, select, func, case, literal, cast
+
 from sql_tree_implementations.generic_tree import GenericTree
 
+# a row of the path of a node, with the same columns as the rows of the other trees
+PathRow = namedtuple('PathRow', ['ancestor', 'descendant', 'depth', 'title'])
+
+# a row used to build subtrees
+SubtreeRow = namedtuple('SubtreeRow', ['id', 'title', 'depth', 'parent_id'])
+
 
 class HybridTree(GenericTree):
+    """
+    Class to create a structure that can store trees using a parent pointer and a materialized path.
+    The path of a node holds the ids of all its ancestors and its own id (e.g. '/1/5/42/'), so the subtree of a node
+    is a range scan over the indexed path column and its ancestors are known without any join.
+    """
+
+    def __init__(self, url='sqlite:///:memory:', title_index=False, **engine_options):
+        """
+        Instance initialization.
+        :param url: the database URL (e.g. 'sqlite:///tree.db')
+        :param title_index: if True, the node titles are indexed, which speeds up the lookups by title
+        :param engine_options: the engine and pragmas arguments of GenericTree, or extra arguments for create_engine
+        (e.g. poolclass=QueuePool, pool_size=10)
+        """
+
+        super(HybridTree, self).__init__(url, title_index, **engine_options)
+
+        # the instances with the same options share the table definitions
+        self._share_tables((HybridTree, title_index), self._define_tables)
+
+    def _define_tables(self):
+        """
+        Adds the Nodes table, with the parent and the materialized path of every node, to the metadata.
+        """
+
+        self.nodes = Table(
+            'nodes', self.metadata,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('title', Text, nullable=True),
+            Column('parent_id', Integer, ForeignKey('nodes.id'), nullable=True),
+            Column('path', Text, nullable=False),
+            Index('nodes_parent_idx', 'parent_id'),
+            Index('nodes_path_idx', 'path')
+        )
+
+        self._add_title_index()
+
+    @staticmethod
+    def _prefix_range(column, prefix):
+        """
+        Builds the condition matching all the paths that start with a prefix, as a range that can use the index.
+        This is the same as LIKE 'prefix%', since '0' is the character right after '/'.
+        :param column: the path column
+        :param prefix: a path ending with '/'
+        :return: a SQL condition
+        """
+
+        return (column >= prefix) & (column < prefix[:-1] + '0')
+
+    @staticmethod
+    def _path_depth(column):
+        """
+        Builds the expression for the depth of a path (0 for roots).
+        :param column: the path column
+        :return: a SQL expression
+        """
+
+        return func.length(column) - func.length(func.replace(column, '/', '')) - 2
+
+    def _get_node_path(self, node_id, connection):
+        """
+        Retrieves the materialized path of a node.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: the path or None if the node does not exist
+        """
+
+        return connection.execute(
+            select([self.nodes.c.path]).where(self.nodes.c.id == node_id)
+        ).scalar()
+
+    def add_node(self, title='', parent=None, by_title=False):
+        """
+        Add a new child element to a parent.
+        :param title: the title of the child element.
+        :param parent: the parent of the child element.
+        :param by_title: if True, it will use the first id found for the parent title
+        :return: the id of the new node
+        """
+
+        with self._connect() as conn:
+            parent_id = self._resolve_parent(parent, by_title, conn)
+            prefix = '/' if parent_id is None else self._get_node_path(parent_id, conn)
+
+            # the path ends with the new id, so the id is taken by the insert itself, which holds the write lock, and
+            # the row is written complete in a single statement
+            new_node_pk = func.coalesce(func.max(self.nodes.c.id), 0) + 1
+
+            return conn.execute(
+                self.nodes.insert().from_select(
+                    ['id', 'title', 'parent_id', 'path'],
+                    select([
+                        new_node_pk,
+                        literal(title, Text),
+                        literal(parent_id, Integer),
+                        literal(prefix, Text) + cast(new_node_pk, Text) + '/'
+                    ])
+                )
+            ).lastrowid
+
+    def is_root(self, node_id, connnection=None):
+        """
+        Checks if the node with the given id is root or not.
+        :param node_id: the id of the node to be checked
+        :param connnection: a database connection
+        :return: True if the node is root, False otherwise.
+        """
+
+        with self._connect(connnection) as connnection:
+            return connnection.execute(
+                select(
+                    [self.nodes.c.id]
+                ).where(
+                    self.nodes.c.id == node_id
+                ).where(
+                    self.nodes.c.parent_id.isnot(None)
+                )
+            ).fetchone() is None
+
     def delete_node(self, node_id, connection=None):
-        pass
+        """
+        Delete the node with the specified id and all it's descendants.
+        :param node_id: the id of the node to be removed
+        :param connection: a database connection
+        """
+
+        with self._connect(connection) as connection:
+            prefix = self._get_node_path(node_id, connection)
+            if prefix is None:
+                return
+
+            connection.execute(
+                self.nodes.delete().where(self._prefix_range(self.nodes.c.path, prefix))
+            )
 
     def move_node(self, node_id, new_parent_id, connection=None):
-        pass
+        """
+        Moves a node under a different parent node, rewriting the path prefix of its subtree in one update.
+        :param node_id: the id of the node to be moved
+        :param new_parent_id: the id of the new parent node (None to make the node a root)
+        :param connection: a database connection
+        """
 
-    def is_root(self, node_id, connnection=None):
-        pass
+        with self._connect(connection) as connection:
+            old_prefix = self._get_node_path(node_id, connection)
+            if old_prefix is None:
+                raise Exception('Node does not exist.')
 
-    def get_path(self, node_id, connection=None):
-        pass
+            parent_prefix = '/'
+            if new_parent_id is not None:
+                parent_prefix = self._get_node_path(new_parent_id, connection)
 
-    def get_descendants(self, node_id, connection=None):
-        pass
+                if parent_prefix is None:
+                    raise Exception('Parent node does not exist.')
 
-    def add_node(self, title='', parent=None, by_title=False):
-        pass
+                if parent_prefix.startswith(old_prefix):
+                    raise Exception('A node cannot be moved under its own subtree.')
+
+            new_prefix = '{}{}/'.format(parent_prefix, node_id)
+
+            connection.execute(
+                self.nodes.update().where(
+                    self._prefix_range(self.nodes.c.path, old_prefix)
+                ).values(
+                    path=literal(new_prefix) + func.substr(self.nodes.c.path, len(old_prefix) + 1),
+                    parent_id=case([(self.nodes.c.id == node_id, new_parent_id)], else_=self.nodes.c.parent_id)
+                )
+            )
 
     def get_roots(self, connection=None):
-        pass
\ No newline at end of file
+        """
+        Get the root nodes.
+        :param connection: a database connection
+        :return: a list of rows with the root nodes
+        """
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select(
+                    [self.nodes.c.title, self.nodes.c.id.label('descendant')]
+                ).where(
+                    self.nodes.c.parent_id.is_(None)
+                )
+            ).fetchall()
+
+    def get_descendants(self, node_id, connection=None):
+        """
+        Get the direct descendants of the given node.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a list of rows with the descendants of the node with id = node_id
+        """
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select([
+                    self.nodes.c.parent_id.label('ancestor'),
+                    self.nodes.c.id.label('descendant'),
+                    literal(1, Integer).label('depth'),
+                    self.nodes.c.title
+                ]).where(
+                    self.nodes.c.parent_id == node_id
+                )
+            ).fetchall()
+
+    def get_path(self, node_id, connection=None):
+        """
+        Retrieves the ancestors in descending order of depth (useful for building node location (path from root).
+        The ancestors are parsed from the path of the node and fetched with a single lookup.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a list of rows containing the ancestors of the given node
+        """
+
+        with self._connect(connection) as connection:
+            path = self._get_node_path(node_id, connection)
+            if path is None:
+                return []
+
+            ancestor_ids = [int(x) for x in path.strip('/').split('/')]
+            titles = dict(connection.execute(
+                select([self.nodes.c.id, self.nodes.c.title]).where(self.nodes.c.id.in_(ancestor_ids))
+            ).fetchall())
+
+        depth = len(ancestor_ids)
+        return [PathRow(x, node_id, depth - index - 1, titles[x]) for index, x in enumerate(ancestor_ids)]
+
+    def get_subtree(self, node_id=None, max_depth=None, connection=None):
+        """
+        Loads a subtree in memory with a single range scan.
+        :param node_id: the id of the top node (None to load all the trees)
+        :param max_depth: the maximum depth relative to the top node (None for no limit)
+        :param connection: a database connection
+        :return: a SubtreeNode (None if the node does not exist) or a list of SubtreeNode roots if node_id is None
+        """
+
+        depth = self._path_depth(self.nodes.c.path)
+
+        with self._connect(connection) as connection:
+            stmt = select(
+                [self.nodes.c.id, self.nodes.c.title, depth.label('depth'), self.nodes.c.parent_id]
+            ).order_by(
+                self.nodes.c.id
+            )
+
+            top_depth = 0
+            if node_id is not None:
+                prefix = self._get_node_path(node_id, connection)
+                if prefix is None:
+                    return None
+
+                top_depth = prefix.count('/') - 2
+                stmt = stmt.where(self._prefix_range(self.nodes.c.path, prefix))
+
+            if max_depth is not None:
+                stmt = stmt.where(depth <= top_depth + max_depth)
+
+            rows = connection.execute(stmt).fetchall()
+
+        top_nodes = self._build_subtree(
+            [SubtreeRow(x.id, x.title, x.depth - top_depth, x.parent_id) for x in rows]
+        )
+
+        if node_id is None:
+            return top_nodes
+
+        return top_nodes[0] if top_nodes else None
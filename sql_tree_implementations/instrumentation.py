@@ -0,0 +1,235 @@
+import functools
+import inspect
+import threading
+import time
+import types
+from bisect import bisect_left
+
+from sqlalchemy import event
+
+# upper bounds of the duration buckets of the histograms, in milliseconds
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# public methods that are not tree operations
+EXCLUDED_METHODS = frozenset(['session', 'instrument', 'cache_info', 'create_schema'])
+
+
+class OperationStats:
+    """
+    The cost of a call to a public method of a tree, including the calls it makes to other public methods.
+    """
+
+    def __init__(self, name):
+        """
+        Instance initialization.
+        :param name: the name of the method
+        """
+
+        self.name = name
+        self.statements = 0
+        self.rows = 0
+        self.db_time = 0.0
+        self.elapsed = 0.0
+        self.failed = False
+
+    def __repr__(self):
+        return '<OperationStats {} statements={} rows={} elapsed={:.3f}ms>'.format(
+            self.name, self.statements, self.rows, self.elapsed * 1000
+        )
+
+
+class Instrumentation:
+    """
+    Attributes the statements executed by a tree to the outermost public method that caused them, using the cursor
+    events of the engine. The results are kept as histograms and can be sent to a callback.
+    """
+
+    def __init__(self, tree, callback=None, buckets=DEFAULT_BUCKETS):
+        """
+        Instance initialization, the tree is instrumented right away.
+        :param tree: a GenericTree
+        :param callback: a function called with the OperationStats of every finished operation
+        :param buckets: the upper bounds of the duration buckets, in milliseconds
+        """
+
+        self.tree = tree
+        self.callback = callback
+        self.buckets = tuple(buckets)
+
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+        # holds the active operation, separately for each thread
+        self._local = threading.local()
+
+        self._methods = []
+        for name, method in inspect.getmembers(tree, inspect.ismethod):
+            if not name.startswith('_') and name not in EXCLUDED_METHODS:
+                setattr(tree, name, self._wrap(name, method))
+                self._methods.append(name)
+
+        # the schema is created lazily, it would be counted against the first operation
+        tree.create_schema()
+
+        event.listen(tree.engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(tree.engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def remove(self):
+        """
+        Stops the instrumentation of the tree.
+        """
+
+        event.remove(self.tree.engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.remove(self.tree.engine, 'after_cursor_execute', self._after_cursor_execute)
+
+        for name in self._methods:
+            delattr(self.tree, name)
+
+        self._methods = []
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('instrumentation_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        db_time = time.perf_counter() - conn.info['instrumentation_start'].pop()
+
+        operation = getattr(self._local, 'operation', None)
+        if operation is None:
+            return
+
+        operation.statements += 1
+        operation.db_time += db_time
+
+        # the row count is only known for the statements that change data
+        if cursor.rowcount >= 0:
+            operation.rows += cursor.rowcount
+
+    def _wrap(self, name, method):
+        """
+        Wraps a method so that it starts a new operation when no other operation is active.
+        :param name: the name of the method
+        :param method: the bound method
+        :return: the wrapper
+        """
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if getattr(self._local, 'operation', None) is not None:
+                return method(*args, **kwargs)
+
+            operation = OperationStats(name)
+
+            try:
+                result = self._run(operation, method, *args, **kwargs)
+            except BaseException:
+                self._finish(operation)
+                raise
+
+            # the statements of a generator run while it is consumed
+            if isinstance(result, types.GeneratorType):
+                return self._wrap_generator(operation, result)
+
+            self._finish(operation)
+            return result
+
+        return wrapper
+
+    def _wrap_generator(self, operation, generator):
+        """
+        Attributes the work done by a generator to an operation, which ends when the generator is exhausted or
+        closed.
+        :param operation: the OperationStats
+        :param generator: the generator returned by the method
+        :return: a generator yielding the same values
+        """
+
+        try:
+            while True:
+                try:
+                    value = self._run(operation, next, generator)
+                except StopIteration:
+                    return
+
+                yield value
+        finally:
+            # also reached when the consumer closes the wrapper before the end
+            generator.close()
+            self._finish(operation)
+
+    def _run(self, operation, function, *args, **kwargs):
+        """
+        Calls a function with an operation active.
+        :param operation: the OperationStats
+        :param function: the function
+        :return: the result of the function
+        """
+
+        self._local.operation = operation
+        start = time.perf_counter()
+
+        try:
+            return function(*args, **kwargs)
+        except StopIteration:
+            raise
+        except BaseException:
+            operation.failed = True
+            raise
+        finally:
+            operation.elapsed += time.perf_counter() - start
+            self._local.operation = None
+
+    def _finish(self, operation):
+        """
+        Adds a finished operation to the histograms and sends it to the callback.
+        :param operation: the OperationStats
+        """
+
+        with self._lock:
+            histogram = self._histograms.get(operation.name)
+            if histogram is None:
+                histogram = self._histograms[operation.name] = {
+                    'calls': 0,
+                    'failures': 0,
+                    'statements': 0,
+                    'max_statements': 0,
+                    'rows': 0,
+                    'time_ms': 0.0,
+                    'db_time_ms': 0.0,
+                    'buckets': [0] * (len(self.buckets) + 1)
+                }
+
+            histogram['calls'] += 1
+            histogram['failures'] += operation.failed
+            histogram['statements'] += operation.statements
+            histogram['max_statements'] = max(histogram['max_statements'], operation.statements)
+            histogram['rows'] += operation.rows
+            histogram['time_ms'] += operation.elapsed * 1000
+            histogram['db_time_ms'] += operation.db_time * 1000
+            histogram['buckets'][bisect_left(self.buckets, operation.elapsed * 1000)] += 1
+
+        if self.callback is not None:
+            self.callback(operation)
+
+    def snapshot(self):
+        """
+        Returns a copy of the histograms.
+        :return: a dict mapping each method name to a dict with the calls, failures, statements, max_statements,
+        rows, time_ms and db_time_ms totals, and the buckets, a list of (upper bound in milliseconds, count) pairs
+        where the last bound is None
+        """
+
+        bounds = self.buckets + (None,)
+
+        with self._lock:
+            return {
+                name: dict(histogram, buckets=list(zip(bounds, histogram['buckets'])))
+                for name, histogram in self._histograms.items()
+            }
+
+    def reset(self):
+        """
+        Clears the histograms.
+        """
+
+        with self._lock:
+            self._histograms = {}
@@ -1,24 +1,533 @@
-from sql_tree_implementations.generic_tree import GenericTree
+from sqlalchemy import Table, Column, Integer, Text, Index, select, bindparam, func, desc, union_all
+
+from sql_tree_implementations.generic_tree import GenericTree, SubtreeNode
 
 
 class NestedSetsTree(GenericTree):
+    """
+    Class to create a structure that can store trees using nested sets.
+    The left/right values are spaced out so that nodes can be inserted or moved without renumbering the other
+    nodes. When there is no room left under a parent, it is widened by shifting the values that follow it up to the
+    next free stretch, which usually only moves its ancestors and the nodes right after it. The whole table is
+    renumbered (rebalanced) only when the values would overflow.
+    """
+
+    # default spacing between consecutive left/right values
+    DEFAULT_GAP = 2 ** 16
+
+    # new values are never closer than gap // MIN_SPACING_RATIO, a parent with less room left is widened instead
+    MIN_SPACING_RATIO = 64
+
+    # the largest left/right value, which leaves room below the limit of 64 bit integers
+    MAX_VALUE = 2 ** 62
+
+    def __init__(self, url='sqlite:///:memory:', gap=DEFAULT_GAP, title_index=False, **engine_options):
+        """
+        Instance initialization.
+        :param url: the database URL (e.g. 'sqlite:///tree.db')
+        :param gap: the spacing between consecutive left/right values of new nodes
+        :param title_index: if True, the node titles are indexed, which speeds up the lookups by title
+        :param engine_options: the engine and pragmas arguments of GenericTree, or extra arguments for create_engine
+        (e.g. poolclass=QueuePool, pool_size=10)
+        """
+
+        super(NestedSetsTree, self).__init__(url, title_index, **engine_options)
+
+        if gap < 1:
+            raise Exception('The gap must be a positive number.')
+
+        self.gap = gap
+        self.min_spacing = max(1, gap // self.MIN_SPACING_RATIO)
+
+        # the instances with the same options share the table definitions
+        self._share_tables((NestedSetsTree, title_index), self._define_tables)
+
+    def _define_tables(self):
+        """
+        Adds the Nodes table, with the left/right values and the depth of every node, to the metadata.
+        """
+
+        self.nodes = Table(
+            'nodes', self.metadata,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('title', Text, nullable=True),
+            Column('lft', Integer, nullable=False),
+            Column('rgt', Integer, nullable=False),
+            Column('depth', Integer, nullable=False),
+            Index('nodes_lft_idx', 'lft'),
+            Index('nodes_rgt_idx', 'rgt'),
+            Index('nodes_depth_lft_idx', 'depth', 'lft')
+        )
+
+        self._add_title_index()
+
+    def _get_bounds(self, node_id, connection):
+        """
+        Retrieves the left/right values and the depth of a node.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a row object or None if the node does not exist
+        """
+
+        return connection.execute(
+            select(
+                [self.nodes.c.id, self.nodes.c.lft, self.nodes.c.rgt, self.nodes.c.depth]
+            ).where(
+                self.nodes.c.id == node_id
+            )
+        ).fetchone()
+
+    def _free_room(self, parent, connection):
+        """
+        Finds the free values after the last child of a parent.
+        :param parent: the bounds of the parent node (None for the roots)
+        :param connection: a database connection
+        :return: the value after which the new children go and the right value of the parent (None for the roots,
+        which have unlimited room after the last root)
+        """
+
+        depth = 0 if parent is None else parent.depth + 1
+
+        # the last child is the one with the greatest left value
+        stmt = select(
+            [self.nodes.c.rgt]
+        ).where(
+            self.nodes.c.depth == depth
+        ).order_by(
+            desc(self.nodes.c.lft)
+        ).limit(1)
+
+        if parent is None:
+            return connection.execute(stmt).scalar() or 0, None
+
+        start = connection.execute(
+            stmt.where(self.nodes.c.lft > parent.lft).where(self.nodes.c.lft < parent.rgt)
+        ).scalar() or parent.lft
+
+        return start, parent.rgt
+
+    def _allocate(self, parent, count, connection):
+        """
+        Finds room for new values after the last child of a parent, widening the parent when it is too full.
+        :param parent: the bounds of the parent node (None to allocate after the last root)
+        :param count: the number of values, two for every node
+        :param connection: a database connection
+        :return: the value after which the new values go and their spacing
+        """
+
+        start, end = self._free_room(parent, connection)
+
+        if end is None:
+            if start + (count + 1) * self.gap <= self.MAX_VALUE:
+                return start, self.gap
+        else:
+            spacing = min(self.gap, (end - start) // (count + 1))
+            if spacing >= self.min_spacing:
+                return start, spacing
+
+            shift = self._widen(
+                end, (count + 1) * self.min_spacing - (end - start), (count + 1) * self.gap - (end - start), connection
+            )
+            if shift is not None:
+                return start, min(self.gap, (end + shift - start) // (count + 1))
+
+        self._rebalance(connection)
+
+        return self._allocate(None if parent is None else self._get_bounds(parent.id, connection), count, connection)
+
+    def _widen(self, position, needed, wanted, connection, chunk_size=256):
+        """
+        Makes room before a value by shifting it and the values that follow it, up to the first free stretch that
+        can give the wanted shift and keep as much for the values after it. When the stretch allows it, the shift
+        grows with the number of shifted values, so that the next insertions at the same place do not shift them
+        again.
+        :param position: the first value to shift (the right value of the widened parent)
+        :param needed: the minimum shift
+        :param wanted: the shift giving the full gap to the new values
+        :param connection: a database connection
+        :param chunk_size: the maximum number of values read by a query
+        :return: the shift, or None if the values would overflow
+        """
+
+        # the left and right values in order, read from both indexes
+        values_stmt = union_all(
+            select([self.nodes.c.lft.label('value')]).where(self.nodes.c.lft > bindparam('after')),
+            select([self.nodes.c.rgt.label('value')]).where(self.nodes.c.rgt > bindparam('after'))
+        ).order_by('value').limit(chunk_size)
+
+        last = position - 1
+        count = 0
+        free = None
+
+        while free is None:
+            values = [x.value for x in connection.execute(values_stmt, {'after': last})]
+
+            for value in values:
+                if count and value - last - 1 >= 2 * wanted:
+                    free = value - last - 1
+                    break
+
+                last = value
+                count += 1
+            else:
+                if len(values) < chunk_size:
+                    free = self.MAX_VALUE - last
+
+        if free < needed:
+            return None
+
+        shift = max(needed, min(free // 2, max(wanted, count * self.gap)))
+
+        for column in (self.nodes.c.lft, self.nodes.c.rgt):
+            connection.execute(
+                self.nodes.update().where(
+                    column >= position
+                ).where(
+                    column <= last
+                ).values({column: column + shift})
+            )
+
+        return shift
+
+    def _rebalance(self, connection):
+        """
+        Renumbers all the nodes so that every node gets room for new children.
+        :param connection: a database connection
+        """
+
+        rows = connection.execute(
+            select([self.nodes.c.id, self.nodes.c.lft, self.nodes.c.rgt]).order_by(self.nodes.c.lft)
+        ).fetchall()
+
+        # rebuild the structure from the intervals
+        children = {None: []}
+        stack = []
+        for row in rows:
+            while stack and stack[-1].rgt < row.lft:
+                stack.pop()
+
+            children[stack[-1].id if stack else None].append(row.id)
+            children[row.id] = []
+            stack.append(row)
+
+        def trailing_room(node_id):
+            return 3 * self.gap * (len(children[node_id]) + 1)
+
+        # assign the new values in depth-first order
+        bounds = {}
+        counter = 0
+        stack = [(None, iter(children[None]))]
+        while stack:
+            node_id, pending = stack[-1]
+            child_id = next(pending, None)
+
+            if child_id is not None:
+                counter += self.gap
+                bounds[child_id] = [counter, None]
+                stack.append((child_id, iter(children[child_id])))
+            else:
+                stack.pop()
+                if node_id is not None:
+                    counter += trailing_room(node_id)
+                    bounds[node_id][1] = counter
+
+        if not rows:
+            return
+
+        connection.execute(
+            self.nodes.update().where(
+                self.nodes.c.id == bindparam('b_id')
+            ).values(
+                lft=bindparam('b_lft'), rgt=bindparam('b_rgt')
+            ),
+            [{'b_id': x.id, 'b_lft': bounds[x.id][0], 'b_rgt': bounds[x.id][1]} for x in rows]
+        )
+
+    def add_node(self, title='', parent=None, by_title=False):
+        """
+        Add a new child element to a parent.
+        :param title: the title of the child element.
+        :param parent: the parent of the child element.
+        :param by_title: if True, it will use the first id found for the parent title
+        :return: the id of the new node
+        """
+
+        with self._connect() as conn:
+            parent_id = self._resolve_parent(parent, by_title, conn)
+            parent_bounds = None if parent_id is None else self._get_bounds(parent_id, conn)
+
+            start, spacing = self._allocate(parent_bounds, 2, conn)
+
+            return conn.execute(self.nodes.insert(), {
+                'title': title,
+                'lft': start + spacing,
+                'rgt': start + 2 * spacing,
+                'depth': 0 if parent_bounds is None else parent_bounds.depth + 1
+            }).inserted_primary_key[0]
+
+    def is_root(self, node_id, connnection=None):
+        """
+        Checks if the node with the given id is root or not.
+        :param node_id: the id of the node to be checked
+        :param connnection: a database connection
+        :return: True if the node is root, False otherwise.
+        """
+
+        with self._connect(connnection) as connnection:
+            return connnection.execute(
+                select(
+                    [self.nodes.c.id]
+                ).where(
+                    self.nodes.c.id == node_id
+                ).where(
+                    self.nodes.c.depth > 0
+                )
+            ).fetchone() is None
+
     def delete_node(self, node_id, connection=None):
-        pass
+        """
+        Delete the node with the specified id and all it's descendants.
+        :param node_id: the id of the node to be removed
+        :param connection: a database connection
+        """
+
+        with self._connect(connection) as connection:
+            bounds = self._get_bounds(node_id, connection)
+            if bounds is None:
+                return
+
+            connection.execute(
+                self.nodes.delete().where(
+                    self.nodes.c.lft >= bounds.lft
+                ).where(
+                    self.nodes.c.lft <= bounds.rgt
+                )
+            )
 
     def move_node(self, node_id, new_parent_id, connection=None):
-        pass
+        """
+        Moves a node under a different parent node, with a single update of its subtree.
+        :param node_id: the id of the node to be moved
+        :param new_parent_id: the id of the new parent node (None to make the node a root)
+        :param connection: a database connection
+        """
 
-    def is_root(self, node_id, connnection=None):
-        pass
+        with self._connect(connection) as connection:
+            bounds = self._get_bounds(node_id, connection)
+            parent_bounds = None if new_parent_id is None else self._get_bounds(new_parent_id, connection)
 
-    def get_path(self, node_id, connection=None):
-        pass
+            if bounds is None or (new_parent_id is not None and parent_bounds is None):
+                raise Exception('Node does not exist.')
 
-    def get_descendants(self, node_id, connection=None):
-        pass
+            if parent_bounds is not None and bounds.lft <= parent_bounds.lft <= bounds.rgt:
+                raise Exception('A node cannot be moved under its own subtree.')
 
-    def add_node(self, title='', parent=None, by_title=False):
-        pass
+            depth_offset = (0 if parent_bounds is None else parent_bounds.depth + 1) - bounds.depth
+            start, end = self._free_room(parent_bounds, connection)
+
+            # a subtree that fits in the free room keeps its values, shifted by a single update
+            offset = self.gap if end is None else min(self.gap, (end - start - (bounds.rgt - bounds.lft)) // 2)
+            if offset < self.min_spacing:
+                self._pack(bounds, parent_bounds, depth_offset, connection)
+                return
+
+            offset = start + offset - bounds.lft
+
+            connection.execute(
+                self.nodes.update().where(
+                    self.nodes.c.lft >= bounds.lft
+                ).where(
+                    self.nodes.c.lft <= bounds.rgt
+                ).values(
+                    lft=self.nodes.c.lft + offset,
+                    rgt=self.nodes.c.rgt + offset,
+                    depth=self.nodes.c.depth + depth_offset
+                )
+            )
+
+    def _pack(self, bounds, parent_bounds, depth_offset, connection):
+        """
+        Moves a subtree after the last child of a parent, giving new values to its nodes so that it only needs two
+        values for each node.
+        :param bounds: the bounds of the top node of the subtree
+        :param parent_bounds: the bounds of the new parent (None to make the node a root)
+        :param depth_offset: the change of depth of the nodes of the subtree
+        :param connection: a database connection
+        """
+
+        subtree_stmt = select(
+            [self.nodes.c.id, self.nodes.c.lft, self.nodes.c.rgt]
+        ).where(
+            self.nodes.c.lft >= bindparam('b_lft')
+        ).where(
+            self.nodes.c.lft <= bindparam('b_rgt')
+        )
+
+        size = connection.execute(
+            select([func.count()]).select_from(subtree_stmt.subquery()), {'b_lft': bounds.lft, 'b_rgt': bounds.rgt}
+        ).scalar()
+
+        # widening the parent can also shift the subtree
+        start, spacing = self._allocate(parent_bounds, 2 * size, connection)
+        bounds = self._get_bounds(bounds.id, connection)
+
+        rows = connection.execute(subtree_stmt, {'b_lft': bounds.lft, 'b_rgt': bounds.rgt}).fetchall()
+        values = sorted([(x.lft, x.id) for x in rows] + [(x.rgt, x.id) for x in rows])
+
+        new_values = {}
+        for index, (_, node_id) in enumerate(values):
+            new_values.setdefault(node_id, []).append(start + (index + 1) * spacing)
+
+        connection.execute(
+            self.nodes.update().where(
+                self.nodes.c.id == bindparam('b_id')
+            ).values(
+                lft=bindparam('b_new_lft'), rgt=bindparam('b_new_rgt'), depth=self.nodes.c.depth + depth_offset
+            ),
+            [{'b_id': node_id, 'b_new_lft': lft, 'b_new_rgt': rgt} for node_id, (lft, rgt) in new_values.items()]
+        )
 
     def get_roots(self, connection=None):
-        pass
+        """
+        Get the root nodes.
+        :param connection: a database connection
+        :return: a list of rows with the root nodes
+        """
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select(
+                    [self.nodes.c.title, self.nodes.c.id.label('descendant')]
+                ).where(
+                    self.nodes.c.depth == 0
+                ).order_by(
+                    self.nodes.c.lft
+                )
+            ).fetchall()
+
+    def get_descendants(self, node_id, connection=None):
+        """
+        Get the direct descendants of the given node, with a range scan over its interval.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a list of rows with the descendants of the node with id = node_id
+        """
+
+        parent = self.nodes.alias()
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select([
+                    parent.c.id.label('ancestor'),
+                    self.nodes.c.id.label('descendant'),
+                    (self.nodes.c.depth - parent.c.depth).label('depth'),
+                    self.nodes.c.title
+                ]).where(
+                    parent.c.id == node_id
+                ).where(
+                    self.nodes.c.depth == parent.c.depth + 1
+                ).where(
+                    self.nodes.c.lft > parent.c.lft
+                ).where(
+                    self.nodes.c.lft < parent.c.rgt
+                ).order_by(
+                    self.nodes.c.lft
+                )
+            ).fetchall()
+
+    def descendant_count(self, node_id, connection=None):
+        """
+        Counts all the descendants of a node, with a range scan over its interval.
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: the number of descendants
+        """
+
+        parent = self.nodes.alias()
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select(
+                    [func.count()]
+                ).where(
+                    parent.c.id == node_id
+                ).where(
+                    self.nodes.c.lft > parent.c.lft
+                ).where(
+                    self.nodes.c.lft < parent.c.rgt
+                )
+            ).scalar()
+
+    def get_path(self, node_id, connection=None):
+        """
+        Retrieves the ancestors in descending order of depth (useful for building node location (path from root).
+        :param node_id: the id of the node
+        :param connection: a database connection
+        :return: a list of rows containing the ancestors of the given node
+        """
+
+        node = self.nodes.alias()
+
+        with self._connect(connection) as connection:
+            return connection.execute(
+                select([
+                    self.nodes.c.id.label('ancestor'),
+                    node.c.id.label('descendant'),
+                    (node.c.depth - self.nodes.c.depth).label('depth'),
+                    self.nodes.c.title
+                ]).where(
+                    node.c.id == node_id
+                ).where(
+                    self.nodes.c.lft <= node.c.lft
+                ).where(
+                    self.nodes.c.rgt >= node.c.rgt
+                ).order_by(
+                    self.nodes.c.lft
+                )
+            ).fetchall()
+
+    def get_subtree(self, node_id=None, max_depth=None, connection=None):
+        """
+        Loads a subtree in memory with a single range scan.
+        :param node_id: the id of the top node (None to load all the trees)
+        :param max_depth: the maximum depth relative to the top node (None for no limit)
+        :param connection: a database connection
+        :return: a SubtreeNode (None if the node does not exist) or a list of SubtreeNode roots if node_id is None
+        """
+
+        with self._connect(connection) as connection:
+            stmt = select(
+                [self.nodes.c.id, self.nodes.c.title, self.nodes.c.lft, self.nodes.c.rgt, self.nodes.c.depth]
+            ).order_by(
+                self.nodes.c.lft
+            )
+
+            top_depth = 0
+            if node_id is not None:
+                bounds = self._get_bounds(node_id, connection)
+                if bounds is None:
+                    return None
+
+                top_depth = bounds.depth
+                stmt = stmt.where(self.nodes.c.lft >= bounds.lft).where(self.nodes.c.lft <= bounds.rgt)
+
+            if max_depth is not None:
+                stmt = stmt.where(self.nodes.c.depth <= top_depth + max_depth)
+
+            rows = connection.execute(stmt).fetchall()
+
+        # the enclosing intervals of the current row are kept on a stack
+        top_nodes = []
+        stack = []
+        for row in rows:
+            while stack and stack[-1][0] < row.lft:
+                stack.pop()
+
+            node = SubtreeNode(row.id, row.title, row.depth - top_depth, [])
+            (stack[-1][1].children if stack else top_nodes).append(node)
+            stack.append((row.rgt, node))
+
+        if node_id is None:
+            return top_nodes
+
+        return top_nodes[0] if top_nodes else None
@@ -0,0 +1,169 @@
+"""
+Computes the closure table rows of a large batch of nodes in worker processes.
+
+The batch is split into independent subtrees of bounded size, grouped into jobs. The nodes above them (the top nodes,
+whose subtrees are larger than a job) are handled by the calling process, and every job receives the paths of the top
+nodes its subtrees hang from, so it produces all the rows of its own nodes. The jobs and their results are arrays,
+which are pickled as raw bytes instead of one object for every value.
+"""
+
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# the number of jobs for each worker when the job size is not given, so that uneven jobs still balance out
+JOBS_PER_WORKER = 4
+
+
+def closure_arrays(ids, parents, bases):
+    """
+    Generates the closure table rows of a job, this is what the worker processes run.
+    :param ids: an array of node ids, parents before children
+    :param parents: an array with the index in ids of the parent of every node, or -1 - k for the nodes whose
+    parent is outside of the job and whose ancestors outside of the job are in bases[k]
+    :param bases: a list of (ancestor, depth) lists, where the depths are relative to the parent. bases[0] is empty,
+    for the roots.
+    :return: the ancestor, descendant and depth arrays
+    """
+
+    ancestors, descendants, depths = array('q'), array('q'), array('q')
+
+    for index, node_id in enumerate(ids):
+        current, depth = index, 0
+
+        # walk up to the top of the job
+        while current >= 0:
+            ancestors.append(ids[current])
+            descendants.append(node_id)
+            depths.append(depth)
+            current = parents[current]
+            depth += 1
+
+        # continue with the ancestors outside of the job
+        for ancestor, base_depth in bases[-1 - current]:
+            ancestors.append(ancestor)
+            descendants.append(node_id)
+            depths.append(base_depth + depth)
+
+    return ancestors, descendants, depths
+
+
+def split_batch(ids, parents, job_size):
+    """
+    Splits a batch of nodes into the top nodes and jobs of independent subtrees.
+    :param ids: the node ids, parents before children
+    :param parents: the parent id of every node, -1 for roots
+    :param job_size: the maximum number of nodes of a job, a larger subtree is split below its top node
+    :return: the (ids, parents, bases) arguments of closure_arrays for the top nodes and a list of them for the jobs
+    """
+
+    count = len(ids)
+
+    positions = {}
+    parent_positions = array('q')
+    for position, (node_id, parent_id) in enumerate(zip(ids, parents)):
+        positions[node_id] = position
+        parent_positions.append(-1 if parent_id < 0 else positions[parent_id])
+
+    del positions
+
+    sizes = array('q', [1]) * count
+    for position in range(count - 1, -1, -1):
+        parent = parent_positions[position]
+        if parent >= 0:
+            sizes[parent] += sizes[position]
+
+    top = (array('q'), array('q'), [[]])
+    jobs = []
+
+    # the index of every node in its job, or in the top nodes
+    local = array('q', [0]) * count
+    job_of = array('q', [-1]) * count
+
+    # the paths of the top nodes, as (ancestor, depth) pairs, and their index in the bases of each job
+    chains = {}
+    base_indexes = []
+
+    fill = job_size
+    for position in range(count):
+        parent = parent_positions[position]
+
+        if sizes[position] > job_size:
+            # the parent of a top node is also a top node
+            local[position] = len(top[0])
+            top[0].append(ids[position])
+            top[1].append(-1 if parent < 0 else local[parent])
+            chains[position] = [(ids[position], 0)] + ([] if parent < 0 else
+                                                       [(x, depth + 1) for x, depth in chains[parent]])
+            continue
+
+        if parent < 0 or sizes[parent] > job_size:
+            # the top node of a subtree, which goes to the current job if it still has room
+            if fill + sizes[position] > job_size:
+                jobs.append((array('q'), array('q'), [[]]))
+                base_indexes.append({})
+                fill = 0
+
+            fill += sizes[position]
+            job = len(jobs) - 1
+
+            if parent < 0:
+                local_parent = -1
+            else:
+                if parent not in base_indexes[job]:
+                    base_indexes[job][parent] = len(jobs[job][2])
+                    jobs[job][2].append(chains[parent])
+
+                local_parent = -1 - base_indexes[job][parent]
+        else:
+            job = job_of[parent]
+            local_parent = local[parent]
+
+        job_ids, job_parents, _ = jobs[job]
+        job_of[position] = job
+        local[position] = len(job_ids)
+        job_ids.append(ids[position])
+        job_parents.append(local_parent)
+
+    return top, jobs
+
+
+def parallel_closure_rows(ids, parents, workers, job_size=None):
+    """
+    Generates the closure table rows of a batch of nodes, computed by a pool of worker processes. The results are
+    consumed in order while the next jobs run, and only a few of them are kept waiting, so the memory stays bounded
+    when the rows are consumed slower than they are computed (e.g. written to a database).
+    :param ids: the node ids, parents before children
+    :param parents: the parent id of every node, -1 for roots
+    :param workers: the number of worker processes
+    :param job_size: the maximum number of nodes of a job (None to give a few jobs to every worker)
+    :return: a generator of (ancestor, descendant, depth) tuples
+    """
+
+    if workers < 1:
+        raise Exception('The number of workers must be a positive number.')
+
+    if job_size is None:
+        job_size = max(1000, -(-len(ids) // (workers * JOBS_PER_WORKER)))
+
+    top, jobs = split_batch(ids, parents, job_size)
+    jobs = iter(jobs)
+
+    executor = ProcessPoolExecutor(workers)
+    try:
+        pending = deque(executor.submit(closure_arrays, *job) for job in islice(jobs, 2 * workers))
+
+        # the top nodes are handled while the first jobs run
+        yield from zip(*closure_arrays(*top))
+
+        while pending:
+            result = pending.popleft().result()
+
+            job = next(jobs, None)
+            if job is not None:
+                pending.append(executor.submit(closure_arrays, *job))
+
+            yield from zip(*result)
+    finally:
+        executor.shutdown(cancel_futures=True)
@@ -0,0 +1,170 @@
+import mmap
+import struct
+import sys
+from array import array
+
+# file header: magic, format version and node count
+HEADER = struct.Struct('<8sIQ')
+MAGIC = b'SQLTREE\x00'
+VERSION = 1
+
+
+class Snapshot:
+    """
+    The nodes of a tree in a compact binary form: the ids, the parent ids (-1 for roots) and the titles, with the
+    parents stored before their children.
+
+    The file holds the header, the ids as int64, the parent ids as int64, the title lengths in bytes as int32 (-1 for
+    a None title) and the UTF-8 encoded titles, all little endian.
+    """
+
+    def __init__(self, ids, parents, title_lengths, title_data, source=None, views=()):
+        """
+        Instance initialization.
+        :param ids: a sequence of node ids
+        :param parents: a sequence of parent ids, -1 for roots
+        :param title_lengths: a sequence of title lengths in bytes, -1 for None titles
+        :param title_data: the bytes of all the titles
+        :param source: the memory map holding the data, if any
+        :param views: the memory views on the memory map, released before it is closed
+        """
+
+        self.ids = ids
+        self.parents = parents
+        self.title_lengths = title_lengths
+        self.title_data = title_data
+
+        self._source = source
+        self._views = list(views)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def titles(self):
+        """
+        Decodes the titles.
+        :return: a generator of titles, in the order of the ids
+        """
+
+        offset = 0
+        for length in self.title_lengths:
+            if length < 0:
+                yield None
+            else:
+                yield bytes(self.title_data[offset:offset + length]).decode('utf-8')
+                offset += length
+
+    def close(self):
+        """
+        Releases the memory map, if any. The arrays cannot be used afterwards.
+        """
+
+        if self._source is not None:
+            for view in reversed(self._views):
+                view.release()
+
+            self._source.close()
+            self._source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _little_endian(values):
+    """
+    Converts an array to little endian in place, if needed.
+    :param values: an array
+    :return: the array
+    """
+
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values
+
+
+def write_snapshot(path, nodes):
+    """
+    Writes the nodes of a tree to a file.
+    :param path: the path of the file
+    :param nodes: a list of (id, parent_id, title) tuples with the parents before their children, parent_id is None
+    for roots
+    """
+
+    ids = array('q')
+    parents = array('q')
+    title_lengths = array('i')
+    title_data = []
+
+    for node_id, parent_id, title in nodes:
+        ids.append(node_id)
+        parents.append(-1 if parent_id is None else parent_id)
+
+        if title is None:
+            title_lengths.append(-1)
+        else:
+            data = title.encode('utf-8')
+            title_lengths.append(len(data))
+            title_data.append(data)
+
+    with open(path, 'wb') as handle:
+        handle.write(HEADER.pack(MAGIC, VERSION, len(ids)))
+
+        for values in (ids, parents, title_lengths):
+            _little_endian(values).tofile(handle)
+
+        handle.write(b''.join(title_data))
+
+
+def read_snapshot(path, use_mmap=False):
+    """
+    Reads the nodes of a tree from a file.
+    :param path: the path of the file
+    :param use_mmap: if True, the file is memory mapped instead of being read, so the arrays are views on the file
+    (only on little endian machines)
+    :return: a Snapshot
+    """
+
+    with open(path, 'rb') as handle:
+        if use_mmap and sys.byteorder == 'little':
+            source = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            data = memoryview(source)
+        else:
+            source = None
+            data = memoryview(handle.read())
+
+    if len(data) < HEADER.size:
+        raise Exception('The snapshot is truncated.')
+
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise Exception('The file is not a tree snapshot.')
+
+    if version != VERSION:
+        raise Exception('Unsupported snapshot version: {}.'.format(version))
+
+    offset = HEADER.size
+    columns = []
+    views = [data]
+    for type_code in ('q', 'q', 'i'):
+        size = count * array(type_code).itemsize
+        if offset + size > len(data):
+            raise Exception('The snapshot is truncated.')
+
+        view = data[offset:offset + size]
+        if source is None:
+            column = array(type_code)
+            column.frombytes(view)
+            columns.append(_little_endian(column))
+        else:
+            columns.append(view.cast(type_code))
+            views.extend((view, columns[-1]))
+
+        offset += size
+
+    views.append(data[offset:])
+
+    return Snapshot(columns[0], columns[1], columns[2], views[-1], source, views if source is not None else ())
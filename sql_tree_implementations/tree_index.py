@@ -0,0 +1,552 @@
+from array import array
+from bisect import bisect_left
+from itertools import compress
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the parent of the roots
+NO_PARENT = -1
+
+# above this number of changes, apply_changes replays them on lists of children and rebuilds the pre-order once,
+# instead of renumbering the positions after every change
+REPLAY_LIMIT = 16
+
+# above this number of runs of consecutive slots, apply_delete rebuilds the arrays instead of deleting every run
+MAX_RUNS = 64
+
+
+class TreeIndex:
+    """
+    A read-only mirror of the structure of a tree, kept in compact arrays, which answers ancestry queries without
+    SQL.
+    The nodes are stored in pre-order (an Euler tour where only the entries are kept), so the subtree of a node is
+    the range of positions [tin, tin + size) and checking if a node is an ancestor of another one takes two
+    comparisons. The values of a node are at its slot, the position of its id among the sorted ids, found by binary
+    search. The arrays take 48 bytes per node, however sparse the ids are (e.g. a tree of a forest).
+    """
+
+    def __init__(self):
+        """
+        Instance initialization, with no nodes. Use from_tree or from_parents to build an index.
+        """
+
+        # the node ids in ascending order, the other arrays but the pre-order are indexed by slot
+        self.ids = array('q')
+
+        self.parent = array('q')
+        self.depth = array('q')
+        self.tin = array('q')
+        self.size = array('q')
+
+        # the node ids in pre-order
+        self.order = array('q')
+
+    @classmethod
+    def from_tree(cls, tree, connection=None):
+        """
+        Builds the index of all the trees stored by a tree object, loading them with a single get_subtree call.
+        :param tree: a GenericTree
+        :param connection: a database connection
+        :return: the TreeIndex
+        """
+
+        index = cls()
+        index.reload(tree, connection)
+
+        return index
+
+    @classmethod
+    def from_parents(cls, parents):
+        """
+        Builds an index from the parent of every node, where siblings are ordered by id.
+        :param parents: a dict mapping each node id to the id of its parent (None for roots)
+        :return: the TreeIndex
+        """
+
+        children = {}
+        for node_id in sorted(parents):
+            children.setdefault(parents[node_id], []).append(node_id)
+
+        def walk():
+            stack = [(x, NO_PARENT, 0) for x in reversed(children.get(None, []))]
+
+            while stack:
+                node_id, parent_id, depth = stack.pop()
+
+                yield node_id, parent_id, depth
+                stack.extend((x, node_id, depth + 1) for x in reversed(children.get(node_id, [])))
+
+        index = cls()
+        index._build(walk())
+
+        if len(index) != len(parents):
+            raise Exception('The parents contain a cycle or a missing node.')
+
+        return index
+
+    def reload(self, tree, connection=None):
+        """
+        Replaces the content of the index with all the trees stored by a tree object.
+        :param tree: a GenericTree
+        :param connection: a database connection
+        """
+
+        def walk():
+            for top_node in tree.get_subtree(connection=connection):
+                stack = [(top_node, NO_PARENT, 0)]
+
+                while stack:
+                    node, parent_id, depth = stack.pop()
+
+                    yield node.id, parent_id, depth
+                    stack.extend((child, node.id, depth + 1) for child in reversed(node.children))
+
+        self._build(walk())
+
+    def _build(self, entries):
+        """
+        Replaces the content of the index with nodes given in pre-order.
+        :param entries: an iterable of (node_id, parent_id, depth) tuples in pre-order, with NO_PARENT for roots
+        """
+
+        order = array('q')
+        parents = array('q')
+        depths = array('q')
+
+        for node_id, parent_id, depth in entries:
+            order.append(node_id)
+            parents.append(parent_id)
+            depths.append(depth)
+
+        # a subtree ends at the next position with the same or a lower depth, found with a stack of the positions
+        # that can still end the subtrees before them
+        sizes = array('q', [1]) * len(order)
+        stack = []
+
+        for position in range(len(order) - 1, -1, -1):
+            depth = depths[position]
+            while stack and depths[stack[-1]] > depth:
+                stack.pop()
+
+            sizes[position] = (stack[-1] if stack else len(order)) - position
+            stack.append(position)
+
+        # the positions in pre-order, sorted by id, which are the tin of the slots
+        tin = sorted(range(len(order)), key=order.__getitem__)
+
+        self.ids = array('q', (order[x] for x in tin))
+        self.parent = array('q', (parents[x] for x in tin))
+        self.depth = array('q', (depths[x] for x in tin))
+        self.tin = array('q', tin)
+        self.size = array('q', (sizes[x] for x in tin))
+        self.order = order
+
+    def _slot(self, node_id):
+        """
+        Finds the slot of a node.
+        :param node_id: the id of the node
+        :return: the slot, or -1 if the node does not exist
+        """
+
+        slot = bisect_left(self.ids, node_id)
+        if slot < len(self.ids) and self.ids[slot] == node_id:
+            return slot
+
+        return -1
+
+    def _renumber(self, start, end=None):
+        """
+        Updates the pre-order positions of the nodes in a range of positions.
+        :param start: the first position
+        :param end: the position after the last one (None for the end of the pre-order)
+        """
+
+        ids = self.ids
+        order = self.order
+        tin = self.tin
+
+        if end is None:
+            end = len(order)
+
+        if numpy is not None and end > start:
+            slots = numpy.searchsorted(numpy.frombuffer(ids, dtype=numpy.int64),
+                                       numpy.frombuffer(order, dtype=numpy.int64)[start:end])
+            numpy.frombuffer(tin, dtype=numpy.int64)[slots] = numpy.arange(start, end)
+            return
+
+        for position in range(start, end):
+            tin[bisect_left(ids, order[position])] = position
+
+    def _ancestors(self, node_id):
+        """
+        Iterates over the ancestors of a node, from its parent to the root.
+        :param node_id: the id of the node
+        :return: a generator of ids
+        """
+
+        parent_id = self.parent[self._slot(node_id)]
+        while parent_id != NO_PARENT:
+            yield parent_id
+            parent_id = self.parent[self._slot(parent_id)]
+
+    def _check(self, node_id, message='Node does not exist.'):
+        """
+        Finds the slot of a node that must exist.
+        :param node_id: the id of the node
+        :param message: the message of the exception raised if the node does not exist
+        :return: the slot
+        """
+
+        slot = self._slot(node_id)
+        if slot < 0:
+            raise Exception(message)
+
+        return slot
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, node_id):
+        return self._slot(node_id) >= 0
+
+    def get_parent(self, node_id):
+        """
+        Returns the parent of a node.
+        :param node_id: the id of the node
+        :return: the id of the parent, or None for a root
+        """
+
+        parent_id = self.parent[self._check(node_id)]
+
+        return None if parent_id == NO_PARENT else parent_id
+
+    def get_depth(self, node_id):
+        """
+        Returns the depth of a node (0 for roots).
+        :param node_id: the id of the node
+        :return: the depth
+        """
+
+        return self.depth[self._check(node_id)]
+
+    def get_roots(self):
+        """
+        Returns the root nodes, in pre-order.
+        :return: a list of ids
+        """
+
+        roots = []
+        position = 0
+        while position < len(self.order):
+            roots.append(self.order[position])
+            position += self.size[self._slot(self.order[position])]
+
+        return roots
+
+    def is_ancestor(self, ancestor_id, descendant_id, include_self=False):
+        """
+        Checks if a node is an ancestor of another one, in O(log n).
+        :param ancestor_id: the id of the ancestor
+        :param descendant_id: the id of the descendant
+        :param include_self: if True, a node is considered an ancestor of itself
+        :return: True or False, also False if one of the nodes does not exist
+        """
+
+        ancestor = self._slot(ancestor_id)
+        descendant = self._slot(descendant_id)
+        if ancestor < 0 or descendant < 0:
+            return False
+
+        if ancestor == descendant:
+            return include_self
+
+        tin = self.tin[ancestor]
+
+        return tin <= self.tin[descendant] < tin + self.size[ancestor]
+
+    def is_ancestor_many(self, pairs, include_self=False):
+        """
+        Checks many (ancestor, descendant) pairs at once, with vectorized operations when NumPy is installed.
+        :param pairs: a list of (ancestor_id, descendant_id) pairs
+        :param include_self: if True, a node is considered an ancestor of itself
+        :return: a list of booleans
+        """
+
+        if numpy is None or not pairs or not self.ids:
+            return [self.is_ancestor(a, d, include_self) for a, d in pairs]
+
+        ancestor_ids, descendant_ids = numpy.array(pairs, dtype=numpy.int64).reshape(-1, 2).T
+        ids = numpy.frombuffer(self.ids, dtype=numpy.int64)
+        tin = numpy.frombuffer(self.tin, dtype=numpy.int64)
+        size = numpy.frombuffer(self.size, dtype=numpy.int64)
+
+        # the unknown ids get the last slot, and the pairs where they appear are discarded
+        ancestors = numpy.minimum(numpy.searchsorted(ids, ancestor_ids), len(ids) - 1)
+        descendants = numpy.minimum(numpy.searchsorted(ids, descendant_ids), len(ids) - 1)
+        known = (ids[ancestors] == ancestor_ids) & (ids[descendants] == descendant_ids)
+
+        result = known & (tin[ancestors] <= tin[descendants]) & (tin[descendants] < tin[ancestors] + size[ancestors])
+        if not include_self:
+            result &= ancestors != descendants
+
+        return result.tolist()
+
+    def get_path(self, node_id):
+        """
+        Returns the ancestors of a node, in O(depth log n).
+        :param node_id: the id of the node
+        :return: a list of ids from the root to the node itself
+        """
+
+        self._check(node_id)
+
+        path = [node_id]
+        path.extend(self._ancestors(node_id))
+        path.reverse()
+
+        return path
+
+    def get_subtree(self, node_id):
+        """
+        Returns the nodes of a subtree, a slice of the pre-order.
+        :param node_id: the id of the top node
+        :return: an array with the ids of the node and its descendants, in pre-order
+        """
+
+        slot = self._check(node_id)
+        tin = self.tin[slot]
+
+        return self.order[tin:tin + self.size[slot]]
+
+    def subtree_size(self, node_id):
+        """
+        Returns the number of nodes of a subtree, including its top node.
+        :param node_id: the id of the top node
+        :return: the size
+        """
+
+        return self.size[self._check(node_id)]
+
+    def apply_add(self, node_id, parent_id=None):
+        """
+        Adds a new leaf, to mirror add_node. The node is placed after the last descendant of its parent, and the
+        positions after it are renumbered, which takes O(n log n).
+        :param node_id: the id of the new node
+        :param parent_id: the id of its parent (None for a root)
+        """
+
+        if node_id in self:
+            raise Exception('Node {} already exists.'.format(node_id))
+
+        position = len(self.order)
+        depth = 0
+        if parent_id is not None:
+            parent = self._check(parent_id, 'Parent node does not exist.')
+            position = self.tin[parent] + self.size[parent]
+            depth = self.depth[parent] + 1
+
+            for ancestor_id in self.get_path(parent_id):
+                self.size[self._slot(ancestor_id)] += 1
+
+        slot = bisect_left(self.ids, node_id)
+        self.ids.insert(slot, node_id)
+        self.parent.insert(slot, NO_PARENT if parent_id is None else parent_id)
+        self.depth.insert(slot, depth)
+        self.tin.insert(slot, position)
+        self.size.insert(slot, 1)
+
+        self.order.insert(position, node_id)
+        self._renumber(position)
+
+    def apply_move(self, node_id, new_parent_id):
+        """
+        Moves a subtree, to mirror move_node. Only the positions between the old and the new place of the subtree
+        are updated.
+        :param node_id: the id of the top node of the subtree
+        :param new_parent_id: the id of the new parent (None to make the node a root)
+        """
+
+        slot = self._check(node_id)
+
+        if new_parent_id is not None:
+            new_parent = self._check(new_parent_id, 'Parent node does not exist.')
+
+            if self.is_ancestor(node_id, new_parent_id, include_self=True):
+                raise Exception('A node cannot be moved under its own subtree.')
+
+        start = self.tin[slot]
+        size = self.size[slot]
+        block = self.order[start:start + size]
+
+        for ancestor_id in self._ancestors(node_id):
+            self.size[self._slot(ancestor_id)] -= size
+
+        del self.order[start:start + size]
+
+        if new_parent_id is None:
+            position = len(self.order)
+            depth_change = -self.depth[slot]
+        else:
+            parent_tin = self.tin[new_parent]
+            if parent_tin >= start + size:
+                parent_tin -= size
+
+            position = parent_tin + self.size[new_parent]
+            depth_change = self.depth[new_parent] + 1 - self.depth[slot]
+
+            for ancestor_id in self.get_path(new_parent_id):
+                self.size[self._slot(ancestor_id)] += size
+
+        self.order[position:position] = block
+        self.parent[slot] = NO_PARENT if new_parent_id is None else new_parent_id
+
+        if depth_change:
+            for x in block:
+                self.depth[self._slot(x)] += depth_change
+
+        self._renumber(min(start, position), max(start, position) + size)
+
+    def apply_delete(self, node_id):
+        """
+        Removes a subtree, to mirror delete_node. The positions after it are renumbered, which takes O(n log n).
+        :param node_id: the id of the top node of the subtree
+        """
+
+        slot = self._slot(node_id)
+        if slot < 0:
+            return
+
+        start = self.tin[slot]
+        size = self.size[slot]
+
+        for ancestor_id in self._ancestors(node_id):
+            self.size[self._slot(ancestor_id)] -= size
+
+        # the slots of the subtree are removed from every array, by runs of consecutive slots, or all at once when
+        # there are too many runs
+        runs = []
+        for x in sorted(self._slot(x) for x in self.order[start:start + size]):
+            if runs and runs[-1][1] == x:
+                runs[-1][1] = x + 1
+            else:
+                runs.append([x, x + 1])
+
+        keep = None
+        if len(runs) > MAX_RUNS:
+            keep = bytearray(b'\x01') * len(self.ids)
+            for first, end in runs:
+                keep[first:end] = bytes(end - first)
+
+        for name in ('ids', 'parent', 'depth', 'tin', 'size'):
+            if keep is not None:
+                setattr(self, name, array('q', compress(getattr(self, name), keep)))
+                continue
+
+            values = getattr(self, name)
+            for first, end in reversed(runs):
+                del values[first:end]
+
+        del self.order[start:start + size]
+        self._renumber(start)
+
+    def apply_changes(self, changes):
+        """
+        Replays the entries of a change log (see ClosureTree.changes_since), to follow the changes made by other
+        processes. A short log is applied change by change, a longer one is replayed in O(n log n + changes). The index
+        must be reloaded instead when the log holds a reset.
+        :param changes: a list of Change rows, in version order, that follow the state of the index
+        """
+
+        if any(x.operation == 'reset' for x in changes):
+            raise Exception('The tree was rewritten, the index must be reloaded.')
+
+        if len(changes) > REPLAY_LIMIT:
+            self._replay(changes)
+            return
+
+        for change in changes:
+            if change.operation == 'add':
+                self.apply_add(change.node_id, change.parent_id)
+            elif change.operation in ('move', 'attach'):
+                self.apply_move(change.node_id, change.parent_id)
+            elif change.operation == 'detach':
+                self.apply_move(change.node_id, None)
+            elif change.operation == 'delete':
+                self.apply_delete(change.node_id)
+            else:
+                raise Exception('Unknown change: {}.'.format(change.operation))
+
+    def _replay(self, changes):
+        """
+        Applies many changes at once: they are replayed on the lists of children of the nodes, then the pre-order is
+        rebuilt. The index is left unchanged if a change is invalid.
+        :param changes: a list of Change rows, without resets
+        """
+
+        # the children of every node in their order, as dicts so that a node is removed in constant time
+        children = {NO_PARENT: {}}
+        for node_id in self.order:
+            children[node_id] = {}
+            children[self.parent[self._slot(node_id)]][node_id] = None
+
+        # the parents that changed, written to the arrays once all the changes are valid
+        parents = {}
+
+        def parent_of(node_id):
+            return parents[node_id] if node_id in parents else self.parent[self._slot(node_id)]
+
+        for change in changes:
+            node_id = change.node_id
+            parent_id = NO_PARENT if change.parent_id is None or change.operation == 'detach' else change.parent_id
+
+            if change.operation == 'delete':
+                if node_id not in children:
+                    continue
+
+                del children[parent_of(node_id)][node_id]
+                stack = [node_id]
+                while stack:
+                    stack.extend(children.pop(stack.pop()))
+
+                continue
+
+            if change.operation == 'add':
+                if node_id in children:
+                    raise Exception('Node {} already exists.'.format(node_id))
+            elif change.operation in ('move', 'attach', 'detach'):
+                if node_id not in children:
+                    raise Exception('Node does not exist.')
+            else:
+                raise Exception('Unknown change: {}.'.format(change.operation))
+
+            if parent_id != NO_PARENT:
+                if parent_id not in children:
+                    raise Exception('Parent node does not exist.')
+
+                ancestor_id = parent_id
+                while ancestor_id != NO_PARENT:
+                    if ancestor_id == node_id:
+                        raise Exception('A node cannot be moved under its own subtree.')
+                    ancestor_id = parent_of(ancestor_id)
+
+            if change.operation == 'add':
+                children[node_id] = {}
+            else:
+                del children[parent_of(node_id)][node_id]
+
+            parents[node_id] = parent_id
+            children[parent_id][node_id] = None
+
+        def walk():
+            stack = [(x, NO_PARENT, 0) for x in reversed(children[NO_PARENT])]
+
+            while stack:
+                node_id, parent_id, depth = stack.pop()
+
+                yield node_id, parent_id, depth
+                stack.extend((x, node_id, depth + 1) for x in reversed(children[node_id]))
+
+        self._build(walk())
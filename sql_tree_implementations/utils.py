@@ -0,0 +1,47 @@
+from itertools import islice
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most `size` elements.
+    :param iterable: the iterable to be split
+    :param size: the maximum size of a chunk
+    :return: a generator of lists
+    """
+
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def topological_order(parents):
+    """
+    Orders the keys of a parent mapping so that every parent comes before its children.
+    Siblings keep the order in which they appear in the mapping.
+    :param parents: a dict mapping each key to the key of its parent (None for top level keys)
+    :return: a list of keys
+    """
+
+    order = []
+    children = {}
+
+    for key, parent_key in parents.items():
+        if parent_key is None:
+            order.append(key)
+        elif parent_key not in parents:
+            raise Exception('Parent node does not exist.')
+        else:
+            children.setdefault(parent_key, []).append(key)
+
+    index = 0
+    while index < len(order):
+        order.extend(children.pop(order[index], ()))
+        index += 1
+
+    if len(order) != len(parents):
+        raise Exception('The edges contain a cycle.')
+
+    return order
@@ -0,0 +1,90 @@
+import unittest
+
+from sql_tree_implementations.adjacency_list import AdjacencyTree
+
+
+class AdjacencyTest(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create this structure:
+        tree 1:
+                  A
+              /   |  \\
+             B    C   F
+           /  \\       |
+          D   E       G
+
+        tree 2:
+          X
+        """
+
+        self.a_tree = AdjacencyTree()
+        self.a_tree.add_node('A')
+        self.a_tree.add_node('B', 'A', True)
+        self.a_tree.add_node('C', 'A', True)
+        self.a_tree.add_node('D', 'B', True)
+        self.a_tree.add_node('E', 'B', True)
+        self.a_tree.add_node('F', 'A', True)
+        self.a_tree.add_node('G', 'F', True)
+        self.a_tree.add_node('X')
+        self.a_tree.add_node('Y', 'X', True)
+        self.a_tree.add_node('Z', 'Y', True)
+        self.a_tree.add_node('W', 'X', True)
+
+    def _path(self, title):
+        return [x.title for x in self.a_tree.get_path(self.a_tree.get_first_id(title))]
+
+    def _children(self, title):
+        return [x.title for x in self.a_tree.get_descendants(self.a_tree.get_first_id(title))]
+
+    def test_reads(self):
+        """
+        Test for the read operations.
+        """
+
+        self.a_tree.view_tree()
+
+        self.assertEqual(self._path('E'), ['A', 'B', 'E'])
+        self.assertEqual([x.depth for x in self.a_tree.get_path(self.a_tree.get_first_id('E'))], [2, 1, 0])
+        self.assertEqual(self._children('A'), ['B', 'C', 'F'])
+        self.assertEqual([x.title for x in self.a_tree.get_roots()], ['A', 'X'])
+        self.assertTrue(self.a_tree.is_root(self.a_tree.get_first_id('X')))
+        self.assertFalse(self.a_tree.is_root(self.a_tree.get_first_id('Z')))
+
+        a_tree = self.a_tree.get_subtree(self.a_tree.get_first_id('A'), max_depth=1)
+        self.assertEqual([(x.title, x.depth, len(x.children)) for x in a_tree.children],
+                         [('B', 1, 0), ('C', 1, 0), ('F', 1, 0)])
+        self.assertEqual(len(self.a_tree.get_subtree()), 2)
+
+    def test_shared_tables(self):
+        """
+        Test that the trees with the same options share their table definitions.
+        """
+
+        other_tree = AdjacencyTree(engine=self.a_tree.engine)
+        self.assertIs(other_tree.nodes, self.a_tree.nodes)
+        self.assertIsNot(AdjacencyTree(title_index=True).nodes, self.a_tree.nodes)
+        self.assertEqual([x.title for x in other_tree.get_roots()], ['A', 'X'])
+
+    def test_move_and_delete(self):
+        """
+        Test for the operations that change the structure.
+        """
+
+        self.a_tree.move_node(self.a_tree.get_first_id('B'), self.a_tree.get_first_id('C'))
+        self.assertEqual(self._path('D'), ['A', 'C', 'B', 'D'])
+        self.assertEqual(self._children('A'), ['C', 'F'])
+
+        self.a_tree.move_node(self.a_tree.get_first_id('Y'), None)
+        self.assertEqual(self._path('Z'), ['Y', 'Z'])
+
+        with self.assertRaises(Exception):
+            self.a_tree.move_node(self.a_tree.get_first_id('A'), self.a_tree.get_first_id('D'))
+
+        with self.assertRaises(Exception):
+            self.a_tree.move_node(self.a_tree.get_first_id('A'), 100)
+
+        self.a_tree.delete_node(self.a_tree.get_first_id('C'))
+        self.assertEqual(self.a_tree.node_count(), 7)
+        self.assertIsNone(self.a_tree.get_first_id('E'))
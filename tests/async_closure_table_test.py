@@ -0,0 +1,154 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from sql_tree_implementations import AsyncClosureTree, ClosureTree
+from sql_tree_implementations.async_generic_tree import _sessions
+
+
+class AsyncClosureTest(unittest.TestCase):
+
+    def _run(self, coroutine):
+        return asyncio.run(coroutine)
+
+    async def _create_tree(self, tree):
+        """
+        Create the same structure as in ClosureTest.
+        """
+
+        await tree.add_subtree([
+            ('A', [('B', ['D', 'E']), 'C', ('F', ['G'])]),
+            ('X', [('Y', ['Z']), 'W'])
+        ])
+
+    def test_operations(self):
+        """
+        Test that the async tree returns the same results as the sync one.
+        """
+
+        async def check():
+            tree = AsyncClosureTree(log_changes=True)
+            await self._create_tree(tree)
+            version = await tree.change_version()
+
+            a_id = await tree.get_first_id('A')
+            h_id = await tree.add_node('H', 'G', True)
+            self.assertEqual([x.title for x in await tree.get_path(h_id)], ['A', 'F', 'G', 'H'])
+            self.assertEqual(sorted(x.title for x in await tree.get_descendants(a_id)), ['B', 'C', 'F'])
+            self.assertEqual(sorted(x.title for x in await tree.get_roots()), ['A', 'X'])
+            self.assertEqual(await tree.node_count(), 12)
+
+            # moves are validated
+            with self.assertRaisesRegex(Exception, 'own subtree'):
+                await tree.move_node(a_id, h_id)
+
+            await tree.move_node(await tree.get_first_id('F'), await tree.get_first_id('Z'))
+            self.assertEqual([x.title for x in await tree.get_path(h_id)], ['X', 'Y', 'Z', 'F', 'G', 'H'])
+
+            await tree.move_node(await tree.get_first_id('Y'), None)
+            self.assertTrue(await tree.is_root(await tree.get_first_id('Y')))
+            self.assertEqual([x.title async for x in tree.iter_descendants(a_id, batch_size=2)], ['B', 'C', 'D', 'E'])
+
+            b_id = await tree.get_first_id('B')
+            await tree.delete_node(b_id)
+            self.assertIsNone(await tree.get_subtree(b_id))
+
+            subtree = await tree.get_subtree(await tree.get_first_id('Y'), max_depth=2)
+            self.assertEqual([x.title for x in subtree.children], ['Z'])
+            self.assertEqual([x.title for x in subtree.children[0].children], ['F'])
+
+            self.assertEqual(version, 11)
+            changes = await tree.changes_since(version)
+            self.assertEqual([x.operation for x in changes], ['add', 'move', 'move', 'delete'])
+
+            await tree.dispose()
+
+        self._run(check())
+
+    def test_session(self):
+        """
+        Test that the operations inside a session share one transaction.
+        """
+
+        async def check():
+            tree = AsyncClosureTree()
+            await self._create_tree(tree)
+
+            with self.assertRaises(ZeroDivisionError):
+                async with tree.session() as conn:
+                    await tree.add_node('H', 'A', True)
+
+                    async with tree.session() as inner_conn:
+                        self.assertIs(conn, inner_conn)
+
+                    1 / 0
+
+            self.assertIsNone(await tree.get_first_id('H'))
+            self.assertEqual(await tree.node_count(), 11)
+
+            # the session belongs to its tree, it is seen by the tasks started inside it and ends with its block
+            other_tree = AsyncClosureTree(engine=tree.engine)
+            async with tree.session() as conn:
+                self.assertEqual(dict(_sessions.get()), {tree: conn})
+                self.assertEqual(await asyncio.create_task(tree.node_count()), 11)
+
+            self.assertEqual(dict(_sessions.get()), {})
+            self.assertEqual(await other_tree.node_count(), 11)
+            await tree.dispose()
+
+            # the tables are also created when the first operation runs on a connection given by the caller
+            tree = AsyncClosureTree()
+            async with tree.engine.begin() as conn:
+                self.assertEqual(await tree.get_roots(connection=conn), [])
+                self.assertIsNone(await tree.get_first_id('A', connection=conn))
+
+            await tree.dispose()
+
+        self._run(check())
+
+    def test_concurrent_reads(self):
+        """
+        Test the batched reads on a file database, where each chunk is read on its own connection.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        async def check():
+            tree = AsyncClosureTree('sqlite+aiosqlite:///{}'.format(file_name))
+            await self._create_tree(tree)
+            self.assertTrue(tree._concurrent())
+
+            node_ids = list(range(1, 13))
+            paths = await tree.get_paths(node_ids, chunk_size=3)
+            roots = await tree.are_roots(node_ids, chunk_size=3)
+            nodes = await tree.get_nodes(node_ids, chunk_size=3)
+
+            pairs = [(a, d) for a in node_ids for d in node_ids]
+            ancestry = await tree.is_ancestor_many(pairs, chunk_size=20)
+            self.assertEqual(ancestry, [a in [x.ancestor for x in paths[d]] and a != d for a, d in pairs])
+            self.assertTrue(await tree.is_ancestor(1, 3))
+            self.assertEqual(await tree.lca([3, 1]), 1)
+
+            async with tree.session():
+                self.assertFalse(tree._concurrent())
+                self.assertEqual(await tree.get_paths(node_ids, chunk_size=3), paths)
+
+            await tree.dispose()
+            return paths, roots, nodes
+
+        paths, roots, nodes = self._run(check())
+
+        # the data matches the one read by the sync tree
+        sync_tree = ClosureTree('sqlite:///{}'.format(file_name))
+        self.assertEqual(paths, sync_tree.get_paths(range(1, 13)))
+        self.assertEqual(roots, sync_tree.are_roots(range(1, 13)))
+        self.assertIsNone(nodes[12])
+        self.assertEqual(nodes[11].title, sync_tree.get_node(11).title)
+        sync_tree.engine.dispose()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import json
+import unittest
+from random import Random
+
+from benchmarks import BACKENDS, OPERATIONS, SHAPES, run, compare, run_scaling
+
+
+class BenchmarksTest(unittest.TestCase):
+
+    def test_shapes(self):
+        """
+        Test that every shape has the requested size and valid parents.
+        """
+
+        for name, shape in SHAPES.items():
+            parents = shape(500, Random(0))
+
+            self.assertEqual(len(parents), 500, name)
+            self.assertIsNone(parents[0], name)
+            self.assertTrue(all(x is not None and x < index for index, x in enumerate(parents) if index), name)
+
+    def test_run(self):
+        """
+        Runs a tiny benchmark for every backend and compares it with itself.
+        """
+
+        results = run(sorted(BACKENDS), ['skewed'], [50], ops=5, report=None)
+        results = json.loads(json.dumps(results))
+
+        self.assertEqual(len(results['results']), len(BACKENDS) * (len(OPERATIONS) + 1))
+        self.assertTrue(all(x['count'] == 5 for x in results['results'] if x['operation'] != 'load'))
+        self.assertEqual(compare(results, results), [])
+
+    def test_scaling(self):
+        """
+        Runs a tiny scaling benchmark of the parallel build.
+        """
+
+        results = run_scaling('skewed', 200, [1, 2], report=None)['results']
+
+        self.assertEqual([x['workers'] for x in results], [0, 1, 2])
+        self.assertEqual(results[0]['speedup'], 1.0)
+        self.assertTrue(all(x['seconds'] > 0 for x in results))
@@ -1,8 +1,16 @@
+import os
+import tempfile
+import threading
 import unittest
 from random import randint
 from timeit import Timer
 
-from sql_tree_implementations import ClosureTree
+from sqlalchemy import event, inspect
+from sqlalchemy.pool import QueuePool
+
+from sql_tree_implementations import ClosureTree, TreeIndex
+from sql_tree_implementations.closure_table import SubtreeStats
+from sql_tree_implementations.snapshot import read_snapshot
 
 
 class ClosureTest(unittest.TestCase):
@@ -118,3 +126,893 @@ class ClosureTest(unittest.TestCase):
         t1_2 = self._timed_move(tree, moving_node_id, parent_node_id)
 
         print('Standard: moved node:\n\t-> {}\n\t<- {}'.format(t1_1, t1_2))
+
+    def test_add_subtree(self):
+        """
+        Test for adding a nested structure under an existing node.
+        """
+
+        ids = self.c_tree.add_subtree([('H', ['I', ('J', ['K'])]), 'L'], parent='G', by_title=True)
+
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(self.c_tree.node_count(), 16)
+        self.assertEqual([x.title for x in self.c_tree.get_path(ids[3])], ['A', 'F', 'G', 'H', 'J', 'K'])
+        self.assertEqual(sorted(x.title for x in self.c_tree.get_descendants(self.c_tree.get_first_id('G'))),
+                         ['H', 'L'])
+
+        # a single node can still be added after a bulk import
+        m_id = self.c_tree.add_node('M', ids[3])
+        self.assertEqual([x.title for x in self.c_tree.get_path(m_id)], ['A', 'F', 'G', 'H', 'J', 'K', 'M'])
+
+    def test_add_edges_errors(self):
+        """
+        Test that invalid edge lists are rejected without storing anything.
+        """
+
+        with self.assertRaises(Exception):
+            self.c_tree.add_edges([(1, 2, 'a'), (2, 1, 'b')])
+
+        with self.assertRaises(Exception):
+            self.c_tree.add_edges([(1, None, 'a'), (2, 3, 'b')])
+
+        with self.assertRaises(Exception):
+            self.c_tree.add_edges([(1, None, 'a')], parent='missing', by_title=True)
+
+        self.assertEqual(self.c_tree.node_count(), 11)
+
+    def _generate_edges(self, edges, key=None, max_depth=5, depth=0, branch_size=5):
+        """
+        Create a random edge list recursively, with the same shape as the trees built by _generate_tree.
+        :param edges: the list to which the edges will be appended
+        :param key: the key of the parent node
+        :param max_depth: the maximum absolute depth that will be reached
+        :param depth: the current depth
+        :param branch_size: the maximum number of children that can be generated for any node
+        """
+
+        if key is None:
+            key = len(edges)
+            edges.append((key, None, 'root'))
+
+        if depth < max_depth:
+            for _ in range(randint(2, branch_size)):
+                child_key = len(edges)
+                edges.append((child_key, key, 'x'))
+                self._generate_edges(edges, child_key, max_depth, depth=depth + 1, branch_size=branch_size)
+
+    def test_bulk_import(self):
+        """
+        Compares the bulk import with adding the same nodes one by one.
+        """
+
+        print('=========================')
+
+        edges = []
+        self._generate_edges(edges, max_depth=4, branch_size=5)
+
+        per_node_tree = ClosureTree()
+        per_node_ids = {}
+
+        def add_one_by_one():
+            for key, parent_key, title in edges:
+                per_node_ids[key] = per_node_tree.add_node(title, per_node_ids.get(parent_key))
+
+        bulk_tree = ClosureTree()
+        bulk_ids = {}
+
+        t_per_node = Timer(add_one_by_one).timeit(1)
+        t_bulk = Timer(lambda: bulk_ids.update(bulk_tree.add_edges(edges))).timeit(1)
+
+        print('Bulk import for {} nodes:\n\tper node: {}\n\tbulk: {}'.format(len(edges), t_per_node, t_bulk))
+
+        # both trees must contain the same paths between the same keys
+        def keyed_paths(tree, ids):
+            keys = {node_id: key for key, node_id in ids.items()}
+            with tree.engine.connect() as connection:
+                return sorted((keys[row.ancestor], keys[row.descendant], row.depth)
+                              for row in connection.execute(tree.paths.select()))
+
+        self.assertEqual(per_node_tree.node_count(), bulk_tree.node_count())
+        self.assertEqual(keyed_paths(per_node_tree, per_node_ids), keyed_paths(bulk_tree, bulk_ids))
+
+    def test_session(self):
+        """
+        Test that the operations inside a session share one transaction.
+        """
+
+        with self.c_tree.session() as conn:
+            b_id = self.c_tree.add_node('B2', 'A', True)
+            self.c_tree.move_node(self.c_tree.get_first_id('D'), b_id)
+
+            with self.c_tree.session() as inner_conn:
+                self.assertIs(conn, inner_conn)
+
+        self.assertEqual([x.title for x in self.c_tree.get_path(self.c_tree.get_first_id('D'))], ['A', 'B2', 'D'])
+
+        # everything is rolled back if the session fails
+        with self.assertRaises(ZeroDivisionError):
+            with self.c_tree.session():
+                self.c_tree.add_node('H', 'A', True)
+                self.c_tree.delete_node(self.c_tree.get_first_id('X'))
+                1 / 0
+
+        self.assertIsNone(self.c_tree.get_first_id('H'))
+        self.assertEqual(self.c_tree.node_count(), 12)
+        self.assertEqual(len(self.c_tree.get_descendants(self.c_tree.get_first_id('X'))), 2)
+
+    def test_file_database(self):
+        """
+        Test a tree stored in a file, using a connection pool.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        url = 'sqlite:///{}'.format(file_name)
+        tree = ClosureTree(url, poolclass=QueuePool, pool_size=2)
+
+        with tree.session():
+            tree.add_subtree([('A', ['B', 'C'])])
+            tree.add_node('D', 'B', True)
+
+        tree.engine.dispose()
+
+        # the data is visible from another instance
+        other_tree = ClosureTree(url)
+        self.assertEqual([x.title for x in other_tree.get_path(other_tree.get_first_id('D'))], ['A', 'B', 'D'])
+        self.assertEqual(tree.engine.pool.checkedout(), 0)
+        other_tree.engine.dispose()
+
+    def test_concurrent_add_edges(self):
+        """
+        Test that two writers adding batches of nodes at the same time get different ids.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        tree = ClosureTree('sqlite:///{}'.format(file_name))
+        other_tree = ClosureTree('sqlite:///{}'.format(file_name))
+        self.addCleanup(tree.engine.dispose)
+        self.addCleanup(other_tree.engine.dispose)
+        tree.add_node('A')
+
+        results = []
+
+        def add():
+            try:
+                results.append(other_tree.add_edges([(1, None, 'Y'), (2, 1, 'Z')]))
+            except Exception as e:
+                results.append(e)
+
+        with tree.session():
+            ids = tree.add_edges([(1, None, 'B'), (2, 1, 'C')], parent='A', by_title=True)
+
+            # the other writer waits for the commit of this one
+            thread = threading.Thread(target=add)
+            thread.start()
+            thread.join(0.2)
+
+        thread.join()
+
+        self.assertEqual(len(results), 1)
+        self.assertIsInstance(results[0], dict)
+        self.assertFalse(set(ids.values()) & set(results[0].values()))
+        self.assertEqual(tree.node_count(), 5)
+        self.assertTrue(tree.verify()['valid'])
+
+    def _titles(self, node):
+        """
+        Converts a subtree to nested (title, children) tuples.
+        :param node: a SubtreeNode
+        :return: a (title, children) tuple
+        """
+
+        return node.title, [self._titles(child) for child in node.children]
+
+    def test_get_subtree(self):
+        """
+        Test for loading subtrees in memory.
+        """
+
+        a_tree = self.c_tree.get_subtree(self.c_tree.get_first_id('A'))
+        self.assertEqual(self._titles(a_tree), ('A', [('B', [('D', []), ('E', [])]), ('C', []), ('F', [('G', [])])]))
+        self.assertEqual(a_tree.children[0].children[0].depth, 2)
+
+        b_tree = self.c_tree.get_subtree(self.c_tree.get_first_id('B'), max_depth=0)
+        self.assertEqual(self._titles(b_tree), ('B', []))
+
+        roots = self.c_tree.get_subtree(max_depth=1)
+        self.assertEqual([self._titles(x) for x in roots],
+                         [('A', [('B', []), ('C', []), ('F', [])]), ('X', [('Y', []), ('W', [])])])
+
+        self.assertIsNone(self.c_tree.get_subtree(100))
+
+    def test_iter_descendants(self):
+        """
+        Test for streaming the descendants of a node in batches.
+        """
+
+        a_id = self.c_tree.get_first_id('A')
+
+        rows = list(self.c_tree.iter_descendants(a_id, batch_size=2))
+        self.assertEqual([x.title for x in rows], ['B', 'C', 'F', 'D', 'E', 'G'])
+        self.assertEqual([x.depth for x in rows], [1, 1, 1, 2, 2, 2])
+
+        # resume after the third row
+        cursor = rows[2].depth, rows[2].descendant
+        self.assertEqual([x.title for x in self.c_tree.iter_descendants(a_id, batch_size=2, cursor=cursor)],
+                         ['D', 'E', 'G'])
+
+        self.assertEqual([x.title for x in self.c_tree.iter_descendants(a_id, min_depth=0, max_depth=1)],
+                         ['A', 'B', 'C', 'F'])
+        self.assertEqual(list(self.c_tree.iter_descendants(self.c_tree.get_first_id('Z'))), [])
+
+    def test_cache(self):
+        """
+        Test for the cache of paths, roots and nodes.
+        """
+
+        tree = ClosureTree(cache_size=10)
+        tree.add_subtree([('A', [('B', ['D', 'E']), 'C']), ('X', ['Y'])])
+        a_id, b_id, c_id, d_id, e_id, x_id, y_id = (tree.get_first_id(x) for x in 'ABCDEXY')
+
+        self.assertEqual([x.title for x in tree.get_path(d_id)], ['A', 'B', 'D'])
+        self.assertEqual([x.title for x in tree.get_path(d_id)], ['A', 'B', 'D'])
+        tree.get_path(c_id)
+        tree.get_path(y_id)
+        self.assertTrue(tree.is_root(x_id))
+        self.assertTrue(tree.node_exists(e_id))
+        self.assertEqual(tree.cache_info(), {
+            'hits': 1, 'misses': 5, 'evictions': 0, 'invalidations': 0, 'size': 5, 'max_size': 10})
+
+        # only the entries of the moved subtree are invalidated
+        tree.move_node(b_id, x_id)
+        self.assertEqual(tree.cache_info()['invalidations'], 1)
+        hits = tree.cache_info()['hits']
+        self.assertEqual([x.title for x in tree.get_path(d_id)], ['X', 'B', 'D'])
+        self.assertEqual([x.title for x in tree.get_path(c_id)], ['A', 'C'])
+        self.assertEqual(tree.cache_info()['hits'], hits + 1)
+
+        self.assertTrue(tree.node_exists(b_id))
+        tree.delete_node(b_id)
+        self.assertFalse(tree.node_exists(b_id))
+
+        # a rolled back change does not leave stale entries
+        with self.assertRaises(ZeroDivisionError):
+            with tree.session():
+                tree.move_node(y_id, a_id)
+                self.assertEqual([x.title for x in tree.get_path(y_id)], ['A', 'Y'])
+                1 / 0
+
+        self.assertEqual([x.title for x in tree.get_path(y_id)], ['X', 'Y'])
+
+        for node_id in range(1, 10):
+            tree.get_path(node_id)
+            tree.is_root(node_id)
+
+        self.assertEqual(tree.cache_info()['size'], 10)
+        self.assertGreater(tree.cache_info()['evictions'], 0)
+
+    def test_batched_reads(self):
+        """
+        Test for reading the paths, nodes and root flags of many nodes at once.
+        """
+
+        ids = [self.c_tree.get_first_id(x) for x in 'DGXZ'] + [100]
+
+        paths = self.c_tree.get_paths(ids, chunk_size=2)
+        self.assertEqual({x: [row.title for row in rows] for x, rows in paths.items()}, {
+            ids[0]: ['A', 'B', 'D'], ids[1]: ['A', 'F', 'G'], ids[2]: ['X'], ids[3]: ['X', 'Y', 'Z'], 100: []})
+        self.assertEqual([x.depth for x in paths[ids[0]]], [x.depth for x in self.c_tree.get_path(ids[0])])
+
+        self.assertEqual([x and x.title for x in self.c_tree.get_nodes(ids).values()], ['D', 'G', 'X', 'Z', None])
+        self.assertEqual(list(self.c_tree.nodes_exist(ids).values()), [True, True, True, True, False])
+        self.assertEqual(list(self.c_tree.are_roots(ids).values()), [False, False, True, False, True])
+
+        # the cached and loaded values are merged
+        tree = ClosureTree(cache_size=10)
+        tree.add_subtree([('A', ['B', 'C'])])
+        tree.get_path(2)
+        self.assertEqual({x: [row.title for row in rows] for x, rows in tree.get_paths([1, 2, 3]).items()},
+                         {1: ['A'], 2: ['A', 'B'], 3: ['A', 'C']})
+        self.assertEqual(tree.cache_info()['hits'], 1)
+
+    def test_paths_index_upgrade(self):
+        """
+        Test that the index on the descendants is added to a database created before it existed.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        url = 'sqlite:///{}'.format(file_name)
+        tree = ClosureTree(url)
+        ids = tree.add_subtree([('A', [('B', ['C'])])])
+        tree.engine.execute('DROP INDEX paths_dd_idx')
+        tree.engine.dispose()
+
+        tree = ClosureTree(url)
+        self.addCleanup(tree.engine.dispose)
+        self.assertEqual([x.title for x in tree.get_path(ids[2])], ['A', 'B', 'C'])
+        self.assertIn('paths_dd_idx', [x['name'] for x in inspect(tree.engine).get_indexes('paths')])
+
+        plan = tree.engine.execute('EXPLAIN QUERY PLAN SELECT depth FROM paths WHERE descendant = 3').fetchall()
+        self.assertIn('paths_dd_idx', ' '.join(str(x[-1]) for x in plan))
+
+    def _parents(self, tree):
+        """
+        Reads the parent of every node by title.
+        :param tree: a closure tree
+        :return: a dict mapping each title to the title of its parent (None for roots)
+        """
+
+        return {x: ([row.title for row in tree.get_path(tree.get_first_id(x))][-2:-1] or [None])[0]
+                for x in 'ABCDEFGXYZW' if tree.get_first_id(x)}
+
+    def _assert_closure(self, tree):
+        """
+        Checks that the paths table holds exactly the paths implied by the parents of the nodes.
+        :param tree: a closure tree
+        """
+
+        conn = tree.engine.connect()
+        parents = dict(conn.execute('select descendant, ancestor from paths where depth = 1').fetchall())
+
+        expected = set()
+        for node_id, in conn.execute('select id from nodes'):
+            ancestor, depth = node_id, 0
+            while ancestor is not None:
+                expected.add((ancestor, node_id, depth))
+                ancestor, depth = parents.get(ancestor), depth + 1
+
+        self.assertEqual(set(tuple(x) for x in conn.execute('select ancestor, descendant, depth from paths')),
+                         expected)
+
+    def test_move_validation(self):
+        """
+        Test that invalid moves are rejected without changing the tree.
+        """
+
+        ids = {x: self.c_tree.get_first_id(x) for x in 'ABDX'}
+        parents = self._parents(self.c_tree)
+
+        for node, parent in (('A', 'D'), ('B', 'B'), ('B', 100), (100, 'A')):
+            with self.assertRaises(Exception):
+                self.c_tree.move_node(ids.get(node, node), ids.get(parent, parent))
+
+        with self.assertRaises(Exception):
+            self.c_tree.attach_node(ids['B'], ids['X'])
+
+        self.assertEqual(self._parents(self.c_tree), parents)
+        self._assert_closure(self.c_tree)
+
+    def test_subtree_stats(self):
+        """
+        Test the aggregates of several subtrees.
+        """
+
+        ids = {x: self.c_tree.get_first_id(x) for x in 'ABDX'}
+
+        stats = self.c_tree.subtree_stats([ids['A'], ids['B'], ids['D'], ids['X'], 100], chunk_size=2)
+
+        self.assertEqual(stats[ids['A']], SubtreeStats(6, 2, 4))
+        self.assertEqual(stats[ids['B']], SubtreeStats(2, 1, 2))
+        self.assertEqual(stats[ids['D']], SubtreeStats(0, 0, 1))
+        self.assertEqual(stats[ids['X']], SubtreeStats(3, 2, 2))
+        self.assertIsNone(stats[100])
+
+        self.assertEqual(self.c_tree.descendant_count(ids['A']), 6)
+
+    def test_track_counts(self):
+        """
+        Test that the descendant counts stay correct after every kind of change.
+        """
+
+        tree = ClosureTree(track_counts=True, cache_size=100)
+
+        def assert_counts():
+            node_ids = [x for x, path in tree.get_paths(range(1, 60)).items() if path]
+            stats = tree.subtree_stats(node_ids)
+
+            for node_id in node_ids:
+                self.assertEqual(tree.descendant_count(node_id), stats[node_id].descendants, node_id)
+
+        ids = tree.add_subtree([('A', [('B', ['D', 'E']), 'C', ('F', ['G'])]), ('X', [('Y', ['Z']), 'W'])])
+        tree.add_subtree([('H', ['I', 'J'])], parent=ids[2])
+        tree.add_node('K', ids[3])
+        self.assertEqual(tree.descendant_count(ids[0]), 10)
+        assert_counts()
+
+        tree.move_node(ids[1], ids[9])
+        tree.detach_node(ids[5])
+        assert_counts()
+
+        tree.attach_node(ids[5], ids[8])
+        tree.move_nodes([(ids[7], ids[4]), (ids[9], None), (ids[10], ids[0])])
+        assert_counts()
+
+        with tree.session():
+            tree.delete_node(ids[9])
+            tree.add_node('L', ids[0])
+
+        assert_counts()
+
+        tree.engine.execute(tree.nodes.update().values(descendant_count=0))
+        tree.recount()
+        assert_counts()
+
+        with self.assertRaisesRegex(Exception, 'not tracked'):
+            self.c_tree.recount()
+
+    def test_ordered_siblings(self):
+        """
+        Test that the children keep their order through inserts, reorders and moves.
+        """
+
+        tree = ClosureTree(ordered=True, cache_size=100)
+
+        def titles(node_id):
+            return [x.title for x in tree.get_descendants(node_id)]
+
+        ids = tree.add_subtree([('A', ['B', 'C']), ('X', ['Y'])])
+        self.assertEqual(titles(ids[0]), ['B', 'C'])
+
+        d_id = tree.add_node('D', before=ids[2])
+        tree.add_node('E', ids[0], after=ids[1])
+        tree.add_node('F', ids[0])
+        self.assertEqual(titles(ids[0]), ['B', 'E', 'D', 'C', 'F'])
+
+        # a reorder among the same siblings only changes the position row of the node
+        path_before = tree.get_path(d_id)
+        tree.move_node(d_id, None, before=ids[1])
+        self.assertEqual(titles(ids[0]), ['D', 'B', 'E', 'C', 'F'])
+        self.assertEqual([x.ancestor for x in tree.get_path(d_id)], [x.ancestor for x in path_before])
+
+        tree.move_node(ids[2], ids[3], before=ids[4])
+        tree.move_nodes([(ids[1], ids[3]), (d_id, ids[3])])
+        self.assertEqual(titles(ids[0]), ['E', 'F'])
+        self.assertEqual(titles(ids[3]), ['C', 'Y', 'B', 'D'])
+        self.assertEqual([x.title for x in tree.get_subtree(ids[3]).children], ['C', 'Y', 'B', 'D'])
+
+        with self.assertRaisesRegex(Exception, 'not a child of the parent'):
+            tree.add_node('G', ids[0], before=ids[4])
+
+        with self.assertRaisesRegex(Exception, 'next to itself'):
+            tree.move_node(d_id, None, after=d_id)
+
+        with self.assertRaisesRegex(Exception, 'not ordered'):
+            self.c_tree.add_node('G', before=self.c_tree.get_first_id('B'))
+
+    def test_ancestry(self):
+        """
+        Test the ancestor checks and the lowest common ancestor queries.
+        """
+
+        ids = {x: self.c_tree.get_first_id(x) for x in 'ABCDEFGXYZW'}
+
+        self.assertTrue(self.c_tree.is_ancestor(ids['A'], ids['D']))
+        self.assertFalse(self.c_tree.is_ancestor(ids['D'], ids['A']))
+        self.assertFalse(self.c_tree.is_ancestor(ids['A'], ids['A']))
+        self.assertTrue(self.c_tree.is_ancestor(ids['A'], ids['A'], include_self=True))
+        self.assertFalse(self.c_tree.is_ancestor(ids['A'], 100))
+
+        pairs = [(ids['A'], ids['G']), (ids['B'], ids['G']), (ids['X'], ids['W']), (ids['Z'], ids['Z']),
+                 (ids['A'], ids['G'])]
+        self.assertEqual(self.c_tree.is_ancestor_many(pairs, chunk_size=2), [True, False, True, False, True])
+        self.assertEqual(self.c_tree.is_ancestor_many(pairs, include_self=True)[3], True)
+        self.assertEqual(self.c_tree.is_ancestor_many([]), [])
+
+        self.assertEqual(self.c_tree.lca([ids['D'], ids['E']]), ids['B'])
+        self.assertEqual(self.c_tree.lca([ids['D'], ids['E'], ids['G']]), ids['A'])
+        self.assertEqual(self.c_tree.lca([ids['B'], ids['D']]), ids['B'])
+        self.assertEqual(self.c_tree.lca([ids['Z']]), ids['Z'])
+        self.assertIsNone(self.c_tree.lca([ids['D'], ids['Z']]))
+        self.assertIsNone(self.c_tree.lca([]))
+
+    def test_verify_and_rebuild(self):
+        """
+        Test that the integrity checks find broken paths and that the rebuild repairs them.
+        """
+
+        self.assertTrue(self.c_tree.verify()['valid'])
+
+        # deleting a node also deletes the nodes of its subtree
+        self.c_tree.delete_node(self.c_tree.get_first_id('B'))
+        self.assertEqual(self.c_tree.node_count(), 8)
+        self.assertTrue(self.c_tree.verify()['valid'])
+
+        tree = ClosureTree(ordered=True, track_counts=True, cache_size=100)
+        ids = tree.add_subtree([('A', ['B', ('C', ['D'])]), ('X', ['Y'])])
+        expected = tree.get_paths(ids)
+
+        paths = tree.paths
+        tree.engine.execute(tree.nodes.insert(), [{'title': 'orphan'}, {'title': 'orphan'}])
+        tree.engine.execute(paths.delete().where(paths.c.depth > 1))
+        tree.engine.execute(paths.insert(), {'ancestor': ids[5], 'descendant': ids[4], 'depth': 1, 'position': 'a0'})
+
+        report = tree.verify()
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['orphans'], 2)
+        self.assertEqual(report['missing_paths'], 3)
+        self.assertEqual(report['cycles'], 2)
+
+        self.assertEqual(tree.collect_orphans(chunk_size=1), 2)
+        self.assertEqual(tree.verify()['orphans'], 0)
+
+        # the cycle between X and Y is broken at X, which stays a root
+        self.assertEqual(tree.rebuild_paths(), 11)
+        self.assertTrue(tree.verify()['valid'])
+        self.assertEqual(tree.get_paths(ids), expected)
+        self.assertEqual([x.title for x in tree.get_descendants(ids[0])], ['B', 'C'])
+        self.assertEqual(tree.descendant_count(ids[0]), 3)
+
+    def test_batched_delete(self):
+        """
+        Test that a subtree deleted in batches is detached first and that the tables stay valid between the batches.
+        """
+
+        tree = ClosureTree(track_counts=True, cache_size=100, log_changes=True)
+        ids = tree.add_subtree([('A', [('B', [('C', ['D', 'E']), 'F']), 'G'])])
+        self.assertEqual(tree.get_node(ids[3]).title, 'D')
+
+        steps = []
+
+        def progress(deleted, total):
+            report = tree.verify()
+            steps.append((deleted, total, report['valid'], report['nodes']))
+            self.assertFalse(tree.is_ancestor(ids[0], ids[1]))
+
+            # the counts of the nodes left in the subtree follow the batches
+            if deleted < total:
+                self.assertEqual(tree.descendant_count(ids[1]), total - deleted - 1)
+
+        self.assertIsNone(tree.delete_node(ids[1], batch_size=2, progress=progress))
+
+        self.assertEqual(steps, [(2, 5, True, 5), (4, 5, True, 3), (5, 5, True, 2)])
+        self.assertEqual([x.title for x in tree.get_descendants(ids[0])], ['G'])
+        self.assertEqual(tree.descendant_count(ids[0]), 1)
+        self.assertIsNone(tree.get_node(ids[3]))
+        self.assertEqual([x.operation for x in tree.changes_since()][-1], 'delete')
+
+        with self.assertRaisesRegex(Exception, 'batch size'):
+            tree.delete_node(ids[0], background=True)
+
+        # a thread would not see the in-memory database, nothing is detached
+        with self.assertRaisesRegex(Exception, 'shared between threads'):
+            tree.delete_node(ids[0], batch_size=1, background=True)
+        self.assertEqual([x.title for x in tree.get_roots()], ['A'])
+
+        # in the background, the subtree is already detached when the thread is returned
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        tree = ClosureTree('sqlite:///{}'.format(file_name))
+        self.addCleanup(tree.engine.dispose)
+        ids = tree.add_subtree([('A', [('B', ['C', 'D', 'E'])])])
+
+        thread = tree.delete_node(ids[1], batch_size=1, background=True)
+        self.assertEqual(tree.get_descendants(ids[0]), [])
+        thread.join()
+
+        self.assertEqual(tree.node_count(), 1)
+        self.assertTrue(tree.verify()['valid'])
+
+        # the error that stopped the thread is raised by join, and the delete can be resumed
+        def fail(deleted, total):
+            raise ZeroDivisionError
+
+        ids = tree.add_subtree([('B', ['C', 'D'])], parent=ids[0])
+        thread = tree.delete_node(ids[0], batch_size=1, progress=fail, background=True)
+        with self.assertRaises(ZeroDivisionError):
+            thread.join()
+
+        self.assertEqual(tree.node_count(), 3)
+        tree.delete_node(ids[0], batch_size=1)
+        self.assertEqual(tree.node_count(), 1)
+
+    def test_resolve_path(self):
+        """
+        Test the lookup of nodes by title paths.
+        """
+
+        tree = ClosureTree(title_index=True)
+        ids = tree.add_subtree([('A', [('B', ['D', 'E']), ('B', ['D'])]), ('X', [('A', [('B', ['D'])])])])
+
+        self.assertIn('nodes_title_idx', [x['name'] for x in inspect(tree.engine).get_indexes('nodes')])
+
+        self.assertEqual(tree.resolve_path('A/B/D'), ids[2])
+        self.assertEqual(tree.resolve_path('/X/A/B/D/'), ids[9])
+        self.assertEqual(tree.resolve_path(['X', 'A']), ids[7])
+        self.assertEqual(tree.resolve_path('A|B|E', sep='|'), ids[3])
+
+        # the path has to start from a root
+        self.assertIsNone(tree.resolve_path('B/D'))
+        self.assertIsNone(tree.resolve_path('A/D'))
+        self.assertIsNone(tree.resolve_path(''))
+
+        self.assertEqual(
+            tree.resolve_paths(['A/B/D', 'A/B', 'A/C', '', 'X/A/B'], chunk_size=2),
+            [ids[2], ids[1], None, None, ids[8]]
+        )
+
+        self.assertEqual(self.c_tree.resolve_path('X/Y/Z'), self.c_tree.get_first_id('Z'))
+
+    def test_title_index_upgrade(self):
+        """
+        Test that the title index is added to a database created without it.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        url = 'sqlite:///{}'.format(file_name)
+        tree = ClosureTree(url)
+        tree.add_subtree([('A', ['B'])])
+        self.assertNotIn('nodes_title_idx', [x['name'] for x in inspect(tree.engine).get_indexes('nodes')])
+        tree.engine.dispose()
+
+        tree = ClosureTree(url, title_index=True)
+        self.addCleanup(tree.engine.dispose)
+        self.assertEqual(tree.resolve_path('A/B'), tree.get_first_id('B'))
+        self.assertIn('nodes_title_idx', [x['name'] for x in inspect(tree.engine).get_indexes('nodes')])
+
+    def test_snapshot(self):
+        """
+        Test that a tree written to a snapshot is loaded with the same ids, titles and paths.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.snap')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        self.c_tree.add_node(None, 'Z', True)
+        self.c_tree.add_node('\u00e9t\u00e9 \u2603', 'C', True)
+        self.c_tree.move_node(self.c_tree.get_first_id('X'), self.c_tree.get_first_id('E'))
+
+        self.assertEqual(self.c_tree.dump(file_name), 13)
+
+        for use_mmap, workers in ((False, None), (True, None), (True, 2)):
+            tree = ClosureTree.load(file_name, mmap=use_mmap, chunk_size=5, workers=workers)
+
+            self.assertEqual(tree.get_nodes(range(1, 14)), self.c_tree.get_nodes(range(1, 14)))
+            self.assertEqual(tree.get_paths(range(1, 14)), self.c_tree.get_paths(range(1, 14)))
+            self.assertEqual(len(tree.get_roots()), 1)
+
+            # the tree keeps working after the load
+            self.assertEqual(tree.add_node('H', 'A', True), 14)
+
+        # the paths computed by the workers keep the order of the siblings
+        ordered_tree = ClosureTree.load(file_name, ordered=True, workers=2)
+        self.assertTrue(ordered_tree.verify()['valid'])
+        self.assertEqual([x.title for x in ordered_tree.get_descendants(1)], ['B', 'C', 'F'])
+
+        with self.assertRaisesRegex(Exception, 'not empty'):
+            self.c_tree.add_snapshot(read_snapshot(file_name))
+
+        with open(file_name, 'r+b') as handle:
+            handle.write(b'NOTATREE')
+
+        with self.assertRaisesRegex(Exception, 'not a tree snapshot'):
+            ClosureTree.load(file_name)
+
+    def test_move_nodes(self):
+        """
+        Test for moving many nodes at once.
+        """
+
+        ids = {x: self.c_tree.get_first_id(x) for x in 'ABCDEFGXYZW'}
+
+        # B moves under X while its child D moves under G, Y becomes a root and Z moves under B
+        self.c_tree.move_nodes([(ids['B'], ids['X']), (ids['D'], ids['G']), (ids['Y'], None), (ids['Z'], ids['B'])],
+                               chunk_size=2)
+
+        self.assertEqual(self._parents(self.c_tree), {
+            'A': None, 'B': 'X', 'C': 'A', 'D': 'G', 'E': 'B', 'F': 'A', 'G': 'F', 'X': None, 'Y': None, 'Z': 'B',
+            'W': 'X'})
+        self._assert_closure(self.c_tree)
+
+        # a new parent inside another moved subtree is attached after it
+        self.c_tree.move_nodes([(ids['W'], ids['E']), (ids['B'], ids['C'])])
+        self.assertEqual([x.title for x in self.c_tree.get_path(ids['W'])], ['A', 'C', 'B', 'E', 'W'])
+        self._assert_closure(self.c_tree)
+
+        # moves that form a cycle together are rolled back
+        parents = self._parents(self.c_tree)
+        with self.assertRaises(Exception):
+            self.c_tree.move_nodes([(ids['F'], ids['X']), (ids['X'], ids['G'])])
+
+        self.assertEqual(self._parents(self.c_tree), parents)
+        self._assert_closure(self.c_tree)
+
+    def test_forest(self):
+        """
+        Test that the trees of a forest share the tables but not their nodes.
+        """
+
+        forest = ClosureTree(forest=True, ordered=True)
+        first, second = forest.scoped(1), forest.scoped(2)
+
+        first_ids = first.add_subtree([('A', ['B', ('C', ['D'])])])
+        second_ids = second.add_subtree([('A', ['B']), 'X'])
+
+        self.assertEqual(first.node_count(), 4)
+        self.assertEqual(sorted(x.title for x in second.get_roots()), ['A', 'X'])
+        self.assertEqual(first.get_first_id('B'), first_ids[1])
+        self.assertEqual(second.get_first_id('B'), second_ids[1])
+        self.assertIsNone(second.get_node(first_ids[0]))
+
+        # a node cannot be moved into another tree
+        with self.assertRaisesRegex(Exception, 'Parent node does not exist'):
+            second.move_node(second_ids[1], first_ids[0])
+
+        with self.assertRaisesRegex(Exception, 'need a tree'):
+            forest.get_roots()
+
+        third = forest.scoped(3)
+        offset = forest.copy_tree(1, 3)
+        self.assertEqual([x.title for x in third.get_path(first_ids[3] + offset)], ['A', 'C', 'D'])
+        self.assertTrue(third.verify()['valid'])
+
+        with self.assertRaisesRegex(Exception, 'not empty'):
+            forest.copy_tree(2, 3)
+
+        forest.drop_tree(1)
+        self.assertEqual(first.node_count(), 0)
+        self.assertEqual(third.node_count(), 4)
+        self.assertTrue(second.verify()['valid'])
+
+        with self.assertRaisesRegex(Exception, 'not a forest'):
+            self.c_tree.scoped(1)
+
+    def test_concurrent_copy_tree(self):
+        """
+        Test that a tree copy does not collide with the ids taken by another writer while it runs.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        url = 'sqlite:///{}'.format(file_name)
+        forest = ClosureTree(url, forest=True)
+        other_forest = ClosureTree(url, forest=True)
+        self.addCleanup(forest.engine.dispose)
+        self.addCleanup(other_forest.engine.dispose)
+
+        ids = forest.scoped(1).add_subtree([('A', ['B', 'C'])])
+        other_ids = []
+
+        # the other writer adds a node right before the first write of the copy
+        def before_insert(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT') and not other_ids:
+                thread = threading.Thread(target=lambda: other_ids.append(other_forest.scoped(2).add_node('X')))
+                thread.start()
+                thread.join()
+
+        event.listen(forest.engine, 'before_cursor_execute', before_insert)
+        offset = forest.copy_tree(1, 3)
+
+        self.assertEqual([x.title for x in forest.scoped(2).get_roots()], ['X'])
+        self.assertNotIn(other_ids[0], [x + offset for x in ids])
+        self.assertEqual([x.title for x in forest.scoped(3).get_path(ids[2] + offset)], ['A', 'C'])
+        self.assertTrue(forest.scoped(3).verify()['valid'])
+
+    def test_forest_cache(self):
+        """
+        Test that the scoped views of a forest share the cache without seeing the entries of the other trees.
+        """
+
+        forest = ClosureTree(forest=True, cache_size=100)
+        first, second = forest.scoped(1), forest.scoped(2)
+
+        first_ids = first.add_subtree([('A', ['B'])])
+        second.add_subtree([('X', ['Y'])])
+
+        # warm the cache from the first tree
+        self.assertEqual(first.get_node(first_ids[1]).title, 'B')
+        self.assertEqual([x.title for x in first.get_path(first_ids[1])], ['A', 'B'])
+        self.assertFalse(first.is_root(first_ids[1]))
+
+        self.assertIsNone(second.get_node(first_ids[1]))
+        self.assertFalse(second.node_exists(first_ids[0]))
+        self.assertEqual(second.get_nodes(first_ids), {x: None for x in first_ids})
+        self.assertEqual(second.get_path(first_ids[1]), [])
+        self.assertEqual([x.title for x in first.get_path(first_ids[1])], ['A', 'B'])
+
+        with self.assertRaises(Exception):
+            second.add_node('x', first_ids[0])
+        self.assertEqual(second.node_count(), 2)
+
+        # a change in one tree only invalidates its own entries
+        first.delete_node(first_ids[1])
+        self.assertIsNone(first.get_node(first_ids[1]))
+        self.assertEqual(first.get_path(first_ids[1]), [])
+
+    def test_existing_engine(self):
+        """
+        Test trees sharing an engine, with the schema created by their first operation.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        tree = ClosureTree('sqlite:///{}'.format(file_name))
+        self.assertEqual(inspect(tree.engine).get_table_names(), [])
+
+        tree.add_subtree([('A', ['B', 'C'])])
+        self.assertEqual(tree.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+
+        # the other instances reuse the engine and the tables
+        other_tree = ClosureTree(engine=tree.engine, cache_size=10)
+        self.assertIs(other_tree.paths, tree.paths)
+        self.assertIsNot(ClosureTree(ordered=True).paths, tree.paths)
+        self.assertEqual([x.title for x in other_tree.get_path(other_tree.get_first_id('C'))], ['A', 'C'])
+
+        tree.engine.dispose()
+
+        # the pragmas can be turned off
+        plain_tree = ClosureTree('sqlite:///{}'.format(file_name), pragmas=None)
+        self.assertEqual(plain_tree.node_count(), 3)
+        self.assertEqual(plain_tree.engine.execute('PRAGMA synchronous').scalar(), 2)
+        plain_tree.engine.dispose()
+
+    def test_change_log(self):
+        """
+        Test that a process follows the changes made by another one through the change log.
+        """
+
+        handle, file_name = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.addCleanup(os.remove, file_name)
+
+        url = 'sqlite:///{}'.format(file_name)
+        writer = ClosureTree(url, log_changes=True)
+        ids = writer.add_subtree([('A', [('B', ['D', 'E']), 'C']), ('X', ['Y'])])
+
+        reader = ClosureTree(url, log_changes=True, cache_size=100)
+        version = reader.change_version()
+        index = TreeIndex.from_tree(reader)
+        self.assertEqual(version, 7)
+        self.assertEqual(reader.get_path(ids[2])[0].ancestor, ids[0])
+
+        h_id = writer.add_node('H', ids[2])
+        writer.move_node(ids[1], ids[5])
+        writer.move_nodes([(ids[5], ids[6]), (ids[6], None)])
+        writer.delete_node(ids[4])
+
+        self.assertEqual([(x.operation, x.node_id, x.parent_id) for x in reader.changes_since(version)], [
+            ('add', h_id, ids[2]), ('move', ids[1], ids[5]), ('detach', ids[5], None), ('detach', ids[6], None),
+            ('attach', ids[5], ids[6]), ('delete', ids[4], None)
+        ])
+
+        version = reader.sync_changes(version, index)
+        self.assertEqual(version, 13)
+        self.assertEqual([x.ancestor for x in reader.get_path(h_id)], [ids[6], ids[5], ids[1], ids[2], h_id])
+
+        for node_id in ids[:4] + ids[5:] + [h_id]:
+            self.assertEqual(index.get_path(node_id), [x.ancestor for x in writer.get_path(node_id)])
+
+        self.assertNotIn(ids[4], index)
+
+        # a rewrite of the tree reloads the index
+        writer.rebuild_paths()
+        version = reader.sync_changes(version, index)
+        self.assertEqual(version, 14)
+        self.assertEqual(len(index), 7)
+        self.assertEqual(reader.sync_changes(version, index), 14)
+
+        self.assertEqual(writer.prune_changes(13), 13)
+        self.assertEqual([x.version for x in reader.changes_since()], [14])
+
+        with self.assertRaisesRegex(Exception, 'not logged'):
+            self.c_tree.changes_since(0)
+
+        writer.engine.dispose()
+        reader.engine.dispose()
@@ -0,0 +1,43 @@
+import unittest
+from random import Random
+
+from sql_tree_implementations.fractional_index import key_between, keys_after
+
+
+class FractionalIndexTest(unittest.TestCase):
+
+    def test_key_between(self):
+        """
+        Test that generated keys sort between their bounds and stay short when appending.
+        """
+
+        self.assertEqual(key_between(None, None), 'a0')
+        self.assertEqual(key_between('a0', None), 'a1')
+        self.assertEqual(key_between(None, 'a0'), 'Zz')
+        self.assertEqual(key_between('a0', 'a1'), 'a0V')
+
+        keys = keys_after(None, 5000)
+        self.assertEqual(keys, sorted(keys))
+        self.assertLessEqual(max(len(x) for x in keys), 4)
+
+        random = Random(7)
+        keys = [key_between(None, None)]
+        for _ in range(2000):
+            index = random.randint(0, len(keys))
+            lower = keys[index - 1] if index > 0 else None
+            upper = keys[index] if index < len(keys) else None
+
+            key = key_between(lower, upper)
+            self.assertTrue(lower is None or lower < key)
+            self.assertTrue(upper is None or key < upper)
+            keys.insert(index, key)
+
+        with self.assertRaisesRegex(Exception, 'not in order'):
+            key_between('a1', 'a0')
+
+        with self.assertRaisesRegex(Exception, 'Invalid position key'):
+            key_between('a10', None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import unittest
+
+from sqlalchemy import event
+
+from sql_tree_implementations.hybrid_tree import HybridTree
+
+
+class HybridTest(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create this structure:
+        tree 1:
+                  A
+              /   |  \\
+             B    C   F
+           /  \\       |
+          D   E       G
+
+        tree 2:
+          X
+        """
+
+        self.h_tree = HybridTree()
+        self.h_tree.add_node('A')
+        self.h_tree.add_node('B', 'A', True)
+        self.h_tree.add_node('C', 'A', True)
+        self.h_tree.add_node('D', 'B', True)
+        self.h_tree.add_node('E', 'B', True)
+        self.h_tree.add_node('F', 'A', True)
+        self.h_tree.add_node('G', 'F', True)
+        self.h_tree.add_node('X')
+        self.h_tree.add_node('Y', 'X', True)
+        self.h_tree.add_node('Z', 'Y', True)
+        self.h_tree.add_node('W', 'X', True)
+
+    def _path(self, title):
+        return [x.title for x in self.h_tree.get_path(self.h_tree.get_first_id(title))]
+
+    def _children(self, title):
+        return [x.title for x in self.h_tree.get_descendants(self.h_tree.get_first_id(title))]
+
+    def test_reads(self):
+        """
+        Test for the read operations.
+        """
+
+        self.h_tree.view_tree()
+
+        self.assertEqual(self._path('E'), ['A', 'B', 'E'])
+        self.assertEqual([x.depth for x in self.h_tree.get_path(self.h_tree.get_first_id('E'))], [2, 1, 0])
+        self.assertEqual(self._children('A'), ['B', 'C', 'F'])
+        self.assertEqual([x.title for x in self.h_tree.get_roots()], ['A', 'X'])
+        self.assertTrue(self.h_tree.is_root(self.h_tree.get_first_id('X')))
+        self.assertFalse(self.h_tree.is_root(self.h_tree.get_first_id('Z')))
+
+        a_tree = self.h_tree.get_subtree(self.h_tree.get_first_id('A'), max_depth=1)
+        self.assertEqual([(x.title, x.depth, len(x.children)) for x in a_tree.children],
+                         [('B', 1, 0), ('C', 1, 0), ('F', 1, 0)])
+        self.assertEqual(len(self.h_tree.get_subtree()), 2)
+
+    def test_add_node_single_write(self):
+        """
+        Test that a new node is written with its path by a single statement.
+        """
+
+        writes = []
+
+        def before_execute(conn, cursor, statement, parameters, context, executemany):
+            if not statement.startswith('SELECT'):
+                writes.append(statement)
+
+        event.listen(self.h_tree.engine, 'before_cursor_execute', before_execute)
+        node_id = self.h_tree.add_node('V', 'Z', True)
+
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(self._path('V'), ['X', 'Y', 'Z', 'V'])
+        self.assertEqual(self.h_tree.get_path(node_id)[-1].ancestor, node_id)
+
+    def test_shared_tables(self):
+        """
+        Test that the trees with the same options share their table definitions.
+        """
+
+        other_tree = HybridTree(engine=self.h_tree.engine)
+        self.assertIs(other_tree.nodes, self.h_tree.nodes)
+        self.assertIsNot(HybridTree(title_index=True).nodes, self.h_tree.nodes)
+        self.assertEqual([x.title for x in other_tree.get_roots()], ['A', 'X'])
+
+    def test_move_and_delete(self):
+        """
+        Test for the operations that change the structure.
+        """
+
+        self.h_tree.move_node(self.h_tree.get_first_id('B'), self.h_tree.get_first_id('C'))
+        self.assertEqual(self._path('D'), ['A', 'C', 'B', 'D'])
+        self.assertEqual(self._children('A'), ['C', 'F'])
+
+        self.h_tree.move_node(self.h_tree.get_first_id('Y'), None)
+        self.assertEqual(self._path('Z'), ['Y', 'Z'])
+
+        with self.assertRaises(Exception):
+            self.h_tree.move_node(self.h_tree.get_first_id('A'), self.h_tree.get_first_id('D'))
+
+        with self.assertRaises(Exception):
+            self.h_tree.move_node(self.h_tree.get_first_id('A'), 100)
+
+        # the paths of the whole subtree are rewritten
+        self.assertEqual(
+            [x.path for x in self.h_tree.engine.connect().execute(
+                self.h_tree.nodes.select().order_by(self.h_tree.nodes.c.id))],
+            ['/1/', '/1/3/2/', '/1/3/', '/1/3/2/4/', '/1/3/2/5/', '/1/6/', '/1/6/7/', '/8/', '/9/', '/9/10/', '/8/11/']
+        )
+
+        self.h_tree.delete_node(self.h_tree.get_first_id('C'))
+        self.assertEqual(self.h_tree.node_count(), 7)
+        self.assertIsNone(self.h_tree.get_first_id('E'))
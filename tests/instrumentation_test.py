@@ -0,0 +1,96 @@
+import unittest
+
+from sql_tree_implementations import ClosureTree
+from sql_tree_implementations.adjacency_list import AdjacencyTree
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.c_tree = ClosureTree()
+        self.c_tree.add_subtree([('A', [('B', ['D', 'E']), 'C'])])
+
+        self.operations = []
+        self.instrumentation = self.c_tree.instrument(self.operations.append)
+
+    def test_attribution(self):
+        """
+        Test that the statements are attributed to the outermost public method.
+        """
+
+        self.c_tree.add_node('F', 'B', True)
+
+        self.assertEqual([x.name for x in self.operations], ['add_node'])
+
+        # the title lookup, the exists check, the node insert and the paths insert
+        operation = self.operations[0]
+        self.assertEqual(operation.statements, 4)
+        self.assertEqual(operation.rows, 4)
+        self.assertFalse(operation.failed)
+        self.assertGreater(operation.elapsed, 0)
+
+        self.c_tree.view_tree()
+        self.assertEqual(self.operations[-1].name, 'view_tree')
+        self.assertEqual(self.operations[-1].statements, 1)
+
+        with self.assertRaises(Exception):
+            self.c_tree.move_node(1, 100)
+
+        self.assertTrue(self.operations[-1].failed)
+
+        snapshot = self.instrumentation.snapshot()
+        self.assertEqual(sorted(snapshot), ['add_node', 'move_node', 'view_tree'])
+        self.assertEqual(snapshot['add_node']['statements'], 4)
+        self.assertEqual(snapshot['move_node']['failures'], 1)
+        self.assertEqual(sum(x for _, x in snapshot['view_tree']['buckets']), 1)
+        self.assertIsNone(snapshot['view_tree']['buckets'][-1][0])
+
+    def test_generator(self):
+        """
+        Test that the statements of a generator are counted while it is consumed.
+        """
+
+        rows = list(self.c_tree.iter_descendants(self.c_tree.get_first_id('A'), batch_size=2))
+
+        self.assertEqual(len(rows), 4)
+        self.assertEqual([x.name for x in self.operations], ['get_first_id', 'iter_descendants'])
+        self.assertEqual(self.operations[1].statements, 3)
+
+        # stopping early also ends the operation
+        for _ in self.c_tree.iter_descendants(1, batch_size=2):
+            break
+
+        self.assertEqual(self.operations[-1].statements, 1)
+
+    def test_remove(self):
+        """
+        Test that the tree is left as it was once the instrumentation is removed.
+        """
+
+        self.instrumentation.remove()
+        self.c_tree.add_node('F', 'B', True)
+
+        self.assertEqual(self.operations, [])
+        self.assertEqual(self.instrumentation.snapshot(), {})
+        self.assertNotIn('add_node', vars(self.c_tree))
+
+    def test_other_trees(self):
+        """
+        Test that every tree can be instrumented.
+        """
+
+        tree = AdjacencyTree()
+        instrumentation = tree.instrument()
+
+        a_id = tree.add_node('A')
+        tree.add_node('B', a_id)
+        tree.get_path(a_id)
+
+        snapshot = instrumentation.snapshot()
+        self.assertEqual(snapshot['add_node']['calls'], 2)
+        self.assertEqual(snapshot['add_node']['max_statements'], 2)
+        self.assertEqual(snapshot['get_path']['statements'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
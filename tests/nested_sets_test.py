@@ -0,0 +1,156 @@
+import unittest
+from random import Random
+from unittest import mock
+
+from sql_tree_implementations import ClosureTree
+from sql_tree_implementations.nested_sets import NestedSetsTree
+
+
+class NestedSetsTest(unittest.TestCase):
+
+    def setUp(self):
+        """
+        Create this structure, with a small gap so that rebalancing is exercised:
+        tree 1:
+                  A
+              /   |  \\
+             B    C   F
+           /  \\       |
+          D   E       G
+
+        tree 2:
+          X
+        """
+
+        self.n_tree = NestedSetsTree(gap=4)
+        self.n_tree.add_node('A')
+        self.n_tree.add_node('B', 'A', True)
+        self.n_tree.add_node('C', 'A', True)
+        self.n_tree.add_node('D', 'B', True)
+        self.n_tree.add_node('E', 'B', True)
+        self.n_tree.add_node('F', 'A', True)
+        self.n_tree.add_node('G', 'F', True)
+        self.n_tree.add_node('X')
+        self.n_tree.add_node('Y', 'X', True)
+        self.n_tree.add_node('Z', 'Y', True)
+        self.n_tree.add_node('W', 'X', True)
+
+    def _path(self, title):
+        return [x.title for x in self.n_tree.get_path(self.n_tree.get_first_id(title))]
+
+    def _children(self, title):
+        return [x.title for x in self.n_tree.get_descendants(self.n_tree.get_first_id(title))]
+
+    def test_reads(self):
+        """
+        Test for the read operations.
+        """
+
+        self.n_tree.view_tree()
+
+        self.assertEqual(self._path('E'), ['A', 'B', 'E'])
+        self.assertEqual([x.depth for x in self.n_tree.get_path(self.n_tree.get_first_id('E'))], [2, 1, 0])
+        self.assertEqual(self._children('A'), ['B', 'C', 'F'])
+        self.assertEqual([x.title for x in self.n_tree.get_roots()], ['A', 'X'])
+        self.assertEqual(self.n_tree.descendant_count(self.n_tree.get_first_id('A')), 6)
+        self.assertTrue(self.n_tree.is_root(self.n_tree.get_first_id('X')))
+        self.assertFalse(self.n_tree.is_root(self.n_tree.get_first_id('Z')))
+
+        b_tree = self.n_tree.get_subtree(self.n_tree.get_first_id('B'))
+        self.assertEqual([(x.title, x.depth) for x in b_tree.children], [('D', 1), ('E', 1)])
+        self.assertEqual([len(x.children) for x in self.n_tree.get_subtree(max_depth=0)], [0, 0])
+
+    def test_shared_tables(self):
+        """
+        Test that the trees with the same options share their table definitions.
+        """
+
+        other_tree = NestedSetsTree(engine=self.n_tree.engine)
+        self.assertIs(other_tree.nodes, self.n_tree.nodes)
+        self.assertIsNot(NestedSetsTree(title_index=True).nodes, self.n_tree.nodes)
+        self.assertEqual([x.title for x in other_tree.get_roots()], ['A', 'X'])
+
+    def test_move_and_delete(self):
+        """
+        Test for the operations that change the structure.
+        """
+
+        self.n_tree.move_node(self.n_tree.get_first_id('B'), self.n_tree.get_first_id('C'))
+        self.assertEqual(self._path('D'), ['A', 'C', 'B', 'D'])
+        self.assertEqual(self._children('A'), ['C', 'F'])
+
+        self.n_tree.move_node(self.n_tree.get_first_id('Y'), None)
+        self.assertEqual(self._path('Z'), ['Y', 'Z'])
+
+        with self.assertRaises(Exception):
+            self.n_tree.move_node(self.n_tree.get_first_id('A'), self.n_tree.get_first_id('D'))
+
+        self.n_tree.delete_node(self.n_tree.get_first_id('C'))
+        self.assertEqual(self.n_tree.node_count(), 7)
+        self.assertIsNone(self.n_tree.get_first_id('E'))
+
+    def test_random_operations(self):
+        """
+        Compares the results with a closure table after many random inserts and moves.
+        """
+
+        rand = Random(0)
+        c_tree = ClosureTree()
+        n_ids, c_ids = [], []
+
+        for index in range(300):
+            if n_ids and rand.random() < 0.3:
+                node, parent = rand.randrange(len(n_ids)), rand.randrange(len(n_ids))
+                if parent == node or self._is_under(c_tree, c_ids[parent], c_ids[node]):
+                    continue
+
+                self.n_tree.move_node(n_ids[node], n_ids[parent])
+                c_tree.move_node(c_ids[node], c_ids[parent])
+            else:
+                parent = rand.randrange(len(n_ids)) if n_ids and rand.random() < 0.9 else None
+                n_ids.append(self.n_tree.add_node(str(index), None if parent is None else n_ids[parent]))
+                c_ids.append(c_tree.add_node(str(index), None if parent is None else c_ids[parent]))
+
+        for n_id, c_id in zip(n_ids, c_ids):
+            self.assertEqual([x.title for x in self.n_tree.get_path(n_id)], [x.title for x in c_tree.get_path(c_id)])
+            self.assertEqual(sorted(x.title for x in self.n_tree.get_descendants(n_id)),
+                             sorted(x.title for x in c_tree.get_descendants(c_id)))
+
+    def test_rare_rebalances(self):
+        """
+        Test that random moves and deep inserts widen the parents locally instead of renumbering the whole table.
+        """
+
+        rand = Random(1)
+        n_tree, c_tree = NestedSetsTree(), ClosureTree()
+        n_ids, c_ids = [], []
+
+        with mock.patch.object(NestedSetsTree, '_rebalance', autospec=True,
+                               side_effect=NestedSetsTree._rebalance) as rebalance:
+            for index in range(500):
+                parent = rand.randrange(len(n_ids)) if n_ids and rand.random() < 0.9 else None
+                n_ids.append(n_tree.add_node(str(index), None if parent is None else n_ids[parent]))
+                c_ids.append(c_tree.add_node(str(index), None if parent is None else c_ids[parent]))
+
+            for _ in range(200):
+                node, parent = rand.randrange(len(n_ids)), rand.randrange(len(n_ids))
+                if parent == node or self._is_under(c_tree, c_ids[parent], c_ids[node]):
+                    continue
+
+                n_tree.move_node(n_ids[node], n_ids[parent])
+                c_tree.move_node(c_ids[node], c_ids[parent])
+
+            # a chain, where every new node has little room under its parent
+            for index in range(300):
+                n_ids.append(n_tree.add_node('chain{}'.format(index), n_ids[-1]))
+                c_ids.append(c_tree.add_node('chain{}'.format(index), c_ids[-1]))
+
+        self.assertEqual(rebalance.call_count, 0)
+
+        for n_id, c_id in zip(n_ids, c_ids):
+            self.assertEqual([x.title for x in n_tree.get_path(n_id)], [x.title for x in c_tree.get_path(c_id)])
+            self.assertEqual(n_tree.descendant_count(n_id), c_tree.descendant_count(c_id))
+
+    @staticmethod
+    def _is_under(tree, node_id, ancestor_id):
+        return any(x.ancestor == ancestor_id for x in tree.get_path(node_id))
@@ -0,0 +1,52 @@
+import unittest
+from random import Random
+
+from sql_tree_implementations.closure_table import closure_rows
+from sql_tree_implementations.parallel import parallel_closure_rows, split_batch
+
+
+class ParallelTest(unittest.TestCase):
+
+    def _random_batch(self, size, seed=0):
+        """
+        Generates a random forest with shuffled ids.
+        :return: the ids and the parent ids (-1 for roots), parents before children
+        """
+
+        random = Random(seed)
+        ids = random.sample(range(1, size * 10), size)
+        parents = [-1 if index == 0 or random.random() < 0.05 else ids[random.randrange(index)]
+                   for index in range(size)]
+
+        return ids, parents
+
+    def test_split_batch(self):
+        """
+        Test that every node goes either to the top nodes or to a job of bounded size.
+        """
+
+        ids, parents = self._random_batch(500)
+        top, jobs = split_batch(ids, parents, 20)
+
+        self.assertEqual(sorted(list(top[0]) + [x for job in jobs for x in job[0]]), sorted(ids))
+        self.assertTrue(all(len(job[0]) <= 20 for job in jobs))
+        self.assertTrue(len(top[0]) > 0)
+
+    def test_parallel_closure_rows(self):
+        """
+        Test that the rows computed by the workers are the same as the ones computed in a single pass.
+        """
+
+        ids, parents = self._random_batch(2000)
+        parents_dict = {x: None if parent < 0 else parent for x, parent in zip(ids, parents)}
+        expected = sorted((x['ancestor'], x['descendant'], x['depth']) for x in closure_rows(ids, parents_dict))
+
+        for job_size in (1, 7, 100, None):
+            self.assertEqual(sorted(parallel_closure_rows(ids, parents, 2, job_size)), expected)
+
+        with self.assertRaisesRegex(Exception, 'positive'):
+            list(parallel_closure_rows(ids, parents, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+import unittest
+from random import Random
+
+import pytest
+
+from sql_tree_implementations import ClosureTree, TreeIndex
+from sql_tree_implementations.adjacency_list import AdjacencyTree
+from sql_tree_implementations.closure_table import Change
+
+
+class TreeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.c_tree = ClosureTree()
+        self.c_tree.add_subtree([
+            ('A', [('B', ['D', 'E']), 'C', ('F', ['G'])]),
+            ('X', [('Y', ['Z']), 'W'])
+        ])
+
+        self.ids = {x: self.c_tree.get_first_id(x) for x in 'ABCDEFGXYZW'}
+        self.index = TreeIndex.from_tree(self.c_tree)
+
+    def _assert_mirror(self, tree, index):
+        """
+        Checks the index against the paths stored in the database.
+        """
+
+        node_ids = [x for x, path in tree.get_paths(range(1, 100)).items() if path]
+        self.assertEqual(len(index), len(node_ids))
+
+        for node_id in node_ids:
+            path = [x.ancestor for x in tree.get_path(node_id)]
+            self.assertEqual(index.get_path(node_id), path)
+            self.assertEqual(index.get_depth(node_id), len(path) - 1)
+            self.assertEqual(sorted(index.get_subtree(node_id)), sorted(x.id for x in self._walk(tree, node_id)))
+
+            for ancestor_id in node_ids:
+                self.assertEqual(index.is_ancestor(ancestor_id, node_id), ancestor_id in path[:-1])
+
+        # the incremental updates give the same result as a rebuild
+        rebuilt = TreeIndex.from_tree(tree)
+        self.assertEqual(index.parent, rebuilt.parent)
+        self.assertEqual(index.size, rebuilt.size)
+
+    def _walk(self, tree, node_id):
+        stack = [tree.get_subtree(node_id)]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children)
+
+    def test_queries(self):
+        """
+        Test the ancestry queries.
+        """
+
+        ids = self.ids
+        self.assertTrue(self.index.is_ancestor(ids['A'], ids['E']))
+        self.assertFalse(self.index.is_ancestor(ids['B'], ids['G']))
+        self.assertFalse(self.index.is_ancestor(ids['A'], ids['A']))
+        self.assertTrue(self.index.is_ancestor(ids['A'], ids['A'], include_self=True))
+        self.assertFalse(self.index.is_ancestor(ids['A'], 1000))
+
+        self.assertEqual(
+            self.index.is_ancestor_many([(ids['A'], ids['E']), (ids['X'], ids['E']), (-1, ids['E'])]),
+            [True, False, False]
+        )
+
+        self.assertEqual(self.index.get_path(ids['Z']), [ids['X'], ids['Y'], ids['Z']])
+        self.assertEqual(self.index.get_roots(), [ids['A'], ids['X']])
+        self.assertEqual(self.index.get_parent(ids['X']), None)
+        self.assertEqual(self.index.subtree_size(ids['A']), 7)
+        self._assert_mirror(self.c_tree, self.index)
+
+        with self.assertRaisesRegex(Exception, 'does not exist'):
+            self.index.get_path(1000)
+
+    def test_is_ancestor_many_numpy(self):
+        """
+        Test that the vectorized checks give the same results as the checks of single pairs.
+        """
+
+        pytest.importorskip('numpy')
+
+        # unknown, negative and deleted ids are never ancestors
+        self.index.apply_delete(self.ids['G'])
+        node_ids = list(self.ids.values()) + [0, 1000, -1, -5]
+        pairs = [(a, d) for a in node_ids for d in node_ids]
+
+        for include_self in (False, True):
+            self.assertEqual(
+                self.index.is_ancestor_many(pairs, include_self),
+                [self.index.is_ancestor(a, d, include_self) for a, d in pairs]
+            )
+
+    def test_updates(self):
+        """
+        Test that the index follows random changes of the tree.
+        """
+
+        random = Random(0)
+
+        for step in range(60):
+            node_ids = list(self.index.order)
+            node_id = random.choice(node_ids)
+
+            if step % 10 == 9:
+                self.c_tree.delete_node(node_id)
+                self.index.apply_delete(node_id)
+            elif step % 3 == 0:
+                new_id = self.c_tree.add_node('N{}'.format(step), node_id)
+                self.index.apply_add(new_id, node_id)
+            else:
+                new_parent_id = random.choice(node_ids + [None])
+                if self.index.is_ancestor(node_id, new_parent_id or node_id, include_self=new_parent_id is not None):
+                    with self.assertRaises(Exception):
+                        self.index.apply_move(node_id, new_parent_id)
+                    continue
+
+                self.c_tree.move_node(node_id, new_parent_id)
+                self.index.apply_move(node_id, new_parent_id)
+
+        self._assert_mirror(self.c_tree, self.index)
+
+    def test_other_trees(self):
+        """
+        Test an index built from another tree implementation.
+        """
+
+        tree = AdjacencyTree()
+        a_id = tree.add_node('A')
+        b_id = tree.add_node('B', a_id)
+        c_id = tree.add_node('C', b_id)
+
+        index = TreeIndex.from_tree(tree)
+        self.assertEqual(index.get_path(c_id), [a_id, b_id, c_id])
+
+        index = TreeIndex.from_parents({a_id: None, b_id: a_id, c_id: a_id})
+        self.assertEqual(list(index.get_subtree(a_id)), [a_id, b_id, c_id])
+
+        with self.assertRaisesRegex(Exception, 'cycle'):
+            TreeIndex.from_parents({a_id: b_id, b_id: a_id})
+
+    def test_sparse_ids(self):
+        """
+        Test that the arrays grow with the number of nodes, not with the highest id.
+        """
+
+        base = 10 ** 12
+        index = TreeIndex.from_parents({base: None, base + 7: base, 5: base + 7})
+        self.assertEqual(len(index.tin), 3)
+        self.assertEqual(index.get_path(5), [base, base + 7, 5])
+        self.assertTrue(index.is_ancestor(base, 5))
+        self.assertEqual(index.is_ancestor_many([(base, 5), (5, base), (base + 1, 5)]), [True, False, False])
+
+        index.apply_add(base + 3, 5)
+        index.apply_move(base + 7, None)
+        index.apply_delete(5)
+        self.assertEqual(list(index.ids), [base, base + 7])
+        self.assertEqual(index.get_roots(), [base, base + 7])
+        self.assertNotIn(base + 3, index)
+
+    def test_apply_changes(self):
+        """
+        Test that replaying the change log gives the same mirror as the changes themselves.
+        """
+
+        tree = ClosureTree(log_changes=True)
+        tree.add_subtree([('A', [('B', ['D', 'E']), 'C']), ('X', ['Y'])])
+        index = TreeIndex.from_tree(tree)
+        version = tree.change_version()
+
+        ids = {x: tree.get_first_id(x) for x in 'ABCDEXY'}
+        tree.add_edges([(0, None, 'H'), (1, 0, 'I')], parent=ids['Y'])
+        tree.move_nodes([(ids['X'], ids['E']), (ids['B'], None)])
+        tree.detach_node(ids['C'])
+        tree.attach_node(ids['C'], ids['D'])
+        tree.delete_node(ids['D'])
+
+        index.apply_changes(tree.changes_since(version))
+        self._assert_mirror(tree, index)
+
+        tree.rebuild_paths()
+        with self.assertRaisesRegex(Exception, 'reloaded'):
+            index.apply_changes(tree.changes_since(version))
+
+    def test_replay_changes(self):
+        """
+        Test that a long change log, replayed at once, gives the same pre-order as the changes applied one by one.
+        """
+
+        tree = ClosureTree(log_changes=True)
+        tree.add_subtree([('A', [('B', ['D', 'E']), 'C', ('F', ['G'])]), ('X', [('Y', ['Z']), 'W'])])
+        index = TreeIndex.from_tree(tree)
+
+        random = Random(1)
+        for step in range(80):
+            node_ids = list(index.order)
+            node_id = random.choice(node_ids)
+
+            if step % 10 == 9:
+                tree.delete_node(node_id)
+            elif step % 3 == 0:
+                tree.add_node('N{}'.format(step), node_id)
+            else:
+                new_parent_id = random.choice(node_ids + [None])
+                if index.is_ancestor(node_id, new_parent_id or node_id, include_self=new_parent_id is not None):
+                    continue
+                tree.move_node(node_id, new_parent_id)
+
+            index.apply_changes(tree.changes_since(tree.change_version() - 1))
+
+        replayed = TreeIndex()
+        replayed.apply_changes(tree.changes_since(0))
+        self.assertEqual(replayed.order, index.order)
+        self.assertEqual(replayed.tin, index.tin)
+        self._assert_mirror(tree, replayed)
+
+        # an invalid change leaves the index as it was
+        changes = [Change(0, 'add', 1000 + x, None) for x in range(20)] + [Change(0, 'move', 1, 5000)]
+        with self.assertRaisesRegex(Exception, 'Parent node does not exist'):
+            replayed.apply_changes(changes)
+        self.assertEqual(replayed.order, index.order)
+        self.assertNotIn(1000, replayed)
+
+
+if __name__ == '__main__':
+    unittest.main()